@@ -0,0 +1,154 @@
+"""
+Times single runs of main.py --once from process start to exit against a fake TrueNAS, for the ICS output and for a CalDAV sync that has nothing to do, along with how long importing main takes.
+
+See the Benchmarks section of the README for how to run it.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from typing import Any, Dict
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCHMARKS_DIR, "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from bench_sync import compare_results, connect, delete_calendar, git_commit, radicale_server
+from fake_truenas import QUERY_EXAMPLES
+from options import CALDAV_AUTH_TYPE_ENV, CALDAV_HOST_ENV, CALDAV_PASSWORD_ENV, CALDAV_USERNAME_ENV, CALENDAR_ID_ENV, ICS_FILE_ENV, OUTPUT_ENV, OUTPUT_ICS, STATE_FILE_ENV, TRUENAS_API_KEY_ENV, TRUENAS_HOST_ENV, Options
+
+logger = logging.getLogger("bench_startup")
+
+DEFAULT_ITEMS = 100
+DEFAULT_RUNS = 10
+
+
+def time_process(command: list[str], env: Dict[str, str]) -> float:
+    start = time.perf_counter()
+    result = subprocess.run(command, env=env, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise Exception(f"{' '.join(command)} exited with status {result.returncode}:\n{result.stderr[-2000:]}")
+
+    return seconds
+
+
+def time_scenario(scenario: str, items: int, command: list[str], env: Dict[str, str], runs: int) -> Dict[str, Any]:
+    """
+    Runs a command in a fresh process a number of times and measures it.
+
+    :return: The result row of the scenario.
+    :rtype: Dict[str, Any]
+    """
+    timings = [time_process(command, env) for _ in range(runs)]
+    result = {
+        "scenario": scenario,
+        "items": items,
+        "seconds": round(statistics.median(timings), 4),
+        "min_seconds": round(min(timings), 4),
+        "max_seconds": round(max(timings), 4),
+        "runs": runs,
+    }
+    logger.info(f"{scenario} with {items} items took {result['seconds']:.3f}s (median of {runs}).")
+    return result
+
+
+def benchmark(caldav_host: str, args: argparse.Namespace) -> list[Dict[str, Any]]:
+    items_per_query = max(args.items // len(QUERY_EXAMPLES), 1)
+    items = items_per_query * len(QUERY_EXAMPLES)
+    child = [args.python, os.path.join(BENCHMARKS_DIR, "once_with_fake_truenas.py"), str(items_per_query)]
+    base_env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join([SRC_DIR, BENCHMARKS_DIR] + [x for x in [os.environ.get("PYTHONPATH")] if x]),
+        TRUENAS_HOST_ENV: "fake",
+        TRUENAS_API_KEY_ENV: "fake",
+    }
+
+    results = [time_scenario("import", items, [args.python, "-c", "import main"], base_env, args.runs)]
+
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as directory:
+        ics_env = {**base_env, OUTPUT_ENV: OUTPUT_ICS, ICS_FILE_ENV: os.path.join(directory, "jobs.ics")}
+        results.append(time_scenario("ics", items, child, ics_env, args.runs))
+
+        for scenario, auth_type in (("caldav", ""), ("caldav-auth", "basic")):
+            calendar_id = f"bench-startup-{uuid.uuid4().hex[:8]}"
+            caldav_env = {
+                **base_env,
+                CALENDAR_ID_ENV: calendar_id,
+                CALDAV_HOST_ENV: caldav_host,
+                CALDAV_USERNAME_ENV: args.caldav_username,
+                CALDAV_PASSWORD_ENV: args.caldav_password,
+                CALDAV_AUTH_TYPE_ENV: auth_type,
+                STATE_FILE_ENV: os.path.join(directory, f"{calendar_id}.json"),
+            }
+
+            try:
+                # The first run fills the calendar and the state file, so the timed ones have nothing to do.
+                time_process(child, caldav_env)
+                results.append(time_scenario(scenario, items, child, caldav_env, args.runs))
+            finally:
+                if not args.keep_calendars:
+                    with connect(Options.from_mapping(caldav_env)) as dav_client:
+                        delete_calendar(dav_client, calendar_id)
+
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, default=DEFAULT_ITEMS, help=f"The total item count, spread evenly over the item types (default: {DEFAULT_ITEMS}).")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help=f"How many times to run every scenario, reporting the median (default: {DEFAULT_RUNS}).")
+    parser.add_argument("--python", default=sys.executable, help="The Python interpreter to run main.py with (default: this one).")
+    parser.add_argument("--caldav-host", help="The host and port of a running CalDAV server to use, rather than starting Radicale.")
+    parser.add_argument("--caldav-username", default="bench")
+    parser.add_argument("--caldav-password", default="bench")
+    parser.add_argument("--radicale-python", default=sys.executable, help="The Python interpreter to run Radicale with (default: this one).")
+    parser.add_argument("--keep-calendars", action="store_true", help="Leave the benchmark calendars on the server.")
+    parser.add_argument("--output", default="benchmark-startup-results.json", help="Where to write the results (default: benchmark-startup-results.json).")
+    parser.add_argument("--compare", help="Results of an earlier run to compare against.")
+    parser.add_argument("--max-slowdown", type=float, default=1.5, help="With --compare, exit with an error if any scenario got slower than this factor (default: 1.5).")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    with radicale_server(args.radicale_python) if args.caldav_host is None else nullcontext(args.caldav_host) as caldav_host:
+        results = benchmark(caldav_host, args)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": args.runs,
+        },
+        "results": results,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for result in results:
+        print(f"{result['scenario']:>11} {result['items']:>6}: {result['seconds']:.3f}s (min {result['min_seconds']:.3f}s, max {result['max_seconds']:.3f}s)")
+
+    print(f"Wrote results to {args.output}.")
+
+    if args.compare is not None and not compare_results(results, args.compare, args.max_slowdown):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
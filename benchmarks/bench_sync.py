@@ -0,0 +1,270 @@
+"""
+Times CalDAV syncs (caldav_sync.perform_sync_async) against a fake TrueNAS and a local CalDAV server, for a cold sync, a no-op sync and syncs after some items changed, at a range of item counts.
+
+See the Benchmarks section of the README for how to run it.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from caldav.davclient import DAVClient, get_davclient
+import caldav_sync
+import sync_plan
+from calendar_snapshot import CalendarSnapshot
+from calendar_writes import configure_dav_session, create_dav_adapter, create_dav_auth
+from fake_truenas import QUERY_EXAMPLES, FakeTrueNASClient
+from options import CALDAV_HOST_ENV, CALDAV_PASSWORD_ENV, CALDAV_USERNAME_ENV, CALENDAR_ID_ENV, CALDAV_MAX_CONCURRENCY_ENV, TRUENAS_API_KEY_ENV, TRUENAS_HOST_ENV, WRITE_TIMEOUT_ENV, Options
+from state_store import SyncState
+
+logger = logging.getLogger("bench_sync")
+
+DEFAULT_SIZES = "10,100,1000,10000"
+
+RADICALE_CONFIG = """[server]
+hosts = 127.0.0.1:{port}
+[auth]
+type = none
+[storage]
+filesystem_folder = {storage}
+[logging]
+level = warning
+"""
+
+
+def find_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"Radicale exited with status {process.returncode} before it started listening.")
+
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+
+    raise Exception(f"Radicale did not start listening on port {port} within {timeout} seconds.")
+
+
+@contextmanager
+def radicale_server(python: str) -> Iterator[str]:
+    """
+    Runs a throwaway Radicale instance with its storage in a temporary directory.
+
+    :param python: The Python interpreter that has Radicale installed.
+    :type python: str
+    :return: The host and port of the server.
+    :rtype: Iterator[str]
+    """
+    with tempfile.TemporaryDirectory(prefix="bench-radicale-") as directory:
+        port = find_free_port()
+        config_path = os.path.join(directory, "config")
+        with open(config_path, "w") as f:
+            f.write(RADICALE_CONFIG.format(port=port, storage=os.path.join(directory, "collections")))
+
+        process = subprocess.Popen([python, "-m", "radicale", "--config", config_path])
+        try:
+            wait_for_port(port, process, 30)
+            yield f"127.0.0.1:{port}"
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def connect(options: Options) -> DAVClient:
+    auth = create_dav_auth(options.caldav_auth_type, options.caldav_username, options.caldav_password)
+    client = get_davclient(url=f"http://{options.caldav_host}", username=options.caldav_username, password=options.caldav_password, auth=auth)
+    configure_dav_session(client, create_dav_adapter(options.caldav_max_concurrency))
+    return client
+
+
+def delete_calendar(dav_client: DAVClient, calendar_id: str):
+    for calendar in dav_client.principal().calendars():
+        if calendar.id == calendar_id:
+            calendar.delete()
+
+
+def time_sync(scenario: str, size: int, options: Options, dav_client: DAVClient, truenas: FakeTrueNASClient, state: SyncState, snapshot: CalendarSnapshot, changed_ids: Optional[dict[str, set[int]]] = None) -> Dict[str, Any]:
+    """
+    Runs a single sync and measures it.
+
+    :return: The result row of the sync.
+    :rtype: Dict[str, Any]
+    """
+    calls_before = truenas.calls
+    start = time.perf_counter()
+    counts = asyncio.run(caldav_sync.perform_sync_async(options, dav_client, truenas, state, snapshot, set(), changed_ids))  # type: ignore
+    seconds = time.perf_counter() - start
+
+    result = {
+        "scenario": scenario,
+        "items": size,
+        "seconds": round(seconds, 4),
+        "truenas_calls": truenas.calls - calls_before,
+        "counts": asdict(counts),
+    }
+    logger.info(f"{scenario} sync of {size} items took {seconds:.3f}s: {counts}.")
+    return result
+
+
+def benchmark_size(size: int, caldav_host: str, args: argparse.Namespace) -> list[Dict[str, Any]]:
+    """
+    Runs every scenario for one item count, against a calendar of its own.
+
+    :param size: The total number of items, spread evenly over the item types and so rounded down to a multiple of their number.
+    :type size: int
+    :rtype: list[Dict[str, Any]]
+    """
+    calendar_id = f"bench-{size}-{uuid.uuid4().hex[:8]}"
+    options = Options.from_mapping({
+        CALENDAR_ID_ENV: calendar_id,
+        CALDAV_HOST_ENV: caldav_host,
+        CALDAV_USERNAME_ENV: args.caldav_username,
+        CALDAV_PASSWORD_ENV: args.caldav_password,
+        CALDAV_MAX_CONCURRENCY_ENV: str(args.caldav_max_concurrency),
+        TRUENAS_HOST_ENV: "fake",
+        TRUENAS_API_KEY_ENV: "fake",
+        WRITE_TIMEOUT_ENV: "1 day",
+    })
+
+    items_per_query = max(size // len(QUERY_EXAMPLES), 1)
+    size = items_per_query * len(QUERY_EXAMPLES)
+    churn = max(round(items_per_query * args.change_fraction), 1)
+    truenas = FakeTrueNASClient(items_per_query, args.seed, args.truenas_latency)
+    state = SyncState()
+    snapshot = CalendarSnapshot()
+    sync_plan.ical_cache.clear()
+
+    results: list[Dict[str, Any]] = []
+    with connect(options) as dav_client:
+        try:
+            results.append(time_sync("cold", size, options, dav_client, truenas, state, snapshot))
+            results.append(time_sync("noop", size, options, dav_client, truenas, state, snapshot))
+
+            truenas.churn(churn)
+            results.append(time_sync("partial", size, options, dav_client, truenas, state, snapshot))
+
+            changed_ids = truenas.churn(churn)
+            results.append(time_sync("targeted", size, options, dav_client, truenas, state, snapshot, changed_ids))
+
+            # A restarted process has the state file but neither the snapshot nor the conversion cache.
+            sync_plan.ical_cache.clear()
+            results.append(time_sync("restart", size, options, dav_client, truenas, state, CalendarSnapshot()))
+        finally:
+            if not args.keep_calendars:
+                delete_calendar(dav_client, calendar_id)
+
+    return results
+
+
+def compare_results(results: list[Dict[str, Any]], baseline_path: str, max_slowdown: float) -> bool:
+    """
+    Prints how the results compare to an earlier run.
+
+    :return: Whether no scenario got slower than allowed.
+    :rtype: bool
+    """
+    with open(baseline_path) as f:
+        baseline = {(x["scenario"], x["items"]): x for x in json.load(f)["results"]}
+
+    ok = True
+    for result in results:
+        previous = baseline.get((result["scenario"], result["items"]))
+        if previous is None or previous["seconds"] <= 0:
+            continue
+
+        ratio = result["seconds"] / previous["seconds"]
+        regressed = ratio > max_slowdown
+        ok = ok and not regressed
+        print(f"{result['scenario']:>8} {result['items']:>6}: {previous['seconds']:.3f}s -> {result['seconds']:.3f}s ({ratio:.2f}x){' REGRESSION' if regressed else ''}")
+
+    return ok
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Comma separated total item counts to benchmark (default: {DEFAULT_SIZES}).")
+    parser.add_argument("--caldav-host", help="The host and port of a running CalDAV server to use, rather than starting Radicale.")
+    parser.add_argument("--caldav-username", default="bench")
+    parser.add_argument("--caldav-password", default="bench")
+    parser.add_argument("--caldav-max-concurrency", type=int, default=4)
+    parser.add_argument("--radicale-python", default=sys.executable, help="The Python interpreter to run Radicale with (default: this one).")
+    parser.add_argument("--truenas-latency", type=float, default=0.0, help="Seconds every fake TrueNAS call takes (default: 0).")
+    parser.add_argument("--change-fraction", type=float, default=0.01, help="The fraction of items of every type to reschedule, delete and add for the partial syncs (default: 0.01).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-calendars", action="store_true", help="Leave the benchmark calendars on the server.")
+    parser.add_argument("--output", default="benchmark-results.json", help="Where to write the results (default: benchmark-results.json).")
+    parser.add_argument("--compare", help="Results of an earlier run to compare against.")
+    parser.add_argument("--max-slowdown", type=float, default=1.5, help="With --compare, exit with an error if any scenario got slower than this factor (default: 1.5).")
+    parser.add_argument("--log-level", default="ERROR", help="The log level of the sync itself (default: ERROR).")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+
+    sizes = [int(x) for x in args.sizes.split(",")]
+    results: list[Dict[str, Any]] = []
+
+    with radicale_server(args.radicale_python) if args.caldav_host is None else nullcontext(args.caldav_host) as caldav_host:
+        for size in sizes:
+            results.extend(benchmark_size(size, caldav_host, args))
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "caldav_max_concurrency": args.caldav_max_concurrency,
+            "truenas_latency": args.truenas_latency,
+            "change_fraction": args.change_fraction,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for result in results:
+        print(f"{result['scenario']:>8} {result['items']:>6}: {result['seconds']:.3f}s ({', '.join(f'{v} {k}' for k, v in result['counts'].items())})")
+
+    print(f"Wrote results to {args.output}.")
+
+    if args.compare is not None and not compare_results(results, args.compare, args.max_slowdown):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,163 @@
+import copy
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Dict
+from common import QUERY_CLOUDSYNC, QUERY_CRONJOB, QUERY_SCRUB, QUERY_SNAPSHOT
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "truenas-response-examples")
+
+# The example file and the description key of every query.
+QUERY_EXAMPLES = {
+    QUERY_SNAPSHOT: ("snapshottask-example.json", "dataset"),
+    QUERY_SCRUB: ("scrub-example.json", "pool_name"),
+    QUERY_CLOUDSYNC: ("cloudsync-example.json", "description"),
+    QUERY_CRONJOB: ("cronjob-example.json", "description"),
+}
+
+
+def load_examples() -> dict[str, list[Dict]]:
+    """
+    Loads the example responses of every query.
+
+    :rtype: dict[str, list[Dict]]
+    """
+    examples: dict[str, list[Dict]] = {}
+    for query, (file_name, _) in QUERY_EXAMPLES.items():
+        with open(os.path.join(EXAMPLES_DIR, file_name)) as f:
+            examples[query] = json.load(f)
+
+    return examples
+
+
+def synthesize_item(template: Dict, description_key: str, item_id: int, rng: random.Random) -> Dict:
+    """
+    Creates an item shaped like a real one, with a unique ID and description and a schedule based on the template's.
+
+    :param template: The example item to copy.
+    :type template: Dict
+    :param description_key: The key of the item description.
+    :type description_key: str
+    :param item_id: The ID of the new item.
+    :type item_id: int
+    :param rng: The random number generator to vary the schedule with.
+    :type rng: random.Random
+    :rtype: Dict
+    """
+    item = copy.deepcopy(template)
+    item["id"] = item_id
+    item["enabled"] = True
+    item[description_key] = f"{template[description_key]}-{item_id}"
+
+    # Spread the items over more schedules than the examples have, but keep them sharing, like real tasks do.
+    if item["schedule"]["hour"].isdigit():
+        item["schedule"]["hour"] = str(rng.randrange(24))
+
+    return item
+
+
+def matches_filter(item: Dict, query_filter: list[Any]) -> bool:
+    key, operator, value = query_filter
+    if operator == "=":
+        return item.get(key) == value
+    if operator == "!=":
+        return item.get(key) != value
+    if operator == "in":
+        return item.get(key) in value
+    if operator == "^":
+        return str(item.get(key)).startswith(value)
+    if operator == "$":
+        return str(item.get(key)).endswith(value)
+
+    raise Exception(f"Unsupported query-filter operator \"{operator}\".")
+
+
+class FakeTrueNASClient:
+    """
+    Stands in for a logged in TrueNAS API client, answering queries for synthetic items with the query-filters and field selection that the sync uses.
+    """
+
+    def __init__(self, items_per_query: int, seed: int = 0, latency: float = 0.0):
+        """
+        :param items_per_query: How many items of every type to create.
+        :type items_per_query: int
+        :param seed: The seed of the random number generator that varies the items.
+        :type seed: int
+        :param latency: How long every call takes, in seconds, to simulate the round trip to a real server.
+        :type latency: float
+        """
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._examples = load_examples()
+        self._next_id = 1
+        self.latency = latency
+        self.calls = 0
+        self.items: dict[str, list[Dict]] = {x: [self._new_item(x) for _ in range(items_per_query)] for x in QUERY_EXAMPLES}
+
+    def _new_item(self, query: str) -> Dict:
+        examples = self._examples[query]
+        item = synthesize_item(examples[self._next_id % len(examples)], QUERY_EXAMPLES[query][1], self._next_id, self._rng)
+        self._next_id += 1
+        return item
+
+    def call(self, method: str, *params: Any) -> Any:
+        with self._lock:
+            self.calls += 1
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if method == "core.ping":
+            return "pong"
+        if method == "auth.login_with_api_key":
+            return True
+        if method not in self.items:
+            raise Exception(f"Unsupported method \"{method}\".")
+
+        filters: list[list[Any]] = params[0] if len(params) > 0 else []
+        options: Dict = params[1] if len(params) > 1 else {}
+
+        with self._lock:
+            items = [x for x in self.items[method] if all(matches_filter(x, f) for f in filters)]
+
+        if "select" in options:
+            return [{k: x[k] for k in options["select"] if k in x} for x in items]
+
+        return copy.deepcopy(items)
+
+    def churn(self, count: int) -> dict[str, set[int]]:
+        """
+        Reschedules, deletes and adds items of every type, like a user editing their tasks between syncs.
+
+        :param count: How many items of every type to reschedule, and to delete and add.
+        :type count: int
+        :return: The IDs of the items that changed keyed by query, as the change subscriptions would report them.
+        :rtype: dict[str, set[int]]
+        """
+        changed_ids: dict[str, set[int]] = {}
+        with self._lock:
+            for query, items in self.items.items():
+                changed = changed_ids.setdefault(query, set())
+                picked = self._rng.sample(range(len(items)), min(2 * count, len(items)))
+
+                for index in picked[:count]:
+                    schedule = items[index]["schedule"]
+                    minute = schedule["minute"].split(",")[0]
+                    schedule["minute"] = str((int(minute) + 7) % 60) if minute.isdigit() else "7"
+                    changed.add(items[index]["id"])
+
+                for index in sorted(picked[count:], reverse=True):
+                    changed.add(items.pop(index)["id"])
+
+                for _ in range(count):
+                    item = self._new_item(query)
+                    items.append(item)
+                    changed.add(item["id"])
+
+        return changed_ids
+
+    def close(self):
+        pass
+
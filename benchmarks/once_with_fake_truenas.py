@@ -0,0 +1,16 @@
+"""
+Runs main.py --once with the TrueNAS client swapped for the fake one, for bench_startup.py to time from process start to exit.
+
+Takes the number of items of every type as its only argument. Nothing else is imported, so that the timing is that of main.py itself.
+"""
+import sys
+import truenas_api_client
+from fake_truenas import FakeTrueNASClient
+
+items_per_query = int(sys.argv[1])
+truenas_api_client.Client = lambda *args, **kwargs: FakeTrueNASClient(items_per_query)
+
+import main
+
+sys.argv = [main.__file__, "--once"]
+main.main()
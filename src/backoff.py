@@ -0,0 +1,36 @@
+import random
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter for retrying after failures.
+    """
+
+    def __init__(self, initial: float, maximum: float):
+        """
+        :param initial: The delay after the first failure, in seconds.
+        :type initial: float
+        :param maximum: The longest delay, in seconds.
+        :type maximum: float
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.failures = 0
+
+    def next_delay(self) -> float:
+        """
+        Records a failure and gets how long to wait before trying again.
+        The delay doubles with each consecutive failure up to the maximum, and a random half of it is jittered away so that many instances don't retry in lockstep.
+
+        :return: The delay in seconds.
+        :rtype: float
+        """
+        ceiling = min(self.maximum, self.initial * 2 ** min(self.failures, 32))
+        self.failures += 1
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def reset(self):
+        """
+        Records a success, so that the next failure starts over from the initial delay.
+        """
+        self.failures = 0
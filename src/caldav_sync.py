@@ -0,0 +1,461 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from truenas_api_client import JSONRPCClient, LegacyClient
+from caldav.davclient import DAVClient
+from caldav.collection import Calendar
+from caldav.lib import error
+from calendar_snapshot import CalendarSnapshot, RemoteEvent, load_event_bodies
+from common import CALENDAR_NAME, create_item_uid
+from cron_to_ical import FREQ_HOURLY, FREQ_MINUTELY, ICalResult
+from calendar_writes import CalendarWrite, count_writes, create_event_write, create_run_event_write, delete_event_write, run_writes, update_event_write
+from event_diff import SyncCounts, event_content_hash, is_event_up_to_date, is_stored_event_up_to_date
+from event_index import EventIndex
+from event_plan import PlannedEvent
+from item_types import ITEM_TYPES
+from job_runs import RUN_UID_TYPE, JobRun, RunEvent, create_run_event, expired_run_events, is_run_uid
+from metrics import events_total, phase_seconds
+from options import Options
+from state_store import StoredEvent, SyncState, save_state
+from sync_plan import build_query_specs, get_job_methods, ical_cache, plan_all_events
+from truenas_queries import QueryResult, QuerySpec, fetch_job_runs, run_queries
+
+logger = logging.getLogger(__name__)
+
+
+async def download_event_bodies(options: Options, calendar: Calendar, events: dict[str, RemoteEvent], uids: list[str], state: SyncState):
+    """
+    Downloads the bodies of events in a worker thread, see load_event_bodies, within the fetch timeout.
+    Events that were removed from the calendar since its index was fetched are dropped from the events and the sync state, as if they had never been found.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param calendar: The calendar the events are in.
+    :type calendar: Calendar
+    :param events: The existing calendar events keyed by UID.
+    :type events: dict[str, RemoteEvent]
+    :param uids: The UIDs of the events to download.
+    :type uids: list[str]
+    :param state: What was last pushed to the calendar.
+    :type state: SyncState
+    """
+    to_download = [events[x] for x in uids]
+    try:
+        async with asyncio.timeout(options.fetch_timeout.seconds):
+            with phase_seconds.time(phase="event_body_fetch"):
+                await asyncio.to_thread(load_event_bodies, calendar, to_download)
+    except TimeoutError:
+        raise Exception(f"Downloading {len(to_download)} events from the calendar took longer than {options.fetch_timeout}.")
+
+    # Accessing their components would try to download them again, and fail.
+    for event in to_download:
+        if event.event.data is None:
+            logger.info(f"Event with UID {event.uid} was removed from the calendar in the meantime.")
+            events.pop(event.uid, None)
+            state.events.pop(event.uid, None)
+
+
+async def create_events(
+    options: Options,
+    planned_events: list[PlannedEvent],
+    events: dict[str, RemoteEvent],
+    state: SyncState,
+    calendar: Calendar,
+    counts: SyncCounts,
+    writes: list[CalendarWrite]
+) -> set[str]:
+    """
+    Works out which calendar events need to be created or updated for the planned events of a given item type.
+    Existing events are only downloaded, in batches, when the sync state can't vouch for them.
+    
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param planned_events: The events the items should have.
+    :type planned_events: list[PlannedEvent]
+    :param events: The existing calendar events of this item type keyed by UID.
+    :type events: dict[str, RemoteEvent]
+    :param state: What was last pushed to the calendar. Updated with every event that is saved or found to be up to date.
+    :type state: SyncState
+    :param calendar: The calendar to which events will be added.
+    :type calendar: Calendar
+    :param counts: The tally of unchanged events to add to.
+    :type counts: SyncCounts
+    :param writes: The list of calendar writes to add any creates and updates to.
+    :type writes: list[CalendarWrite]
+    :return: A set of event UIDs that are to be created or updated, or that were found to be up to date.
+    :rtype: set[str]
+    """
+    event_uids_saved: set[str] = set()
+    conversion_seconds = 0.0
+    # The planned events with their iCal rules, and whether the sync state says their events are up to date.
+    checked: list[tuple[PlannedEvent, ICalResult, bool]] = []
+
+    for planned in planned_events:
+        conversion_start = time.perf_counter()
+        ical = ical_cache.get(planned.cron)
+        conversion_seconds += time.perf_counter() - conversion_start
+        logger.info(f"Resulting ICAL object: {ical}")
+
+        if ical.rrule["FREQ"] in (FREQ_HOURLY, FREQ_MINUTELY):
+            logger.warning("Hourly and minutely FREQs might not be supported by some calendars!")
+
+        previous_event = events.get(planned.uid)
+        stored_event = state.events.get(planned.uid)
+        checked.append((planned, ical, previous_event is not None and stored_event is not None and is_stored_event_up_to_date(stored_event, previous_event.etag, ical, planned.summary, planned.description)))
+
+    phase_seconds.observe(conversion_seconds, phase="conversion")
+
+    await download_event_bodies(options, calendar, events, [x.uid for x, _, up_to_date in checked if x.uid in events and not up_to_date], state)
+
+    for planned, ical, up_to_date in checked:
+        event_uid, summary, description = planned.uid, planned.summary, planned.description
+        previous_event = events.get(event_uid)
+
+        event_uids_saved.add(event_uid)
+
+        if up_to_date:
+            logger.info("Previously saved event is already up to date.")
+            counts.unchanged += 1
+        elif previous_event is not None and is_event_up_to_date(previous_event.component, ical, summary, description):
+            logger.info("Previously saved event is already up to date, but did not match the sync state.")
+            state.events[event_uid] = StoredEvent(previous_event.href, previous_event.etag, event_content_hash(ical, summary, description), previous_event.component.get("dtstart").dt.isoformat())
+            counts.unchanged += 1
+        elif previous_event is not None:
+            logger.info("Previously saved event needs to be updated.")
+            writes.append(update_event_write(state, previous_event, ical, summary, description))
+        else:
+            logger.info("Event needs to be saved to calendar.")
+            writes.append(create_event_write(calendar, state, event_uid, ical, summary, description))
+
+    return event_uids_saved
+
+
+async def create_run_events(
+    options: Options,
+    run_events: list[RunEvent],
+    events: dict[str, RemoteEvent],
+    state: SyncState,
+    calendar: Calendar,
+    cutoff: datetime,
+    writes: list[CalendarWrite]
+):
+    """
+    Works out which job run events need to be created, and which expired ones removed.
+    Runs never change once they finished, so their events are only ever created and removed.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param run_events: The events of the runs that finished since the last sync.
+    :type run_events: list[RunEvent]
+    :param events: The existing run events keyed by UID.
+    :type events: dict[str, RemoteEvent]
+    :param state: What was last pushed to the calendar.
+    :type state: SyncState
+    :param calendar: The calendar to which events will be added.
+    :type calendar: Calendar
+    :param cutoff: When the retained runs start. Older runs are removed, a batch per sync.
+    :type cutoff: datetime
+    :param writes: The list of calendar writes to add the creates and removals to.
+    :type writes: list[CalendarWrite]
+    """
+    for run_event in run_events:
+        if run_event.uid in events or run_event.start < cutoff:
+            continue
+
+        logger.info(f"Job run event \"{run_event.summary}\" needs to be saved to calendar.")
+        writes.append(create_run_event_write(calendar, state, run_event))
+
+    # Only the run events missing from the sync state need downloading to find out when they started.
+    await download_event_bodies(options, calendar, events, [x for x in events if x not in state.events], state)
+
+    writes.extend(delete_event_write(state, x) for x in expired_run_events(events, state, cutoff))
+
+
+async def fetch_runs(options: Options, truenas_client: JSONRPCClient | LegacyClient, state: SyncState) -> tuple[list[JobRun], int, list[int]]:
+    """
+    Fetches the job runs that finished since the last sync, if they go on the calendar.
+
+    :return: The finished runs, the new job cursor and the IDs of the jobs that are still running.
+    :rtype: tuple[list[JobRun], int, list[int]]
+    """
+    methods = get_job_methods(options)
+    if len(methods) == 0:
+        return [], state.job_cursor, state.unfinished_job_ids
+
+    return await asyncio.to_thread(fetch_job_runs, truenas_client, state.job_cursor, state.unfinished_job_ids, methods)
+
+
+async def plan_run_events(options: Options, truenas_client: JSONRPCClient | LegacyClient, runs: list[JobRun], query_results: dict[str, QueryResult], queries_without_options: set[str]) -> list[RunEvent]:
+    """
+    Works out the events for job runs, named after the items that ran. Items that weren't fetched in this sync (i.e. in a targeted sync) are looked up.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param truenas_client: The TrueNAS client to look up items with.
+    :type truenas_client: JSONRPCClient | LegacyClient
+    :param runs: The finished runs.
+    :type runs: list[JobRun]
+    :param query_results: The items fetched in this sync keyed by query.
+    :type query_results: dict[str, QueryResult]
+    :param queries_without_options: The queries that the TrueNAS can't run with filters or a field selection, see run_query_spec.
+    :type queries_without_options: set[str]
+    :return: The events of the runs whose items pass the filters.
+    :rtype: list[RunEvent]
+    """
+    item_types = {x.name: x for x in options.included_item_types()}
+
+    def add_names(results: dict[str, QueryResult]):
+        for item_type in item_types.values():
+            for item in results[item_type.query].items if item_type.query in results else []:
+                names[(item_type.name, item["id"])] = str(item[item_type.description_key])
+
+    names: dict[tuple[str, int], str] = {}
+    add_names(query_results)
+
+    missing_ids: dict[str, set[int]] = {}
+    for run in runs:
+        if run.item_type in item_types and run.item_id is not None and (run.item_type, run.item_id) not in names:
+            missing_ids.setdefault(run.item_type, set()).add(run.item_id)
+
+    if len(missing_ids) > 0:
+        add_names(await run_queries(truenas_client, [QuerySpec(item_types[item_type].query, ["id", item_types[item_type].description_key], [["id", "in", sorted(ids)]]) for item_type, ids in missing_ids.items()], queries_without_options))
+
+    run_events: list[RunEvent] = []
+    for run in (x for x in runs if x.item_type in item_types):
+        items_filter = options.filters[run.item_type]
+        name = run.item_name if run.item_name is not None else names.get((run.item_type, run.item_id))  # type: ignore
+
+        if name is None:
+            # The item was removed since it ran.
+            name = f"#{run.item_id}"
+        elif items_filter is not None and items_filter.search(name) is None:
+            continue
+
+        run_events.append(create_run_event(run, name))
+
+    return run_events
+
+
+def find_calendar(options: Options, dav_client: DAVClient) -> Calendar:
+    """
+    Finds the TrueNAS jobs calendar, creating it if it doesn't exist.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param dav_client: The CalDAV client to use for interacting with the calendar.
+    :type dav_client: DAVClient
+    :rtype: Calendar
+    """
+    my_principal = dav_client.principal()
+
+    # Go find the corresponding calendar
+    truenas_calendar: Calendar | None = None
+    for cal in my_principal.calendars():
+        if cal.id != options.calendar_id:
+            continue
+
+        truenas_calendar = cal
+
+    # Create one if it doesn't exist
+    if truenas_calendar is None:
+        logger.info("TrueNAS jobs calendar not found. One will be created.")
+        truenas_calendar = my_principal.make_calendar(CALENDAR_NAME, options.calendar_id)
+    else:
+        logger.info("Found previous TrueNAS jobs calendar.")
+
+    return truenas_calendar
+
+
+def remembered_calendar(options: Options, dav_client: DAVClient, calendar_url: Optional[str]) -> Optional[Calendar]:
+    """
+    Gets the calendar at the URL it was found at before, without sending a request, if that URL is still on the same server and has the configured calendar ID.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param dav_client: The CalDAV client to use for interacting with the calendar.
+    :type dav_client: DAVClient
+    :param calendar_url: Where the calendar was found before, if anywhere.
+    :type calendar_url: Optional[str]
+    :rtype: Optional[Calendar]
+    """
+    server_url = str(dav_client.url.canonical()).rstrip("/")
+    # The calendar IDs that find_calendar compares are the last segment of the calendar URL.
+    if calendar_url is None or not calendar_url.startswith(server_url + "/") or calendar_url.rstrip("/").split("/")[-1] != options.calendar_id:
+        return None
+
+    return dav_client.calendar(url=calendar_url)
+
+
+def fetch_calendar(options: Options, dav_client: DAVClient, state: SyncState, snapshot: CalendarSnapshot) -> tuple[Calendar, EventIndex]:
+    """
+    Finds the TrueNAS jobs calendar and brings the snapshot of its events up to date.
+    The calendar is only looked for when it wasn't found before, or can't be fetched where it was found before.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param dav_client: The CalDAV client to use for interacting with the calendar.
+    :type dav_client: DAVClient
+    :param state: What was last pushed to the calendar, to restore the snapshot from after a restart.
+    :type state: SyncState
+    :param snapshot: The snapshot of the calendar events.
+    :type snapshot: CalendarSnapshot
+    :return: The calendar and its events.
+    :rtype: tuple[Calendar, EventIndex]
+    """
+    # Looking for the calendar takes a few requests, which is most of a sync that has nothing to do.
+    truenas_calendar = remembered_calendar(options, dav_client, snapshot.calendar_url or state.calendar_url)
+    remembered = truenas_calendar is not None
+    if truenas_calendar is None:
+        with phase_seconds.time(phase="calendar_discovery"):
+            truenas_calendar = find_calendar(options, dav_client)
+    else:
+        logger.info("Using the TrueNAS jobs calendar found in a previous sync.")
+
+    # After a restart, pick up from the state file rather than downloading the whole calendar again.
+    if snapshot.calendar_url is None and state.calendar_url == str(truenas_calendar.url.canonical()):
+        logger.info("Restoring calendar snapshot from the sync state.")
+        snapshot.restore(state.calendar_url, state.sync_token, state.ctag, ((x.href, uid, x.etag) for uid, x in state.events.items()))
+
+    known_uids = {x.href: uid for uid, x in state.events.items()}
+    with phase_seconds.time(phase="event_fetch"):
+        try:
+            events = snapshot.fetch(truenas_calendar, known_uids)
+        except error.DAVError as e:
+            if not remembered:
+                raise
+
+            # I.e. the calendar was removed since the last sync.
+            logger.warning(f"Failed to fetch the calendar where it was found before, looking for it again: {e}")
+            snapshot.invalidate()
+            with phase_seconds.time(phase="calendar_discovery"):
+                truenas_calendar = find_calendar(options, dav_client)
+            events = snapshot.fetch(truenas_calendar, known_uids)
+
+    event_index = EventIndex(events)
+    logger.info(f"Found {len(event_index)} existing events.")
+    return truenas_calendar, event_index
+
+
+async def perform_sync_async(
+    options: Options,
+    dav_client: DAVClient,
+    truenas_client: JSONRPCClient | LegacyClient,
+    state: SyncState,
+    snapshot: CalendarSnapshot,
+    queries_without_options: set[str],
+    changed_ids: Optional[dict[str, set[int]]] = None
+) -> SyncCounts:
+    """
+    Performs synchronization of TrueNAS recurring jobs with a CalDAV server.
+
+    The TrueNAS queries and the calendar fetch run at the same time, then the changes are worked out and written as concurrent tasks.
+    With job runs included, the runs that finished since the last sync are added as events of their own, and runs past their retention removed.
+    Both the fetch and the write phase are cancelled if they take longer than their timeout.
+    
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param dav_client: The CalDAV client to use for interacting with the calendar.
+    :type dav_client: DAVClient
+    :param truenas_client: The TrueNAS client to use for fetching job data.
+    :type truenas_client: JSONRPCClient | LegacyClient
+    :param state: What was last pushed to the calendar. This is brought up to date and written to the state file, if there is one.
+    :type state: SyncState
+    :param snapshot: The snapshot of the calendar events to sync against, kept between syncs so that only what changed is downloaded. Each calendar synced in the same process needs its own.
+    :type snapshot: CalendarSnapshot
+    :param queries_without_options: The queries that the TrueNAS can't run with filters or a field selection, see run_query_spec. Queries found to fail with them are added.
+    :type queries_without_options: set[str]
+    :param changed_ids: The IDs of the items that changed keyed by query, to only sync those. None syncs everything.
+    :type changed_ids: Optional[dict[str, set[int]]]
+    :return: How many events were created, updated, left unchanged and deleted.
+    :rtype: SyncCounts
+    """
+    
+    # A changed item can move between group events, which only a full sync of its type can work out.
+    if changed_ids is not None and options.group_by_schedule:
+        logger.info(f"Items changed ({changed_ids}), but their events are grouped by schedule, so everything will be synced.")
+        changed_ids = None
+
+    if changed_ids is None:
+        logger.info("Starting sync of recurring TrueNAS jobs with caldav server.")
+    else:
+        logger.info(f"Starting targeted sync of changed TrueNAS jobs with caldav server: {changed_ids}.")
+
+    event_uids_saved: set[str] = set()
+    counts = SyncCounts()
+    writes: list[CalendarWrite] = []
+
+    query_specs = build_query_specs(options, changed_ids)
+
+    # Fetch all the things at once.
+    try:
+        async with asyncio.timeout(options.fetch_timeout.seconds):
+            with phase_seconds.time(phase="fetch"):
+                (truenas_calendar, event_index), query_results, (job_runs, job_cursor, unfinished_job_ids) = await asyncio.gather(
+                    asyncio.to_thread(fetch_calendar, options, dav_client, state, snapshot),
+                    run_queries(truenas_client, query_specs, queries_without_options),
+                    fetch_runs(options, truenas_client, state))
+    except TimeoutError:
+        raise Exception(f"Fetching the calendar and TrueNAS items took longer than {options.fetch_timeout}.")
+
+    # Sync all the things.
+    for item_type, planned_events in plan_all_events(options, query_results).items():
+        logger.info(f"Syncing {item_type} items...")
+        event_uids_saved = event_uids_saved.union(await create_events(options, planned_events, event_index.for_type(item_type), state, truenas_calendar, counts, writes))
+
+    run_uids: set[str] = set()
+    if options.include_job_runs:
+        logger.info(f"Syncing {len(job_runs)} job runs...")
+        run_writes_start = len(writes)
+        await create_run_events(options, await plan_run_events(options, truenas_client, job_runs, query_results, queries_without_options), event_index.for_type(RUN_UID_TYPE), state, truenas_calendar, datetime.now(timezone.utc) - timedelta(seconds=options.job_run_retention.seconds), writes)
+        run_uids = set(x.uid for x in writes[run_writes_start:])
+
+    # Remove stale events. A targeted sync only knows about the items that changed. Run events are removed by their retention instead, unless runs aren't synced (anymore).
+    if changed_ids is None:
+        stale_candidates = set(x.uid for x in event_index).union(state.events)
+        if options.include_job_runs:
+            stale_candidates = set(x for x in stale_candidates if not is_run_uid(x))
+    else:
+        stale_candidates = set(create_item_uid(item_type.name, item_id) for item_type in ITEM_TYPES for item_id in changed_ids.get(item_type.query, ()))
+
+    writes.extend(delete_event_write(state, x) for x in event_index if x.uid in stale_candidates and x.uid not in event_uids_saved)
+
+    logger.info(f"Writing {len(writes)} changes to the calendar with up to {options.caldav_max_concurrency} at once...")
+    try:
+        async with asyncio.timeout(options.write_timeout.seconds):
+            with phase_seconds.time(phase="write"):
+                failures = await run_writes(writes, options.caldav_max_concurrency)
+    except TimeoutError:
+        raise Exception(f"Writing {len(writes)} changes to the calendar took longer than {options.write_timeout}.")
+
+    count_writes(writes, failures, counts)
+    for outcome, count in (("created", counts.created), ("updated", counts.updated), ("unchanged", counts.unchanged), ("deleted", counts.deleted), ("failed", len(failures))):
+        events_total.inc(count, outcome=outcome)
+
+    # Failed deletes are still on the server, so keep them in the state.
+    failed_uids = {x.write.uid for x in failures}
+
+    # Runs whose events failed to save are fetched again next time.
+    if len(failed_uids & run_uids) == 0:
+        state.job_cursor = job_cursor
+        state.unfinished_job_ids = unfinished_job_ids
+    for uid in [x for x in state.events if x in stale_candidates and x not in event_uids_saved and x not in failed_uids]:
+        del state.events[uid]
+
+    state.calendar_url = snapshot.calendar_url
+    state.sync_token = snapshot.sync_token
+    state.ctag = snapshot.ctag
+    await asyncio.to_thread(save_state, options.state_file, state)
+
+    logger.info(f"Sync summary: {counts}.")
+
+    logger.info(f"iCal conversion cache: {ical_cache.stats()}.")
+
+    if len(failures) > 0:
+        for failure in failures:
+            logger.error(f"Failed to {failure.write.action} event with UID {failure.write.uid}: {failure.error}")
+
+        raise Exception(f"{len(failures)} of {len(writes)} calendar writes failed.")
+
+    return counts
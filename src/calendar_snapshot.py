@@ -0,0 +1,293 @@
+import logging
+from dataclasses import dataclass
+from itertools import batched
+from typing import ClassVar, Iterable, Optional
+from urllib.parse import quote
+from caldav.collection import Calendar
+from caldav.calendarobjectresource import Event
+from caldav.elements import cdav, dav
+from caldav.elements.base import BaseElement, NamedBaseElement, ValuedBaseElement
+from caldav.lib import error
+from caldav.lib.url import URL
+from icalendar import Component
+from lxml import etree
+from common import UID_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# The most events to download per calendar-multiget request.
+MULTIGET_BATCH_SIZE = 100
+
+
+class GetCTag(ValuedBaseElement):
+    """
+    The CalendarServer collection tag, which changes whenever anything in the calendar changes.
+    """
+    tag: ClassVar[str] = "{http://calendarserver.org/ns/}getctag"
+
+
+class CalendarDataProp(NamedBaseElement):
+    """
+    A property to return in the calendar data (RFC 4791 section 9.6.4), as opposed to a WebDAV property.
+    """
+    tag: ClassVar[str] = "{urn:ietf:params:xml:ns:caldav}prop"
+
+
+@dataclass
+class RemoteEvent:
+    """
+    An event on the CalDAV server. Only its href, UID and ETag are known up front. The body is downloaded by load_event_bodies, or on its own when the component is first accessed.
+    """
+    href: str
+    uid: str
+    etag: Optional[str]
+    event: Event
+
+    @property
+    def component(self) -> Component:
+        return self.event.component
+
+
+def remote_event_from_event(event: Event, etag: Optional[str]) -> RemoteEvent:
+    """
+    Wraps an event whose body has already been fetched.
+
+    :param event: The fetched event.
+    :type event: Event
+    :param etag: The ETag of the event, if known.
+    :type etag: Optional[str]
+    :rtype: RemoteEvent
+    """
+    return RemoteEvent(str(event.url.canonical()), str(event.component.get("uid", "")), etag, event)
+
+
+def parse_uid(data: str) -> Optional[str]:
+    """
+    Finds the UID of the event in iCalendar data without parsing the rest of it.
+
+    :param data: The iCalendar data.
+    :type data: str
+    :return: The UID of the first VEVENT, or None if there is none.
+    :rtype: Optional[str]
+    """
+    in_event = False
+    for line in data.replace("\r\n", "\n").replace("\n ", "").replace("\n\t", "").split("\n"):
+        name = line.split(":", 1)[0].split(";", 1)[0].upper()
+        if line.upper() == "BEGIN:VEVENT":
+            in_event = True
+        elif in_event and name == "UID" and ":" in line:
+            return line.split(":", 1)[1]
+
+    return None
+
+
+def uid_calendar_data() -> BaseElement:
+    # Servers that don't support partial retrieval send the whole event, which is still only scanned for the UID.
+    return cdav.CalendarData() + (cdav.Comp("VCALENDAR") + (cdav.Comp("VEVENT") + CalendarDataProp("UID")))
+
+
+def build_index_query(uid_prefix: Optional[str]) -> BaseElement:
+    """
+    Builds a calendar-query REPORT for the ETag and UID of every event.
+
+    :param uid_prefix: Only ask for events whose UID contains this, or None for all events.
+    :type uid_prefix: Optional[str]
+    :rtype: BaseElement
+    """
+    event_filter = cdav.CompFilter("VEVENT")
+    if uid_prefix is not None:
+        event_filter += cdav.PropFilter("UID") + cdav.TextMatch(uid_prefix)
+
+    return cdav.CalendarQuery() + [dav.Prop() + [dav.GetEtag(), uid_calendar_data()], cdav.Filter() + (cdav.CompFilter("VCALENDAR") + event_filter)]
+
+
+def build_multiget(urls: Iterable[str], calendar_data: BaseElement) -> BaseElement:
+    return cdav.CalendarMultiGet() + (dav.Prop() + [dav.GetEtag(), calendar_data]) + [dav.Href(value=URL.objectify(x).path) for x in urls]
+
+
+def report(calendar: Calendar, root: BaseElement) -> dict[str, dict]:
+    """
+    Sends a REPORT to a calendar.
+
+    :param calendar: The calendar.
+    :type calendar: Calendar
+    :param root: The report.
+    :type root: BaseElement
+    :return: The ETag and calendar data of every object in the response, keyed by URL.
+    :rtype: dict[str, dict]
+    """
+    response = calendar.client.report(str(calendar.url), etree.tostring(root.xmlelement(), encoding="utf-8", xml_declaration=True), 1)
+    if response.status >= 400:
+        raise error.ReportError(error.errmsg(response))
+
+    results: dict[str, dict] = {}
+    for href, props in response.expand_simple_props([dav.GetEtag(), cdav.CalendarData()]).items():
+        url = calendar.url.join(URL(href) if URL(href).hostname is not None else quote(href))
+        # Some servers list the calendar itself too.
+        if url != calendar.url:
+            results[str(url.canonical())] = props
+
+    return results
+
+
+def load_event_bodies(calendar: Calendar, events: Iterable[RemoteEvent], batch_size: int = MULTIGET_BATCH_SIZE):
+    """
+    Downloads the bodies of events with calendar-multiget, a batch of them per request, rather than one request per event when their components are accessed.
+
+    :param calendar: The calendar the events are in.
+    :type calendar: Calendar
+    :param events: The events to download. Events whose bodies were already downloaded are skipped.
+    :type events: Iterable[RemoteEvent]
+    :param batch_size: The most events to download per request.
+    :type batch_size: int
+    """
+    unloaded = [x for x in events if x.event.data is None]
+    for batch in batched(unloaded, batch_size):
+        fetched = {str(x.url.canonical()): x.data for x in calendar.multiget([x.event.url for x in batch])}
+        for remote_event in batch:
+            # Events removed in the meantime are left unloaded.
+            if remote_event.href in fetched:
+                remote_event.event.data = fetched[remote_event.href]
+
+    if len(unloaded) > 0:
+        logger.info(f"Downloaded {len(unloaded)} events to compare.")
+
+
+class CalendarSnapshot:
+    """
+    Keeps an index of the TrueNAS events in a calendar between syncs and only downloads what changed since the last sync.
+    The index only holds the href, UID and ETag of every event. Event bodies are downloaded in batches when a sync needs to compare them (see load_event_bodies) and aren't kept between syncs.
+
+    Changes are found with a WebDAV sync-collection report (RFC 6578) when the server supports it, falling back to the collection ctag, and finally to downloading the whole index.
+    """
+
+    def __init__(self):
+        self.calendar_url: Optional[str] = None
+        self.sync_token: Optional[str] = None
+        self.ctag: Optional[str] = None
+        # The UID and ETag of every event keyed by URL.
+        self._index: dict[str, tuple[str, Optional[str]]] = {}
+
+    def invalidate(self):
+        """
+        Forgets the snapshot so that the next fetch downloads the whole index. Use this when the snapshot might no longer match the server, i.e. after a failed write.
+        """
+        self.calendar_url = None
+        self.sync_token = None
+        self.ctag = None
+        self._index = {}
+
+    def restore(self, calendar_url: str, sync_token: Optional[str], ctag: Optional[str], events: Iterable[tuple[str, str, Optional[str]]]):
+        """
+        Seeds the snapshot with events known from a previous run.
+
+        :param calendar_url: The URL of the calendar the events belong to.
+        :type calendar_url: str
+        :param sync_token: The sync token the events are up to date with.
+        :type sync_token: Optional[str]
+        :param ctag: The ctag the events are up to date with.
+        :type ctag: Optional[str]
+        :param events: The href, UID and ETag of every event in the calendar.
+        :type events: Iterable[tuple[str, str, Optional[str]]]
+        """
+        self.calendar_url = calendar_url
+        self.sync_token = sync_token
+        self.ctag = ctag
+        self._index = {href: (uid, etag) for href, uid, etag in events}
+
+    def fetch(self, calendar: Calendar, known_uids: Optional[dict[str, str]] = None) -> list[RemoteEvent]:
+        """
+        Brings the snapshot up to date with the calendar.
+
+        :param calendar: The calendar to fetch events from.
+        :type calendar: Calendar
+        :param known_uids: The UIDs of events this tool saved keyed by URL, so that they don't need to be looked up when they changed.
+        :type known_uids: Optional[dict[str, str]]
+        :return: Every TrueNAS event in the calendar without its body, bound to the given calendar and its client.
+        :rtype: list[RemoteEvent]
+        """
+        calendar_url = str(calendar.url.canonical())
+        if calendar_url != self.calendar_url:
+            self.invalidate()
+            self.calendar_url = calendar_url
+
+        if self.sync_token is not None:
+            try:
+                self._fetch_changes(calendar, known_uids or {})
+                return self._bind(calendar)
+            except error.DAVError as e:
+                logger.warning(f"Failed to fetch changes with sync token, falling back to a full fetch: {e}")
+        elif self.ctag is not None:
+            if self._get_ctag(calendar) == self.ctag:
+                logger.info("Calendar ctag is unchanged, reusing previously fetched events.")
+                return self._bind(calendar)
+
+        self._fetch_all(calendar)
+        return self._bind(calendar)
+
+    def _fetch_all(self, calendar: Calendar):
+        self.sync_token = None
+        self.ctag = None
+
+        # Grab the token before the events so that anything changing in between shows up in the next sync.
+        try:
+            self.sync_token = calendar.objects_by_sync_token(load_objects=False).sync_token
+        except error.DAVError as e:
+            logger.info(f"Server does not support sync tokens ({e}), falling back to the calendar ctag.")
+            self.ctag = self._get_ctag(calendar)
+
+        try:
+            results = report(calendar, build_index_query(UID_PREFIX))
+        except error.ReportError as e:
+            logger.info(f"Server does not support filtering events by UID ({e}), fetching the UIDs of all events instead.")
+            results = report(calendar, build_index_query(None))
+
+        self._index = {}
+        for url, props in results.items():
+            uid = parse_uid(props.get(cdav.CalendarData.tag) or "")
+            # The UID filter matches anywhere in the UID.
+            if uid is not None and uid.startswith(UID_PREFIX):
+                self._index[url] = (uid, props.get(dav.GetEtag.tag))
+
+        logger.info(f"Fetched the index of all {len(self._index)} events.")
+
+    def _fetch_changes(self, calendar: Calendar, known_uids: dict[str, str]):
+        updates = calendar.objects_by_sync_token(self.sync_token, load_objects=False)
+
+        changed_etags: dict[str, str] = {}
+        deleted = 0
+        for obj in updates:
+            url = str(obj.url.canonical())
+            etag = obj.props.get(dav.GetEtag.tag)
+            if etag is None:
+                # Deleted objects are reported without an ETag.
+                deleted += self._index.pop(url, None) is not None
+            else:
+                changed_etags[url] = etag
+
+        # An event keeps its UID, so only the UIDs of events that weren't seen before are downloaded.
+        uids = {url: (self._index[url][0] if url in self._index else known_uids.get(url)) for url in changed_etags}
+        unknown = [url for url, uid in uids.items() if uid is None]
+        for batch in batched(unknown, MULTIGET_BATCH_SIZE):
+            for url, props in report(calendar, build_multiget(batch, uid_calendar_data())).items():
+                uids[url] = parse_uid(props.get(cdav.CalendarData.tag) or "")
+
+        for url, etag in changed_etags.items():
+            uid = uids.get(url)
+            if uid is not None and uid.startswith(UID_PREFIX):
+                self._index[url] = (uid, etag)
+            else:
+                self._index.pop(url, None)
+
+        self.sync_token = updates.sync_token
+        logger.info(f"Found {len(changed_etags)} changed events, {len(unknown)} of them new, and dropped {deleted} deleted events since the last sync.")
+
+    def _get_ctag(self, calendar: Calendar) -> Optional[str]:
+        try:
+            return calendar.get_property(GetCTag())
+        except error.DAVError as e:
+            logger.info(f"Failed to get the calendar ctag: {e}")
+            return None
+
+    def _bind(self, calendar: Calendar) -> list[RemoteEvent]:
+        return [RemoteEvent(url, uid, etag, Event(calendar.client, url=url, parent=calendar)) for url, (uid, etag) in self._index.items()]
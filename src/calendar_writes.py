@@ -0,0 +1,244 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Callable, Optional
+from caldav.collection import Calendar
+from caldav.davclient import DAVClient
+from caldav.requests import HTTPBearerAuth
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase, HTTPBasicAuth, HTTPDigestAuth
+from urllib3.util.retry import Retry
+from calendar_snapshot import RemoteEvent
+from cron_to_ical import ICalResult
+from event_diff import SyncCounts, apply_ical_to_component, event_content_hash
+from job_runs import RunEvent, run_event_content_hash
+from metrics import write_seconds
+from state_store import StoredEvent, SyncState
+
+logger = logging.getLogger(__name__)
+
+WRITE_CREATE = "create"
+WRITE_UPDATE = "update"
+WRITE_DELETE = "delete"
+
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# PUT and DELETE are idempotent, and PROPFIND and REPORT only read.
+RETRY_METHODS = Retry.DEFAULT_ALLOWED_METHODS | {"PROPFIND", "REPORT"}
+
+
+@dataclass
+class CalendarWrite:
+    uid: str
+    action: str
+    perform: Callable[[], None]
+
+
+@dataclass
+class WriteFailure:
+    write: CalendarWrite
+    error: Exception
+
+
+def create_dav_adapter(max_concurrency: int) -> HTTPAdapter:
+    """
+    Creates a connection pool for CalDAV clients that is sized for concurrent writes and retries transient server errors with backoff.
+    Clients of calendars on the same server can share one.
+
+    :param max_concurrency: The maximum number of requests in flight at once.
+    :type max_concurrency: int
+    :rtype: HTTPAdapter
+    """
+    retry = Retry(total=RETRY_ATTEMPTS,
+                  backoff_factor=RETRY_BACKOFF_FACTOR,
+                  status_forcelist=RETRY_STATUSES,
+                  allowed_methods=RETRY_METHODS,
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+    return HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=retry)
+
+
+def create_dav_auth(auth_type: Optional[str], username: str, password: str) -> Optional[AuthBase]:
+    """
+    Creates the authentication of a CalDAV client up front. Without it, the client first sends a request without credentials to find out which authentication the server wants.
+
+    :param auth_type: basic, digest or bearer, or None to leave it to the client.
+    :type auth_type: Optional[str]
+    :param username: The username.
+    :type username: str
+    :param password: The password, or the token with bearer authentication.
+    :type password: str
+    :rtype: Optional[AuthBase]
+    """
+    if auth_type == "basic":
+        return HTTPBasicAuth(username, password)
+    if auth_type == "digest":
+        return HTTPDigestAuth(username, password)
+    if auth_type == "bearer":
+        return HTTPBearerAuth(password)
+
+    return None
+
+
+def configure_dav_session(dav_client: DAVClient, adapter: HTTPAdapter):
+    """
+    Makes the CalDAV client send its requests through a connection pool.
+
+    :param dav_client: The CalDAV client.
+    :type dav_client: DAVClient
+    :param adapter: The connection pool, see create_dav_adapter.
+    :type adapter: HTTPAdapter
+    """
+    dav_client.session.mount("http://", adapter)
+    dav_client.session.mount("https://", adapter)
+
+
+def create_event_write(calendar: Calendar, state: SyncState, uid: str, ical: ICalResult, summary: str, description: Optional[str] = None) -> CalendarWrite:
+    """
+    Plans saving a new event to the calendar.
+
+    :param calendar: The calendar to save the event to.
+    :type calendar: Calendar
+    :param state: The sync state to record the event in once it is saved.
+    :type state: SyncState
+    :param uid: The UID of the new event.
+    :type uid: str
+    :param ical: The iCal rule of the new event.
+    :type ical: ICalResult
+    :param summary: The summary of the new event.
+    :type summary: str
+    :param description: The description of the new event, if it has one.
+    :type description: Optional[str]
+    :rtype: CalendarWrite
+    """
+    def perform():
+        logger.info(f"Saving event with UID {uid} to calendar...")
+        event = calendar.save_event(
+            dtstart=ical.start,
+            dtend=ical.end,
+            rrule=ical.rrule,
+            summary=summary,
+            description=description,
+            uid=uid,
+        )
+        state.events[uid] = StoredEvent(str(event.url.canonical()), None, event_content_hash(ical, summary, description), ical.start.isoformat())
+        logger.info(f"Event with UID {uid} successfully saved to calendar.")
+
+    return CalendarWrite(uid, WRITE_CREATE, perform)
+
+
+def create_run_event_write(calendar: Calendar, state: SyncState, run_event: RunEvent) -> CalendarWrite:
+    """
+    Plans saving the event of a job run to the calendar.
+
+    :param calendar: The calendar to save the event to.
+    :type calendar: Calendar
+    :param state: The sync state to record the event in once it is saved.
+    :type state: SyncState
+    :param run_event: The event of the run.
+    :type run_event: RunEvent
+    :rtype: CalendarWrite
+    """
+    def perform():
+        logger.info(f"Saving job run event with UID {run_event.uid} to calendar...")
+        event = calendar.save_event(
+            dtstart=run_event.start,
+            dtend=run_event.end,
+            summary=run_event.summary,
+            description=run_event.description,
+            uid=run_event.uid,
+        )
+        state.events[run_event.uid] = StoredEvent(str(event.url.canonical()), None, run_event_content_hash(run_event), run_event.start.isoformat())
+
+    return CalendarWrite(run_event.uid, WRITE_CREATE, perform)
+
+
+def update_event_write(state: SyncState, remote_event: RemoteEvent, ical: ICalResult, summary: str, description: Optional[str] = None) -> CalendarWrite:
+    """
+    Plans overwriting the schedule, summary and description of an existing event.
+
+    :param state: The sync state to record the event in once it is saved.
+    :type state: SyncState
+    :param remote_event: The existing event.
+    :type remote_event: RemoteEvent
+    :param ical: The new iCal rule of the event.
+    :type ical: ICalResult
+    :param summary: The new summary of the event.
+    :type summary: str
+    :param description: The new description of the event, if it has one.
+    :type description: Optional[str]
+    :rtype: CalendarWrite
+    """
+    def perform():
+        logger.info(f"Updating previously saved event with UID {remote_event.uid}...")
+        apply_ical_to_component(remote_event.component, ical, summary, description)
+        remote_event.event.save(only_this_recurrence=False, all_recurrences=True, no_create=True)
+        # The new ETag is picked up from the server on the next sync.
+        state.events[remote_event.uid] = StoredEvent(remote_event.href, None, event_content_hash(ical, summary, description), ical.start.isoformat())
+        logger.info(f"Previously saved event with UID {remote_event.uid} successfully updated.")
+
+    return CalendarWrite(remote_event.uid, WRITE_UPDATE, perform)
+
+
+def delete_event_write(state: SyncState, remote_event: RemoteEvent) -> CalendarWrite:
+    """
+    Plans removing an event from the calendar. This only needs the href of the event, so its body is never downloaded.
+
+    :param state: The sync state to forget the event in once it is removed.
+    :type state: SyncState
+    :param remote_event: The event to remove.
+    :type remote_event: RemoteEvent
+    :rtype: CalendarWrite
+    """
+    def perform():
+        logger.info(f"Removing stale event with UID {remote_event.uid}.")
+        remote_event.event.delete()
+        state.events.pop(remote_event.uid, None)
+
+    return CalendarWrite(remote_event.uid, WRITE_DELETE, perform)
+
+
+async def run_writes(writes: list[CalendarWrite], max_concurrency: int) -> list[WriteFailure]:
+    """
+    Performs calendar writes as concurrent tasks with at most max_concurrency of them in flight at once. A failed write doesn't stop the others.
+    The CalDAV client is blocking, so each write runs in a worker thread. Cancelling this stops queued writes from starting, but writes already in flight run to completion.
+
+    :param writes: The writes to perform.
+    :type writes: list[CalendarWrite]
+    :param max_concurrency: The maximum number of writes in flight at once.
+    :type max_concurrency: int
+    :return: The writes that failed.
+    :rtype: list[WriteFailure]
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def perform(write: CalendarWrite):
+        async with semaphore:
+            with write_seconds.time(action=write.action):
+                await asyncio.to_thread(write.perform)
+
+    results = await asyncio.gather(*(perform(x) for x in writes), return_exceptions=True)
+    failures: list[WriteFailure] = []
+    for write, result in zip(writes, results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+
+            failures.append(WriteFailure(write, result))
+
+    return failures
+
+
+def count_writes(writes: list[CalendarWrite], failures: list[WriteFailure], counts: SyncCounts):
+    """
+    Adds the successful writes to the sync tally.
+    """
+    failed = {id(x.write) for x in failures}
+    for write in (x for x in writes if id(x) not in failed):
+        if write.action == WRITE_CREATE:
+            counts.created += 1
+        elif write.action == WRITE_UPDATE:
+            counts.updated += 1
+        elif write.action == WRITE_DELETE:
+            counts.deleted += 1
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeCollector:
+    """
+    Collects TrueNAS change events for query collections (i.e. pool.snapshottask.query) and debounces bursts of them.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        """
+        :param loop: The event loop that waits for the changes. The callbacks are called on the TrueNAS client's threads.
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._changed = asyncio.Event()
+        self._changes: dict[str, set[int]] = {}
+        self._needs_full_sync = False
+        self._last_change = 0.0
+
+    def callback_for(self, query: str) -> Callable[..., None]:
+        """
+        Creates a subscription callback that records changes to the items of a query.
+
+        :param query: The query collection the callback is subscribed to.
+        :type query: str
+        :rtype: Callable[..., None]
+        """
+        def callback(message_type: str, *args: Any, **kwargs: Any):
+            message = kwargs if len(kwargs) > 0 else (args[0] if len(args) > 0 and isinstance(args[0], dict) else {})
+            item_id = message.get("id")
+            logger.info(f"Received {message_type} event for item {item_id} of {query}.")
+            self.add(query, item_id)
+
+        return callback
+
+    def add(self, query: str, item_id: Optional[int]):
+        """
+        Records a change to an item.
+
+        :param query: The query collection of the item.
+        :type query: str
+        :param item_id: The ID of the item, or None if unknown, which asks for a full sync.
+        :type item_id: Optional[int]
+        """
+        with self._lock:
+            if item_id is None:
+                self._needs_full_sync = True
+            else:
+                self._changes.setdefault(query, set()).add(item_id)
+
+            self._last_change = time.monotonic()
+
+        try:
+            self._loop.call_soon_threadsafe(self._changed.set)
+        except RuntimeError:
+            # The loop is already closed, so nobody is waiting anymore.
+            pass
+
+    async def wait(self, timeout: float, debounce: float) -> Optional[tuple[bool, dict[str, set[int]]]]:
+        """
+        Waits for changes, then keeps waiting until none arrived for the debounce time so that a burst of changes is handled at once.
+
+        :param timeout: How long to wait for the first change, in seconds.
+        :type timeout: float
+        :param debounce: How long no changes have to arrive for the burst to be considered over, in seconds.
+        :type debounce: float
+        :return: None if nothing changed before the timeout. Otherwise, whether a full sync is needed and the IDs of the changed items keyed by query.
+        :rtype: Optional[tuple[bool, dict[str, set[int]]]]
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                async with asyncio.timeout(max(deadline - time.monotonic(), 0)):
+                    await self._changed.wait()
+            except TimeoutError:
+                return None
+
+            while True:
+                with self._lock:
+                    quiet_time = time.monotonic() - self._last_change
+
+                if quiet_time >= debounce:
+                    break
+
+                await asyncio.sleep(debounce - quiet_time)
+
+            with self._lock:
+                result = (self._needs_full_sync, self._changes)
+                self._changes = {}
+                self._needs_full_sync = False
+                self._changed.clear()
+
+            # The event can be set again by a change that was already part of the previous burst.
+            if result[0] or len(result[1]) > 0:
+                return result
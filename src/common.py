@@ -1,11 +1,34 @@
+import hashlib
+from contextvars import ContextVar
+from typing import Optional
+
 # https://www.truenas.com/docs/api/scale_websocket_api.html#cronjob
 # https://caldav.readthedocs.io/stable/tutorial.html
 # https://radicale.org/v3.html
 
+CALENDAR_NAME = "TrueNAS Jobs"
+
+# Every event this tool saves has a UID starting with this, and it leaves any other event alone.
+UID_PREFIX = "truenas-"
+
 ITEM_TYPE_SCRUB = "Scrub"
 ITEM_TYPE_SNAPSHOT = "Snapshot"
 ITEM_TYPE_CLOUDSYNC = "CloudSync"
 ITEM_TYPE_CRONJOB = "CronJob"
+ITEM_TYPE_REPLICATION = "Replication"
+ITEM_TYPE_RSYNC = "Rsync"
+ITEM_TYPE_SMART = "SMART"
+
+QUERY_SCRUB = "pool.scrub.query"
+QUERY_SNAPSHOT = "pool.snapshottask.query"
+QUERY_CLOUDSYNC = "cloudsync.query"
+QUERY_CRONJOB = "cronjob.query"
+QUERY_REPLICATION = "replication.query"
+QUERY_RSYNC = "rsynctask.query"
+QUERY_SMART = "smart.test.query"
+
+# The name of the target whose sync is running, for log lines and metrics. Unset with a single target.
+current_target: ContextVar[Optional[str]] = ContextVar("current_target", default=None)
 
 def schedule_to_cron_string(schedule: dict[str, str]) -> str:
     """
@@ -19,7 +42,20 @@ def schedule_to_cron_string(schedule: dict[str, str]) -> str:
     return f"{schedule.get("minute", "0")} {schedule["hour"]} {schedule["dom"]} {schedule["month"]} {schedule["dow"]}"
 
 def create_item_uid(prefix: str, item_id: int) -> str:
-    return f"truenas-{prefix.lower()}-{item_id}"
+    return f"{UID_PREFIX}{prefix.lower()}-{item_id}"
+
+def create_group_uid(prefix: str, cron: str) -> str:
+    """
+    Creates the UID of the event for all items of a type that share a schedule. The same schedule always gets the same UID.
+
+    :param prefix: The type of the items.
+    :type prefix: str
+    :param cron: The normalized CRON string of the schedule.
+    :type cron: str
+    :return: The UID of the group event.
+    :rtype: str
+    """
+    return f"{UID_PREFIX}{prefix.lower()}-group-{hashlib.sha256(cron.encode()).hexdigest()[:16]}"
 
 def parse_item_type_from_uid(uid: str) -> str | None:
     parts = uid.split("-")
@@ -0,0 +1,120 @@
+import logging
+from typing import TYPE_CHECKING, Optional
+from truenas_api_client import Client, JSONRPCClient, LegacyClient
+from metrics import phase_seconds
+from options import Options
+
+if TYPE_CHECKING:
+    from caldav.davclient import DAVClient
+    from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionManager:
+    """
+    Keeps the CalDAV and TrueNAS clients open across syncs, pinging them before each use and only reconnecting (and logging in again) when a connection turns out to be dead.
+    """
+
+    def __init__(self, options: Options, dav_adapter: Optional["HTTPAdapter"]):
+        """
+        :param options: The parsed options of the target to connect for.
+        :type options: Options
+        :param dav_adapter: The connection pool for the CalDAV server, which may be shared with other targets on the same server. None if the target doesn't use CalDAV.
+        :type dav_adapter: Optional[HTTPAdapter]
+        """
+        self._options = options
+        self._dav_adapter = dav_adapter
+        self._dav_client: Optional["DAVClient"] = None
+        self._truenas_client: Optional[JSONRPCClient | LegacyClient] = None
+
+    def dav_client(self) -> "DAVClient":
+        """
+        Gets a working CalDAV client, connecting if there is none or the current one doesn't respond.
+
+        :rtype: DAVClient
+        """
+        if self._dav_client is not None:
+            try:
+                response = self._dav_client.options(str(self._dav_client.url))
+                if response.status < 400:
+                    return self._dav_client
+
+                logger.warning(f"CalDAV server responded to ping with status {response.status}. Reconnecting.")
+            except Exception as e:
+                logger.warning(f"CalDAV server did not respond to ping: {e}. Reconnecting.")
+
+            self._close_dav_client()
+
+        if self._dav_adapter is None:
+            raise Exception("This target does not use a CalDAV server.")
+
+        # Only imported when connecting, so that targets without a CalDAV server don't pay for importing it.
+        from caldav.davclient import get_davclient
+        from calendar_writes import configure_dav_session, create_dav_auth
+
+        auth = create_dav_auth(self._options.caldav_auth_type, self._options.caldav_username, self._options.caldav_password)
+        client = get_davclient(url=f"http://{self._options.caldav_host}", username=self._options.caldav_username, password=self._options.caldav_password, auth=auth)
+        configure_dav_session(client, self._dav_adapter)
+        self._dav_client = client
+        logger.info("Successfully connected to caldav server.")
+        return client
+
+    def truenas_client(self) -> JSONRPCClient | LegacyClient:
+        """
+        Gets a working, logged in TrueNAS client, connecting and logging in if there is none or the current one doesn't respond.
+
+        :rtype: JSONRPCClient | LegacyClient
+        """
+        if self._truenas_client is not None:
+            try:
+                self._truenas_client.call("core.ping")
+                return self._truenas_client
+            except Exception as e:
+                logger.warning(f"TrueNAS did not respond to ping: {e}. Reconnecting.")
+                self._close_truenas_client()
+
+        with phase_seconds.time(phase="truenas_login"):
+            client = Client(uri=f"wss://{self._options.truenas_host}/api/current", verify_ssl=self._options.truenas_host_verify_ssl)
+            try:
+                if not client.call("auth.login_with_api_key", self._options.truenas_api_key):
+                    raise Exception("Failed to authenticate with TrueNAS.")
+            except BaseException:
+                client.close()
+                raise
+
+        self._truenas_client = client
+        logger.info("Successfully logged into TrueNAS.")
+        return client
+
+    def reset(self):
+        """
+        Closes both clients so that the next use reconnects, i.e. after a sync failed in a way that a ping might not notice (such as an expired session).
+        """
+        self._close_dav_client()
+        self._close_truenas_client()
+
+    def _close_dav_client(self):
+        if self._dav_client is None:
+            return
+
+        try:
+            # Don't close the connection pool along with the session, since other targets may be using it.
+            self._dav_client.session.adapters.clear()
+            self._dav_client.close()
+        except Exception as e:
+            logger.debug(f"Failed to close CalDAV client: {e}")
+
+        self._dav_client = None
+
+    def _close_truenas_client(self):
+        if self._truenas_client is None:
+            return
+
+        try:
+            self._truenas_client.close()
+        except Exception as e:
+            logger.debug(f"Failed to close TrueNAS client: {e}")
+
+        self._truenas_client = None
+
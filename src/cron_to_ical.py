@@ -1,11 +1,9 @@
 import logging
-import time
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Sequence, Union
+from typing import Optional, Sequence, Union
 from cron_converter import Cron
-from zoneinfo import ZoneInfo, available_timezones
-from dateutil import tz
+from local_timezone import local_now, resolve_local_timezone
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +14,16 @@ FREQ_DAILY = "DAILY"
 FREQ_HOURLY = "HOURLY"
 FREQ_MINUTELY = "MINUTELY"
 
+# From the finest to the coarsest. Calendars support the finer FREQs less well, and expanding them costs more.
+FREQ_ORDER = [FREQ_MINUTELY, FREQ_HOURLY, FREQ_DAILY, FREQ_WEEKLY, FREQ_MONTHLY, FREQ_YEARLY]
+
+# Shorter progressions (i.e. "0,30") are just as compact as a BY* list, which every calendar understands.
+MIN_PROGRESSION_LENGTH = 3
+
+MINUTES_PER_HOUR = 60
+HOURS_PER_DAY = 24
+MONTHS_PER_YEAR = 12
+
 
 def dow_to_str(dow: int):
     """
@@ -24,19 +32,51 @@ def dow_to_str(dow: int):
     return {0: "SU", 1: "MO", 2: "TU", 3: "WE", 4: "TH", 5: "FR", 6: "SA"}[dow]
 
 
+def progression_step(values: list[int], range_size: int) -> Optional[int]:
+    """
+    Finds the step of a CRON field whose values are every nth value of its whole range (i.e. "*/10" or "5-59/10" for minutes).
+    Only then does the progression carry on seamlessly into the next hour, day or year, which is what an INTERVAL does.
+
+    :param values: The sorted values of the field.
+    :type values: list[int]
+    :param range_size: The number of values the field can take (i.e. 60 for minutes).
+    :type range_size: int
+    :return: The step, or None if the values aren't such a progression.
+    :rtype: Optional[int]
+    """
+    if len(values) < MIN_PROGRESSION_LENGTH:
+        return None
+
+    step = values[1] - values[0]
+    if range_size % step != 0 or len(values) != range_size // step:
+        return None
+
+    if any(b - a != step for a, b in zip(values, values[1:])):
+        return None
+
+    return step
+
+
+def rrule_size(rrule: dict[str, Union[str, int, Sequence[Union[int, str]]]]) -> int:
+    """
+    Counts the values of an RRULE besides its FREQ, as a measure of how expensive it is for calendars to expand.
+    """
+    return sum(len(value) if isinstance(value, (list, tuple)) else 1 for key, value in rrule.items() if key != "FREQ")
+
+
 @dataclass
 class ICalResult:
     start: datetime
     end: datetime
-    rrule: dict[str, Union[str, Sequence[Union[int, str]]]]
+    rrule: dict[str, Union[str, int, Sequence[Union[int, str]]]]
 
 
 def cron_to_ical(cron: str) -> ICalResult:
     """
     Generates an abstract iCal thing according to a CRON expression.
 
-    Currently, this handles all intervals literally (using a larger FREQ with evenly spaced BY* filters). This works fine because the cron_converter package provides the next start datetime for a CRON, aligning everything properly.
-    TODO: Change this to properly handle CRON intervals.
+    The literal form uses a larger FREQ with the values of every restricted field as BY* filters. Stepped fields that an INTERVAL can express instead (minutes and hours of a day, months of a year) also get a candidate rule with that INTERVAL, as long as its FREQ is no finer than the literal one. The rule with the fewest values wins, with ties going to the literal form.
+    INTERVALs count from DTSTART, so this relies on the cron_converter package providing an actual occurrence of the CRON as the start datetime.
     """
     c = Cron(cron)
     (minute, hour, dom, month, dow) = c.parts
@@ -68,7 +108,7 @@ def cron_to_ical(cron: str) -> ICalResult:
     else:
         frequency = FREQ_YEARLY
 
-    options: dict[str, Union[str, Sequence[Union[int, str]]]] = {
+    options: dict[str, Union[str, int, Sequence[Union[int, str]]]] = {
         'FREQ': frequency,
     }
 
@@ -83,28 +123,57 @@ def cron_to_ical(cron: str) -> ICalResult:
     if not month.is_full():
         options['BYMONTH'] = month.to_list()
 
+    # A finer field than the FREQ has to be listed in full to expand each period, while coarser fields only need listing if they limit it.
+    days: dict[str, Sequence[Union[int, str]]] = {}
+    if not dow.is_full():
+        days['BYDAY'] = list(map(dow_to_str, dow.to_list()))
+    if not dom.is_full():
+        days['BYMONTHDAY'] = dom.to_list()
+
+    candidates = [options]
+
+    minute_step = progression_step(minute.to_list(), MINUTES_PER_HOUR)
+    if minute_step is not None:
+        candidates.append({
+            'FREQ': FREQ_MINUTELY,
+            'INTERVAL': minute_step,
+            **({} if hour.is_full() else {'BYHOUR': hour.to_list()}),
+            **days,
+            **({} if month.is_full() else {'BYMONTH': month.to_list()}),
+        })
+
+    hour_step = progression_step(hour.to_list(), HOURS_PER_DAY)
+    if hour_step is not None:
+        candidates.append({
+            'FREQ': FREQ_HOURLY,
+            'INTERVAL': hour_step,
+            'BYMINUTE': minute.to_list(),
+            **days,
+            **({} if month.is_full() else {'BYMONTH': month.to_list()}),
+        })
+
+    month_step = progression_step(month.to_list(), MONTHS_PER_YEAR)
+    # Without restricted days, a monthly rule would only produce the day of DTSTART.
+    if month_step is not None and len(days) > 0:
+        candidates.append({
+            'FREQ': FREQ_MONTHLY,
+            'INTERVAL': month_step,
+            'BYMINUTE': minute.to_list(),
+            'BYHOUR': hour.to_list(),
+            **days,
+        })
+
+    options = min([x for x in candidates if FREQ_ORDER.index(str(x['FREQ'])) >= FREQ_ORDER.index(frequency)], key=rrule_size)
+
     # Use the local timezone here for the cron schedule to grab the next start datetime.
-    now = datetime.now(tz.gettz(time.tzname[time.daylight]))
+    now = local_now()
     schedule = c.schedule(start_date=now)
     next_start = schedule.prev()
 
     # Now we need to convert the timezone info from whatever it is to an IANA timezone.
-    # Go grab the first matching timezone with the same offset and dst rules.
-    zone_list = sorted(available_timezones())
-    candidates: list[str] = []
-    for candidate_zone_str in zone_list:
-        candidate_zone = ZoneInfo(candidate_zone_str)
-        local_tz_offset = now.utcoffset()
-        local_tz_dst = now.dst()
-
-        # Compare offsets, being careful about None results
-        if local_tz_offset == candidate_zone.utcoffset(datetime.now()) and local_tz_dst == candidate_zone.dst(datetime.now()):
-            candidates.append(candidate_zone_str)
-
-    if len(candidates) > 0:
-        # If we found candidates, just use the first one.
-        iana_tz = sorted(candidates)[0]
-        next_start = next_start.replace(tzinfo=ZoneInfo(iana_tz))
+    iana_tz = resolve_local_timezone(now)
+    if iana_tz is not None:
+        next_start = next_start.replace(tzinfo=iana_tz)
     else:
         logger.warning(f"Could not find IANA timezone for offset {now.utcoffset()} and dst {now.dst()} - using original timezone info. Your calendar may be incorrect!")
 
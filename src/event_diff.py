@@ -0,0 +1,215 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime, tzinfo
+from typing import Any, Mapping, Optional
+from dateutil.rrule import rrulestr
+from icalendar import Component, vRecur
+from cron_to_ical import FREQ_HOURLY, FREQ_MINUTELY, FREQ_MONTHLY, ICalResult
+from state_store import StoredEvent
+
+# DTSTARTs in any of these are written as UTC ("Z") times, so they come back from the server as plain UTC.
+UTC_TIMEZONE_KEYS = {"UTC", "Etc/UTC", "Etc/UCT", "UCT", "Etc/Universal", "Universal", "Etc/Zulu", "Zulu"}
+
+
+@dataclass
+class SyncCounts:
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    deleted: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.created} created, {self.updated} updated, {self.unchanged} unchanged, {self.deleted} deleted"
+
+
+def normalize_rrule(rrule: Mapping[str, Any]) -> dict[str, list[str]]:
+    """
+    Normalizes an RRULE so that a rule built by cron_to_ical and one parsed back from the server compare equal.
+
+    :param rrule: The RRULE as a dict or a parsed vRecur.
+    :type rrule: Mapping[str, Any]
+    :return: The RRULE with upper case keys and every value as a list of upper case strings.
+    :rtype: dict[str, list[str]]
+    """
+    normalized: dict[str, list[str]] = {}
+    for key, value in rrule.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        normalized[str(key).upper()] = [str(x).upper() for x in values]
+
+    return normalized
+
+
+def timezone_key(tz: Optional[tzinfo]) -> Optional[str]:
+    """
+    Gets a comparable name for a timezone, preferring the IANA key.
+    """
+    if tz is None:
+        return None
+
+    key = getattr(tz, "key", None) or str(tz)
+    return "UTC" if key in UTC_TIMEZONE_KEYS else key
+
+
+def interval_phase(rrule: Mapping[str, Any], start: datetime) -> Optional[int]:
+    """
+    Gets where in its INTERVAL a rule starting at the given datetime falls, i.e. 1 for every other hour starting at an odd hour.
+    Which occurrences a rule with an INTERVAL has depends on its DTSTART like this, on top of its BY* values.
+
+    The INTERVALs that cron_to_ical uses evenly divide the next larger unit (an hour, a day or a year), so every occurrence of a rule has the same phase.
+
+    :param rrule: The RRULE as a dict or a parsed vRecur.
+    :type rrule: Mapping[str, Any]
+    :param start: The DTSTART, or any other occurrence of the rule.
+    :type start: datetime
+    :return: The phase, or None if the rule has no INTERVAL.
+    :rtype: Optional[int]
+    """
+    normalized = normalize_rrule(rrule)
+    if "INTERVAL" not in normalized:
+        return None
+
+    interval = int(normalized["INTERVAL"][0])
+    frequency = normalized["FREQ"][0]
+    if frequency == FREQ_MINUTELY:
+        return start.minute % interval
+    if frequency == FREQ_HOURLY:
+        return start.hour % interval
+    if frequency == FREQ_MONTHLY:
+        return (start.month - 1) % interval
+
+    raise Exception(f"Unsupported INTERVAL with FREQ {frequency}.")
+
+
+def is_occurrence(ical: ICalResult, start: datetime) -> bool:
+    """
+    Checks if a datetime is an occurrence of an iCal rule, i.e. if a series starting there would produce the same occurrences.
+
+    :param ical: The iCal rule.
+    :type ical: ICalResult
+    :param start: The datetime to check.
+    :type start: datetime
+    :rtype: bool
+    """
+    rule = rrulestr(vRecur(ical.rrule).to_ical().decode(), dtstart=start)
+    return rule.after(start, inc=True) == start
+
+
+def is_event_up_to_date(component: Component, ical: ICalResult, summary: str, description: Optional[str] = None) -> bool:
+    """
+    Checks if an existing VEVENT already describes the given iCal rule, summary and description, in which case it doesn't need to be saved again.
+
+    The DTSTART is allowed to be older than the newly computed one as long as it is an occurrence of the same rule in the same timezone, and in the same phase of an INTERVAL, since the event then has the exact same upcoming occurrences.
+
+    :param component: The existing VEVENT.
+    :type component: Component
+    :param ical: The newly computed iCal rule.
+    :type ical: ICalResult
+    :param summary: The newly computed summary.
+    :type summary: str
+    :param description: The newly computed description, or None to not check it.
+    :type description: Optional[str]
+    :rtype: bool
+    """
+    if str(component.get("summary", "")) != summary:
+        return False
+
+    if description is not None and str(component.get("description", "")) != description:
+        return False
+
+    existing_rrule = component.get("rrule")
+    if existing_rrule is None or normalize_rrule(existing_rrule) != normalize_rrule(ical.rrule):
+        return False
+
+    existing_start = component.get("dtstart")
+    existing_end = component.get("dtend")
+    if existing_start is None or existing_end is None:
+        return False
+
+    existing_start = existing_start.dt
+    existing_end = existing_end.dt
+    if not isinstance(existing_start, datetime) or not isinstance(existing_end, datetime):
+        return False
+
+    if timezone_key(existing_start.tzinfo) != timezone_key(ical.start.tzinfo):
+        return False
+
+    if existing_start > ical.start or existing_end - existing_start != ical.end - ical.start:
+        return False
+
+    if interval_phase(ical.rrule, existing_start) != interval_phase(ical.rrule, ical.start):
+        return False
+
+    return is_occurrence(ical, existing_start)
+
+
+def event_content_hash(ical: ICalResult, summary: str, description: Optional[str] = None) -> str:
+    """
+    Hashes everything about an event that this tool controls, except for the DTSTART which moves along with the schedule. Only its phase is hashed for rules with an INTERVAL, see interval_phase.
+
+    :param ical: The iCal rule.
+    :type ical: ICalResult
+    :param summary: The summary.
+    :type summary: str
+    :param description: The description, if the event has one.
+    :type description: Optional[str]
+    :rtype: str
+    """
+    content: dict[str, Any] = {
+        "summary": summary,
+        "rrule": normalize_rrule(ical.rrule),
+        "timezone": timezone_key(ical.start.tzinfo),
+        "duration": (ical.end - ical.start).total_seconds(),
+    }
+    # Only hashed when present so that the hashes of events without one stay the same.
+    if description is not None:
+        content["description"] = description
+    phase = interval_phase(ical.rrule, ical.start)
+    if phase is not None:
+        content["phase"] = phase
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def is_stored_event_up_to_date(stored: StoredEvent, etag: Optional[str], ical: ICalResult, summary: str, description: Optional[str] = None) -> bool:
+    """
+    Checks if the event last pushed by this tool already describes the given iCal rule, summary and description, without looking at the event on the server.
+
+    :param stored: The event as last pushed by this tool.
+    :type stored: StoredEvent
+    :param etag: The current ETag of the event on the server. The stored event is only trusted if this matches.
+    :type etag: Optional[str]
+    :param ical: The newly computed iCal rule.
+    :type ical: ICalResult
+    :param summary: The newly computed summary.
+    :type summary: str
+    :param description: The newly computed description, if the event has one.
+    :type description: Optional[str]
+    :rtype: bool
+    """
+    if stored.etag is None or stored.etag != etag:
+        return False
+
+    if stored.content_hash != event_content_hash(ical, summary, description):
+        return False
+
+    stored_start = datetime.fromisoformat(stored.dtstart).astimezone(ical.start.tzinfo)
+    return stored_start <= ical.start and is_occurrence(ical, stored_start)
+
+
+def apply_ical_to_component(component: Component, ical: ICalResult, summary: str, description: Optional[str] = None):
+    """
+    Overwrites the schedule, summary and description of an existing VEVENT.
+
+    :param component: The existing VEVENT.
+    :type component: Component
+    :param ical: The newly computed iCal rule.
+    :type ical: ICalResult
+    :param summary: The newly computed summary.
+    :type summary: str
+    :param description: The newly computed description, or None for no description.
+    :type description: Optional[str]
+    """
+    for name, value in (("dtstart", ical.start), ("dtend", ical.end), ("rrule", ical.rrule), ("summary", summary), ("description", description)):
+        component.pop(name, None)
+        if value is not None:
+            component.add(name, value)
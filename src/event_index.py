@@ -0,0 +1,42 @@
+import logging
+from typing import Iterable, Iterator, Optional
+from calendar_snapshot import RemoteEvent
+from common import parse_item_type_from_uid
+
+logger = logging.getLogger(__name__)
+
+
+class EventIndex:
+    """
+    Indexes calendar events by item type and UID.
+    """
+
+    def __init__(self, events: Iterable[RemoteEvent]):
+        self._by_type: dict[Optional[str], dict[str, RemoteEvent]] = {}
+
+        for event in events:
+            events_of_type = self._by_type.setdefault(parse_item_type_from_uid(event.uid), {})
+
+            if event.uid in events_of_type:
+                logger.warning(f"Found more than one event with UID {event.uid}. Only the first one will be synced.")
+                continue
+
+            events_of_type[event.uid] = event
+
+    def __iter__(self) -> Iterator[RemoteEvent]:
+        for events_of_type in self._by_type.values():
+            yield from events_of_type.values()
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self._by_type.values())
+
+    def for_type(self, item_type: str) -> dict[str, RemoteEvent]:
+        """
+        Gets the events of a given item type.
+
+        :param item_type: The type of the item (i.e. ITEM_TYPE_SNAPSHOT).
+        :type item_type: str
+        :return: The events of that type keyed by UID.
+        :rtype: dict[str, RemoteEvent]
+        """
+        return self._by_type.get(item_type.lower(), {})
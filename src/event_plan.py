@@ -0,0 +1,93 @@
+import logging
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional
+from common import create_group_uid, create_item_uid, schedule_to_cron_string
+from ical_cache import normalize_cron
+from item_types import ItemType
+from metrics import items_total
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PlannedEvent:
+    """
+    An event to publish, before its schedule is converted to an iCal rule.
+    """
+    uid: str
+    cron: str
+    summary: str
+    description: Optional[str]
+
+
+def plan_events(
+    items: list[Dict],
+    item_type: ItemType,
+    items_filter: Optional[re.Pattern],
+    group_by_schedule: bool = False
+) -> list[PlannedEvent]:
+    """
+    Works out the events for TrueNAS items of a given type.
+    Either every item gets its own event, or every schedule gets one event listing the items that share it.
+
+    :param items: The items fetched from the TrueNAS API.
+    :type items: list[Dict]
+    :param item_type: The type of the items.
+    :type item_type: ItemType
+    :param items_filter: A regular expression pattern to filter items.
+    :type items_filter: Optional[re.Pattern]
+    :param group_by_schedule: Whether to create one event per schedule rather than per item.
+    :type group_by_schedule: bool
+    :return: The events for the items.
+    :rtype: list[PlannedEvent]
+    """
+    logger.info(f"Found {len(items)} items.")
+
+    if items_filter is not None:
+        logger.info(f"Filtering items with pattern \"{items_filter.pattern}\".")
+        filtered_items = [x for x in items if items_filter.search(x[item_type.description_key]) is not None]
+        logger.info(f"{len(filtered_items)} items remain after filtering.")
+        items_total.inc(len(items) - len(filtered_items), type=item_type.name, outcome="filtered")
+    else:
+        filtered_items = items
+
+    planned: list[PlannedEvent] = []
+
+    # The descriptions of the items sharing each schedule, keyed by normalized CRON string.
+    groups: dict[str, list[str]] = {}
+
+    for item in filtered_items:
+        # Not every item type requires a description, i.e. SMART tests.
+        description = str(item[item_type.description_key]) or f"#{item['id']}"
+        item_summary = f"{item_type.name}: {description}"
+        logger.info(f"Found item: \"{item_summary}\".")
+
+        if item_type.enabled_key is not None and not item[item_type.enabled_key]:
+            logger.info(f"Skipping item \"{item_summary}\" because it is disabled.")
+            items_total.inc(type=item_type.name, outcome="disabled")
+            continue
+
+        schedule = item_type.get_schedule(item)
+        if schedule is None:
+            logger.info(f"Skipping item \"{item_summary}\" because it doesn't run on a schedule of its own.")
+            items_total.inc(type=item_type.name, outcome="unscheduled")
+            continue
+
+        items_total.inc(type=item_type.name, outcome="synced")
+
+        cron_str = schedule_to_cron_string(schedule)
+        logger.info(f"Found CRON expression {cron_str}.")
+
+        if group_by_schedule:
+            groups.setdefault(normalize_cron(cron_str), []).append(description)
+        else:
+            planned.append(PlannedEvent(create_item_uid(item_type.name, item['id']), cron_str, item_summary, None))
+
+    for cron_str, members in groups.items():
+        members.sort()
+        logger.info(f"Found {len(members)} items with CRON expression {cron_str}.")
+        group_summary = f"{item_type.name}: {members[0]}" if len(members) == 1 else f"{item_type.name}: {members[0]} and {len(members) - 1} more"
+        planned.append(PlannedEvent(create_group_uid(item_type.name, cron_str), cron_str, group_summary, "\n".join(members)))
+
+    return planned
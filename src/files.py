@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+
+# Only the user running this can read files by default, since the state file is nobody else's business.
+PRIVATE_FILE_MODE = 0o600
+# For files other processes serve, i.e. a web server sharing the volume of the ICS feed.
+PUBLIC_FILE_MODE = 0o644
+
+
+def write_file_atomically(path: str, data: bytes, mode: int = PRIVATE_FILE_MODE):
+    """
+    Writes a file by writing a temporary file next to it and moving that into place, so that a crash never leaves a half written file behind and readers never see one.
+
+    :param path: The path of the file.
+    :type path: str
+    :param data: The new contents of the file.
+    :type data: bytes
+    :param mode: The permissions of the file.
+    :type mode: int
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # The temporary file is created readable by its owner only, and keeps that when it is moved into place.
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,102 @@
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo
+from cron_converter import Cron
+from cron_to_ical import ICalResult, cron_to_ical
+from local_timezone import local_now, resolve_local_timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ICAL_CACHE_SIZE = 256
+
+
+def normalize_cron(cron: str) -> str:
+    """
+    Normalizes a CRON string so that equivalent schedules share a cache key (i.e. "0 0 * * sun" and "0 0 * * 0").
+
+    :param cron: The CRON string.
+    :type cron: str
+    :return: The normalized CRON string.
+    :rtype: str
+    """
+    return Cron(cron).to_string()
+
+
+def next_occurrence(cron: str, start: datetime) -> datetime:
+    """
+    Finds the first occurrence of a CRON schedule strictly after the given start.
+
+    :param cron: The CRON string.
+    :type cron: str
+    :param start: An occurrence of the schedule.
+    :type start: datetime
+    :return: The following occurrence.
+    :rtype: datetime
+    """
+    return Cron(cron).schedule(start_date=start + timedelta(minutes=1)).next()
+
+
+@dataclass
+class ICalCacheEntry:
+    result: ICalResult
+    expires: datetime
+    # The local timezone the result was converted in.
+    zone: Optional[ZoneInfo]
+
+
+class ICalCache:
+    """
+    A bounded LRU cache of cron_to_ical results keyed by the normalized CRON string.
+
+    An entry expires once its DTSTART is older than one period of the schedule, i.e. when the schedule fires again and cron_to_ical would pick a newer start.
+    It also expires when the local timezone resolves differently, i.e. when a timezone guessed from the UTC offset changes on a DST transition.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_ICAL_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, ICalCacheEntry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, cron: str) -> ICalResult:
+        """
+        Gets the iCal conversion of a CRON string, converting it only if there is no fresh cached result.
+
+        :param cron: The CRON string.
+        :type cron: str
+        :return: The iCal conversion. This is shared between callers, so don't modify it.
+        :rtype: ICalResult
+        """
+        key = normalize_cron(cron)
+        entry = self._entries.get(key)
+        zone = resolve_local_timezone(local_now())
+
+        if entry is not None and entry.zone == zone and datetime.now(entry.expires.tzinfo) < entry.expires:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.result
+
+        self.misses += 1
+        result = cron_to_ical(key)
+        self._entries[key] = ICalCacheEntry(result, next_occurrence(key, result.start), zone)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        return result
+
+    def clear(self):
+        """
+        Drops every cached conversion, i.e. after the local timezone changes.
+        """
+        self._entries.clear()
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {len(self._entries)}/{self.max_size} entries"
@@ -0,0 +1,182 @@
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from icalendar import Calendar, Event
+from common import CALENDAR_NAME
+from cron_to_ical import ICalResult
+from event_diff import apply_ical_to_component, event_content_hash
+from event_plan import PlannedEvent
+
+logger = logging.getLogger(__name__)
+
+ICS_CONTENT_TYPE = "text/calendar; charset=utf-8"
+ICS_PRODID = "-//ChapterSevenSeeds//truenas-jobs-caldav//EN"
+
+
+def feed_etag(events: list[tuple[PlannedEvent, ICalResult]]) -> str:
+    """
+    Computes the ETag of a feed from the content hashes of its events. Like the content hashes, this leaves out the DTSTARTs, which move along with the schedules without changing any occurrences.
+
+    :param events: The events of the feed and their iCal rules.
+    :type events: list[tuple[PlannedEvent, ICalResult]]
+    :return: A quoted strong ETag.
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for planned, ical in sorted(events, key=lambda x: x[0].uid):
+        digest.update(planned.uid.encode())
+        digest.update(event_content_hash(ical, planned.summary, planned.description).encode())
+
+    return f"\"{digest.hexdigest()[:32]}\""
+
+
+def render_calendar(events: list[tuple[PlannedEvent, ICalResult]], stamp: datetime) -> bytes:
+    """
+    Renders events into a single VCALENDAR, with the same properties the CalDAV mode saves.
+
+    :param events: The events and their iCal rules.
+    :type events: list[tuple[PlannedEvent, ICalResult]]
+    :param stamp: The DTSTAMP of the events.
+    :type stamp: datetime
+    :rtype: bytes
+    """
+    calendar = Calendar()
+    calendar.add("prodid", ICS_PRODID)
+    calendar.add("version", "2.0")
+    calendar.add("x-wr-calname", CALENDAR_NAME)
+
+    for planned, ical in sorted(events, key=lambda x: x[0].uid):
+        event = Event()
+        event.add("uid", planned.uid)
+        event.add("dtstamp", stamp)
+        apply_ical_to_component(event, ical, planned.summary, planned.description)
+        calendar.add_component(event)
+
+    # Subscribers can't look up timezones by name the way CalDAV servers do.
+    calendar.add_missing_timezones()
+    return calendar.to_ical()
+
+
+class IcsFeed:
+    """
+    The latest rendered ICS feed, shared between the sync and the HTTP server threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._etag: Optional[str] = None
+        self._body: Optional[bytes] = None
+
+    @property
+    def etag(self) -> Optional[str]:
+        with self._lock:
+            return self._etag
+
+    def current(self) -> tuple[Optional[str], Optional[bytes]]:
+        """
+        Gets the ETag and body of the feed, or Nones if nothing was published yet.
+
+        :rtype: tuple[Optional[str], Optional[bytes]]
+        """
+        with self._lock:
+            return self._etag, self._body
+
+    def publish(self, etag: str, body: bytes):
+        """
+        Replaces the feed.
+
+        :param etag: The ETag of the new feed.
+        :type etag: str
+        :param body: The new feed.
+        :type body: bytes
+        """
+        with self._lock:
+            self._etag = etag
+            self._body = body
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks if an If-None-Match header matches an ETag, using the weak comparison that RFC 9110 prescribes for it.
+
+    :param if_none_match: The value of the header.
+    :type if_none_match: str
+    :param etag: The current ETag.
+    :type etag: str
+    :rtype: bool
+    """
+    for candidate in (x.strip() for x in if_none_match.split(",")):
+        if candidate == "*" or candidate.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+
+    return False
+
+
+class FeedServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, feed: IcsFeed):
+        self.feed = feed
+        super().__init__(("", port), FeedRequestHandler)
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the ICS feed at any path.
+    """
+    server: FeedServer
+
+    def do_GET(self):
+        self.serve_feed(True)
+
+    def do_HEAD(self):
+        self.serve_feed(False)
+
+    def serve_feed(self, include_body: bool):
+        etag, body = self.server.feed.current()
+
+        if etag is None or body is None:
+            self.send_response(503)
+            self.send_header("Retry-After", "60")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if etag_matches(self.headers.get("If-None-Match", ""), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", ICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        if include_body:
+            self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+def start_feed_server(port: int, feed: IcsFeed) -> FeedServer:
+    """
+    Serves an ICS feed over HTTP from a background thread, with ETag and If-None-Match support so that pollers get a 304 when nothing changed.
+
+    :param port: The port to listen on, or 0 for any free port.
+    :type port: int
+    :param feed: The feed to serve.
+    :type feed: IcsFeed
+    :return: The running server.
+    :rtype: FeedServer
+    """
+    server = FeedServer(port, feed)
+    threading.Thread(target=server.serve_forever, name="ics-feed-server", daemon=True).start()
+    logger.info(f"Serving the ICS feed on port {server.server_address[1]}.")
+    return server
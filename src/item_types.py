@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+from common import (
+    ITEM_TYPE_CLOUDSYNC,
+    ITEM_TYPE_CRONJOB,
+    ITEM_TYPE_REPLICATION,
+    ITEM_TYPE_RSYNC,
+    ITEM_TYPE_SCRUB,
+    ITEM_TYPE_SMART,
+    ITEM_TYPE_SNAPSHOT,
+    QUERY_CLOUDSYNC,
+    QUERY_CRONJOB,
+    QUERY_REPLICATION,
+    QUERY_RSYNC,
+    QUERY_SCRUB,
+    QUERY_SMART,
+    QUERY_SNAPSHOT,
+)
+
+
+def item_schedule(item: Dict) -> Optional[dict[str, str]]:
+    return item.get("schedule")
+
+
+@dataclass(frozen=True)
+class ItemType:
+    """
+    Describes a kind of scheduled TrueNAS task: how to fetch its items, how to turn them into events, and how it is configured.
+    """
+    # The summary prefix of the events, which also ends up (lowercased) in their UIDs, so it can't contain dashes.
+    name: str
+    query: str
+    # The key that says if an item is enabled, or None if the items can't be disabled.
+    enabled_key: Optional[str]
+    # The key of what the events are named after, and what the filter is matched against.
+    description_key: str
+    include_env: str
+    filter_env: str
+    include_default: bool = True
+    # Gets the schedule of an item, or None if it doesn't run on a schedule of its own.
+    get_schedule: Callable[[Dict], Optional[dict[str, str]]] = item_schedule
+    # The job methods that run an item, with the item ID as the first argument.
+    job_methods: tuple[str, ...] = ()
+    # Whether the first argument of the job methods is the description of the item instead.
+    job_argument_is_description: bool = False
+
+
+# The item types in the order they are synced. The types added after the original four are opt-in, so that upgrading doesn't add events (or queries that older middleware doesn't know).
+ITEM_TYPES: tuple[ItemType, ...] = (
+    ItemType(ITEM_TYPE_SNAPSHOT, QUERY_SNAPSHOT, "enabled", "dataset", "INCLUDE_SNAPSHOTS", "SNAPSHOTS_FILTER", job_methods=("pool.snapshottask.run",)),
+    ItemType(ITEM_TYPE_SCRUB, QUERY_SCRUB, "enabled", "pool_name", "INCLUDE_SCRUBS", "SCRUBS_FILTER", job_methods=("pool.scrub.run", "pool.scrub.scrub"), job_argument_is_description=True),
+    ItemType(ITEM_TYPE_CLOUDSYNC, QUERY_CLOUDSYNC, "enabled", "description", "INCLUDE_CLOUDSYNCS", "CLOUDSYNCS_FILTER", job_methods=("cloudsync.sync",)),
+    ItemType(ITEM_TYPE_CRONJOB, QUERY_CRONJOB, "enabled", "description", "INCLUDE_CRONJOBS", "CRONJOBS_FILTER"),
+    ItemType(ITEM_TYPE_REPLICATION, QUERY_REPLICATION, "enabled", "name", "INCLUDE_REPLICATIONS", "REPLICATIONS_FILTER", False, job_methods=("replication.run",)),
+    ItemType(ITEM_TYPE_RSYNC, QUERY_RSYNC, "enabled", "path", "INCLUDE_RSYNCS", "RSYNCS_FILTER", False, job_methods=("rsynctask.run",)),
+    # SMART tests can't be disabled, and their schedules have no minute since they start on the hour.
+    ItemType(ITEM_TYPE_SMART, QUERY_SMART, None, "desc", "INCLUDE_SMART_TESTS", "SMART_TESTS_FILTER", False),
+)
+
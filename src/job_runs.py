@@ -0,0 +1,179 @@
+import hashlib
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Dict, Optional
+from common import UID_PREFIX, parse_item_type_from_uid
+from item_types import ITEM_TYPES, ItemType
+from state_store import SyncState
+
+if TYPE_CHECKING:
+    from calendar_snapshot import RemoteEvent
+
+logger = logging.getLogger(__name__)
+
+# The item type that parse_item_type_from_uid finds in the UIDs of run events.
+RUN_UID_TYPE = "run"
+
+# The job methods that run the synced items, and the item types they run.
+JOB_METHODS: dict[str, ItemType] = {method: x for x in ITEM_TYPES for method in x.job_methods}
+
+# The states of finished jobs, and how they read in event summaries.
+FINISHED_JOB_STATES = {
+    "SUCCESS": "succeeded",
+    "FAILED": "failed",
+    "ABORTED": "aborted",
+}
+
+# The most expired run events removed per sync, so that catching up on a long retention change doesn't hold up the sync.
+JOB_RUN_PRUNE_BATCH_SIZE = 50
+
+
+@dataclass
+class JobRun:
+    """
+    A finished TrueNAS job that ran a synced item. Scrubs are identified by pool name, everything else by item ID.
+    """
+    job_id: int
+    item_type: str
+    item_id: Optional[int]
+    item_name: Optional[str]
+    state: str
+    start: datetime
+    end: datetime
+    error: Optional[str]
+
+
+@dataclass
+class RunEvent:
+    """
+    A calendar event for a job run, spanning the time it actually ran.
+    """
+    uid: str
+    start: datetime
+    end: datetime
+    summary: str
+    description: str
+
+
+def parse_job_time(value: Any) -> Optional[datetime]:
+    """
+    Parses a job timestamp, which the TrueNAS client decodes to a datetime but which is milliseconds since the epoch on the wire.
+
+    :param value: The timestamp.
+    :type value: Any
+    :return: The timestamp in UTC, or None if the job didn't get that far.
+    :rtype: Optional[datetime]
+    """
+    if isinstance(value, dict) and "$date" in value:
+        value = value["$date"]
+
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, timezone.utc)
+
+    return None
+
+
+def parse_job(job: Dict) -> Optional[JobRun]:
+    """
+    Parses a job from core.get_jobs.
+
+    :param job: The job.
+    :type job: Dict
+    :return: The run, or None if the job isn't a finished run of a synced item.
+    :rtype: Optional[JobRun]
+    """
+    item_type = JOB_METHODS.get(job.get("method", ""))
+    start = parse_job_time(job.get("time_started"))
+    end = parse_job_time(job.get("time_finished"))
+    arguments = job.get("arguments") or []
+
+    if item_type is None or job.get("state") not in FINISHED_JOB_STATES or start is None or end is None or len(arguments) == 0:
+        return None
+
+    if item_type.job_argument_is_description:
+        item_id, item_name = None, str(arguments[0])
+    elif isinstance(arguments[0], int):
+        item_id, item_name = arguments[0], None
+    else:
+        return None
+
+    return JobRun(job["id"], item_type.name, item_id, item_name, job["state"], start, max(end, start + timedelta(seconds=1)), job.get("error"))
+
+
+def create_run_uid(run: JobRun) -> str:
+    # Job IDs start over when the middleware restarts, so the start time keeps the UIDs apart.
+    return f"{UID_PREFIX}{RUN_UID_TYPE}-{run.job_id}-{int(run.start.timestamp())}"
+
+
+def is_run_uid(uid: str) -> bool:
+    return parse_item_type_from_uid(uid) == RUN_UID_TYPE
+
+
+def format_run_duration(duration: timedelta) -> str:
+    seconds = int(duration.total_seconds())
+    hours, minutes = seconds // 3600, seconds % 3600 // 60
+    if hours > 0:
+        return f"{hours}h {minutes}m"
+    if minutes > 0:
+        return f"{minutes}m {seconds % 60}s"
+    return f"{seconds}s"
+
+
+def create_run_event(run: JobRun, name: str) -> RunEvent:
+    """
+    Works out the event for a job run.
+
+    :param run: The run.
+    :type run: JobRun
+    :param name: The name of the item that ran.
+    :type name: str
+    :rtype: RunEvent
+    """
+    result = FINISHED_JOB_STATES[run.state]
+    description = f"Job {run.job_id} {result} after {format_run_duration(run.end - run.start)}."
+    if run.error:
+        description += f"\n\n{run.error}"
+
+    return RunEvent(create_run_uid(run), run.start, run.end, f"{run.item_type} run {result}: {name}", description)
+
+
+def run_event_content_hash(event: RunEvent) -> str:
+    digest = hashlib.sha256()
+    for part in (event.start.isoformat(), event.end.isoformat(), event.summary, event.description):
+        digest.update(part.encode())
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+def expired_run_events(events: dict[str, "RemoteEvent"], state: SyncState, cutoff: datetime, batch_size: int = JOB_RUN_PRUNE_BATCH_SIZE) -> list["RemoteEvent"]:
+    """
+    Finds the oldest run events that started before the retention cutoff.
+
+    :param events: The run events on the calendar, keyed by UID.
+    :type events: dict[str, RemoteEvent]
+    :param state: The sync state, which knows when the runs it saved started without downloading them.
+    :type state: SyncState
+    :param cutoff: When the retained runs start.
+    :type cutoff: datetime
+    :param batch_size: The most events to return.
+    :type batch_size: int
+    :return: Up to batch_size expired events, oldest first.
+    :rtype: list[RemoteEvent]
+    """
+    expired: list[tuple[datetime, "RemoteEvent"]] = []
+    for uid, event in events.items():
+        stored = state.events.get(uid)
+        start = datetime.fromisoformat(stored.dtstart) if stored is not None else event.component.get("dtstart").dt
+        if start < cutoff:
+            expired.append((start, event))
+
+    expired.sort(key=lambda x: x[0])
+    if len(expired) > batch_size:
+        logger.info(f"Found {len(expired)} expired job run events. Removing the oldest {batch_size} of them this time.")
+
+    return [event for _, event in expired[:batch_size]]
@@ -0,0 +1,171 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+from dateutil import tz
+
+logger = logging.getLogger(__name__)
+
+TZ_ENV = "TZ"
+LOCALTIME_PATH = "/etc/localtime"
+ZONEINFO_MARKER = "zoneinfo/"
+
+
+def zone_from_path(path: str) -> Optional[ZoneInfo]:
+    """
+    Extracts an IANA timezone from a path into a zoneinfo database (i.e. /usr/share/zoneinfo/America/Denver).
+
+    :param path: The path to inspect.
+    :type path: str
+    :return: The matching timezone, or None if the path doesn't point into a zoneinfo database.
+    :rtype: Optional[ZoneInfo]
+    """
+    if ZONEINFO_MARKER not in path:
+        return None
+
+    key = path.split(ZONEINFO_MARKER, 1)[1]
+
+    # Some distributions keep "posix/" and "right/" copies of the database.
+    for prefix in ("posix/", "right/"):
+        if key.startswith(prefix):
+            key = key[len(prefix):]
+
+    return zone_from_key(key)
+
+
+def zone_from_key(key: str) -> Optional[ZoneInfo]:
+    """
+    Safely builds a timezone from an IANA key.
+
+    :param key: The IANA key (i.e. America/Denver).
+    :type key: str
+    :return: The timezone, or None if the key is not a known IANA timezone.
+    :rtype: Optional[ZoneInfo]
+    """
+    try:
+        return ZoneInfo(key)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def is_tz_env_set() -> bool:
+    """
+    Checks if the TZ environment variable sets the timezone of this process, whether or not it holds an IANA key.
+    """
+    return os.environ.get(TZ_ENV, "").lstrip(":") != ""
+
+
+def zone_from_tz_env() -> Optional[ZoneInfo]:
+    """
+    Reads the IANA timezone from the TZ environment variable, if it holds one.
+    """
+    value = os.environ.get(TZ_ENV, "").lstrip(":")
+    if value == "":
+        return None
+
+    if value.startswith("/"):
+        return zone_from_path(value)
+
+    return zone_from_key(value)
+
+
+def zone_from_localtime_link() -> Optional[ZoneInfo]:
+    """
+    Reads the IANA timezone from the target of the /etc/localtime symlink, if it is one.
+    Note that bind mounting /etc/localtime into a container yields a plain file, in which case this returns None.
+    """
+    if not os.path.islink(LOCALTIME_PATH):
+        return None
+
+    return zone_from_path(os.path.realpath(LOCALTIME_PATH))
+
+
+def zone_from_offset(now: datetime) -> Optional[ZoneInfo]:
+    """
+    Finds the first IANA timezone (alphabetically) with the same UTC offset and DST rules as the given datetime.
+    This is expensive since it loads every timezone known to the system.
+
+    :param now: A timezone aware datetime in the local timezone.
+    :type now: datetime
+    :return: The first matching timezone, or None if there is no match.
+    :rtype: Optional[ZoneInfo]
+    """
+    local_tz_offset = now.utcoffset()
+    local_tz_dst = now.dst()
+    naive_now = now.replace(tzinfo=None)
+
+    for candidate_zone_str in sorted(available_timezones()):
+        candidate_zone = ZoneInfo(candidate_zone_str)
+
+        if local_tz_offset == candidate_zone.utcoffset(naive_now) and local_tz_dst == candidate_zone.dst(naive_now):
+            return candidate_zone
+
+    return None
+
+
+class LocalTimezoneResolver:
+    """
+    Works out the IANA timezone of this machine and caches it.
+
+    A timezone named by TZ or by the /etc/localtime symlink is resolved once per process. The symlink is ignored when TZ is set, since the process uses TZ then, even when it isn't an IANA key (i.e. a POSIX string like "XYZ3").
+    Otherwise, the timezone is guessed by matching the current UTC offset, which is redone only when the offset changes (i.e. on a DST transition).
+    """
+
+    def __init__(self):
+        self._configured_zone: Optional[ZoneInfo] = None
+        self._configured_zone_resolved = False
+        self._offset_key: Optional[tuple[Optional[timedelta], Optional[timedelta]]] = None
+        self._offset_zone: Optional[ZoneInfo] = None
+
+    def resolve(self, now: datetime) -> Optional[ZoneInfo]:
+        """
+        Resolves the IANA timezone for the local time.
+
+        :param now: A timezone aware datetime in the local timezone.
+        :type now: datetime
+        :return: The IANA timezone, or None if one could not be found.
+        :rtype: Optional[ZoneInfo]
+        """
+        if not self._configured_zone_resolved:
+            self._configured_zone = zone_from_tz_env() if is_tz_env_set() else zone_from_localtime_link()
+            self._configured_zone_resolved = True
+
+            if self._configured_zone is not None:
+                logger.info(f"Using configured local timezone {self._configured_zone.key}.")
+
+        if self._configured_zone is not None:
+            return self._configured_zone
+
+        offset_key = (now.utcoffset(), now.dst())
+        if offset_key != self._offset_key:
+            self._offset_zone = zone_from_offset(now)
+            self._offset_key = offset_key
+
+            if self._offset_zone is not None:
+                logger.info(f"Matched local timezone {self._offset_zone.key} for offset {now.utcoffset()} and dst {now.dst()}.")
+
+        return self._offset_zone
+
+
+_resolver = LocalTimezoneResolver()
+
+
+def local_now() -> datetime:
+    """
+    Gets the current time in the local timezone as the C library knows it, which doesn't necessarily have an IANA key.
+    """
+    return datetime.now(tz.gettz(time.tzname[time.daylight]))
+
+
+def resolve_local_timezone(now: datetime) -> Optional[ZoneInfo]:
+    """
+    Resolves the IANA timezone for the local time using the process wide resolver.
+
+    :param now: A timezone aware datetime in the local timezone.
+    :type now: datetime
+    :return: The IANA timezone, or None if one could not be found.
+    :rtype: Optional[ZoneInfo]
+    """
+    return _resolver.resolve(now)
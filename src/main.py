@@ -1,245 +1,307 @@
-import re
-import time
-from typing import Dict, Optional
-from truenas_api_client import Client, JSONRPCClient, LegacyClient
-from caldav.davclient import DAVClient, get_davclient
-from caldav.collection import Calendar
-from caldav.calendarobjectresource import Event
-from common import ITEM_TYPE_CLOUDSYNC, ITEM_TYPE_CRONJOB, ITEM_TYPE_SCRUB, ITEM_TYPE_SNAPSHOT, create_item_uid, parse_item_type_from_uid, schedule_to_cron_string
-from cron_to_ical import FREQ_HOURLY, FREQ_MINUTELY, cron_to_ical
-from options import Options
+import argparse
+import asyncio
 import logging
+import sys
+import time
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Optional
+from truenas_api_client import JSONRPCClient, LegacyClient
+from backoff import Backoff
+from change_subscriptions import ChangeCollector
+from connections import ConnectionManager
+from common import current_target
+from files import PUBLIC_FILE_MODE, write_file_atomically
+from ics_export import IcsFeed, feed_etag, render_calendar, start_feed_server
+from metrics import SYNC_EXPORT, SYNC_FULL, SYNC_TARGETED, phase_seconds, record_sync, register_target, start_metrics_server
+from options import OUTPUT_CALDAV, OUTPUT_ICS, Options
+from sync_plan import build_query_specs, ical_cache, plan_all_events
+from targets import SyncConfig, SyncTarget, TargetLogFilter, load_config_from_env
+from truenas_queries import run_queries
 from dotenv import load_dotenv
 
-load_dotenv()
+# The CalDAV client and its dependencies take most of the startup time, so they are only imported for type hints here and otherwise once a target syncs to CalDAV.
+if TYPE_CHECKING:
+    from caldav.davclient import DAVClient
+    from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
+EXIT_SUCCESS = 0
+EXIT_SYNC_FAILED = 1
+EXIT_CONFIG_ERROR = 2
 
-def create_events(
-    items_filter: Optional[re.Pattern],
-    truenas_client: JSONRPCClient | LegacyClient,
-    events: list[Event],
-    calendar: Calendar,
-    query: str,
-    enabled_key: str | None,
-    item_type: str,
-    item_description_key: str
-) -> set[str]:
+
+async def perform_export_async(options: Options, truenas_client: JSONRPCClient | LegacyClient, feed: IcsFeed, queries_without_options: set[str]):
     """
-    Generates calendar events for TrueNAS items of a given type.
-    
-    :param items_filter: A regular expression pattern to filter items.
-    :type items_filter: Optional[re.Pattern]
-    :param truenas_client: The TrueNAS API client to use for fetching item data.
+    Renders the recurring TrueNAS jobs into a single ICS feed, written to a file and/or served over HTTP.
+    The events are the same ones that would be synced to a CalDAV server. The feed is only rendered again when an event changed.
+
+    :param options: The parsed options for the export.
+    :type options: Options
+    :param truenas_client: The TrueNAS client to use for fetching job data.
     :type truenas_client: JSONRPCClient | LegacyClient
-    :param events: A list of existing calendar events.
-    :type events: list[Event]
-    :param calendar: The calendar to which events will be added.
-    :type calendar: Calendar
-    :param query: The query to use for fetching items from the TrueNAS API.
-    :type query: str
-    :param enabled_key: The key to check if the item is enabled.
-    :type enabled_key: str | None
-    :param item_type: The type of the item.
-    :type item_type: str
-    :param item_description_key: The key for the item description.
-    :type item_description_key: str
-    :return: A set of event UIDs that were created or updated.
-    :rtype: set[str]
+    :param feed: The feed to publish to.
+    :type feed: IcsFeed
+    :param queries_without_options: The queries that the TrueNAS can't run with filters or a field selection, see run_query_spec.
+    :type queries_without_options: set[str]
     """
-    logger.info(f"Performing query \"{query}\" for events with summary prefix \"{item_type}\".")
-
-    items: list[Dict] = truenas_client.call(query)  # type: ignore
-    logger.info(f"Found {len(items)} items.")
+    logger.info("Starting export of recurring TrueNAS jobs to an ICS feed.")
 
-    event_uids_saved: set[str] = set()
+    query_specs = build_query_specs(options)
 
-    if items_filter is not None:
-        logger.info(f"Filtering items with pattern \"{items_filter.pattern}\".")
-        filtered_items = [x for x in items if items_filter.search(x[item_description_key]) is not None]
-        logger.info(f"{len(filtered_items)} items remain after filtering.")
-    else:
-        filtered_items = items
+    try:
+        async with asyncio.timeout(options.fetch_timeout.seconds):
+            query_results = await run_queries(truenas_client, query_specs, queries_without_options)
+    except TimeoutError:
+        raise Exception(f"Fetching the TrueNAS items took longer than {options.fetch_timeout}.")
 
-    for item in filtered_items:
-        item_summary = f"{item_type}: {item[item_description_key]}"
-        logger.info(f"Found item: \"{item_summary}\".")
+    events = [(planned, ical_cache.get(planned.cron)) for planned_events in plan_all_events(options, query_results).values() for planned in planned_events]
 
-        if enabled_key is not None and not item[enabled_key]:
-            logger.info(f"Skipping item \"{item_summary}\" because it is disabled.")
-            continue
+    etag = feed_etag(events)
+    if etag == feed.etag:
+        logger.info(f"ICS feed with {len(events)} events is already up to date.")
+        return
 
-        cron_str = schedule_to_cron_string(item["schedule"])
-        logger.info(f"Found CRON expression {cron_str}.")
+    with phase_seconds.time(phase="render"):
+        body = render_calendar(events, datetime.now(timezone.utc))
+    if options.ics_file is not None:
+        await asyncio.to_thread(write_file_atomically, options.ics_file, body, PUBLIC_FILE_MODE)
 
-        ical = cron_to_ical(cron_str)
-        logger.info(f"Resulting ICAL object: {ical}")
+    feed.publish(etag, body)
+    logger.info(f"Published ICS feed with {len(events)} events ({len(body)} bytes, ETag {etag}).")
 
-        if ical.rrule["FREQ"] in (FREQ_HOURLY, FREQ_MINUTELY):
-            logger.warning("Hourly and minutely FREQs might not be supported by some calendars!")
+    logger.info(f"iCal conversion cache: {ical_cache.stats()}.")
 
-        event_uid = create_item_uid(item_type, item['id'])
-        previous_events: list[Event] = [x for x in events if x.component.uid == event_uid]
 
-        event_uids_saved.add(event_uid)
+async def sync_target(target: SyncTarget, dav_client: Optional["DAVClient"], truenas_client: JSONRPCClient | LegacyClient, changed_ids: Optional[dict[str, set[int]]] = None):
+    """
+    Syncs a target to its output, recording how long it took and whether it succeeded in the metrics.
 
-        if len(previous_events) > 0:
-            logger.info("Updating previously saved event...")
-            previous_event = previous_events[0]
-            previous_event.component.dtstart = ical.start
-            previous_event.component.dtend = ical.start
-            previous_event.component.rrule = ical.rrule
-            previous_event.component.summary = item_summary
-            previous_event.save(only_this_recurrence=False, all_recurrences=True, no_create=True)
-            logger.info("Previously saved event successfully updated...")
+    :param target: The target to sync.
+    :type target: SyncTarget
+    :param dav_client: The CalDAV client to use for interacting with the calendar, or None with the ICS output.
+    :type dav_client: Optional["DAVClient"]
+    :param truenas_client: The TrueNAS client to use for fetching job data.
+    :type truenas_client: JSONRPCClient | LegacyClient
+    :param changed_ids: The IDs of the items that changed keyed by query, to only sync those. None syncs everything.
+    :type changed_ids: Optional[dict[str, set[int]]]
+    """
+    kind = SYNC_EXPORT if target.options.output == OUTPUT_ICS else SYNC_FULL if changed_ids is None else SYNC_TARGETED
+    start = time.perf_counter()
+    try:
+        if target.options.output == OUTPUT_ICS:
+            # Rendering the whole feed is cheap, so changes don't need targeting.
+            await perform_export_async(target.options, truenas_client, target.feed, target.queries_without_options)
         else:
-            logger.info("Saving event to calendar...")
-            calendar.save_event(
-                dtstart=ical.start,
-                dtend=ical.end,
-                rrule=ical.rrule,
-                summary=item_summary,
-                uid=event_uid,
-            )
-            logger.info(f"Event successfully saved to calendar.")
+            from caldav_sync import perform_sync_async
+            await perform_sync_async(target.options, dav_client, truenas_client, target.state, target.snapshot, target.queries_without_options, changed_ids)  # type: ignore
+    except Exception:
+        record_sync(kind, time.perf_counter() - start, False)
+        raise
 
-    return event_uids_saved
+    record_sync(kind, time.perf_counter() - start, True)
 
 
-def perform_sync(options: Options, dav_client: DAVClient, truenas_client: JSONRPCClient | LegacyClient):
+async def watch_for_changes(target: SyncTarget, dav_client: Optional["DAVClient"], truenas_client: JSONRPCClient | LegacyClient, sync_slots: asyncio.Semaphore):
     """
-    Performs synchronization of TrueNAS recurring jobs with a CalDAV server.
-    
-    :param options: The parsed options for the synchronization.
-    :type options: Options
-    :param dav_client: The CalDAV client to use for interacting with the calendar.
-    :type dav_client: DAVClient
-    :param truenas_client: The TrueNAS client to use for fetching job data.
+    Subscribes to changes of the included TrueNAS items and performs a targeted sync for each burst of changes, until the next periodic full sync is due.
+
+    :param target: The target to watch.
+    :type target: SyncTarget
+    :param dav_client: The CalDAV client to use for interacting with the calendar, or None with the ICS output.
+    :type dav_client: Optional["DAVClient"]
+    :param truenas_client: The TrueNAS client to subscribe with and to use for fetching job data.
     :type truenas_client: JSONRPCClient | LegacyClient
+    :param sync_slots: Limits how many syncs run at once across all targets.
+    :type sync_slots: asyncio.Semaphore
     """
-    
-    logger.info("Starting sync of recurring TrueNAS jobs with caldav server.")
-
-    my_principal = dav_client.principal()
-
-    # Go find the corresponding calendar
-    truenas_calendar: Calendar | None = None
-    for cal in my_principal.calendars():
-        if cal.id != options.calendar_id:
-            continue
-
-        truenas_calendar = cal
-
-    # Create one if it doesn't exist
-    if truenas_calendar is None:
-        logger.info("TrueNAS jobs calendar not found. One will be created.")
-        truenas_calendar = my_principal.make_calendar("TrueNAS Jobs", options.calendar_id)
-    else:
-        logger.info("Found previous TrueNAS jobs calendar.")
-
-    all_events = truenas_calendar.events()
-
-    def filter_events_by_type(item_type: str) -> list[Event]:
-        return [x for x in all_events if parse_item_type_from_uid(x.component.uid) == item_type.lower()]
-
-    event_uids_saved: set[str] = set()
-
-    # Sync all the things.
-
-    if not options.include_snapshots:
-        logger.info("Ignoring snapshots...")
-    else:
-        logger.info("Syncing snapshots...")
-        event_uids_saved = event_uids_saved.union(
-            create_events(
-                options.snapshots_filter,
-                truenas_client,
-                filter_events_by_type(ITEM_TYPE_SNAPSHOT),
-                truenas_calendar,
-                "pool.snapshottask.query",
-                "enabled",
-                ITEM_TYPE_SNAPSHOT,
-                "dataset"))
-
-    if not options.include_scrubs:
-        logger.info("Ignoring scrubs...")
-    else:
-        logger.info("Syncing scrubs...")
-        event_uids_saved = event_uids_saved.union(
-            create_events(
-                options.scrubs_filter,
-                truenas_client,
-                filter_events_by_type(ITEM_TYPE_SCRUB),
-                truenas_calendar,
-                "pool.scrub.query",
-                "enabled",
-                ITEM_TYPE_SCRUB,
-                "pool_name"))
-
-    if not options.include_cloudsyncs:
-        logger.info("Ignoring cloudsync tasks...")
-    else:
-        logger.info("Syncing cloudsync tasks...")
-        event_uids_saved = event_uids_saved.union(
-            create_events(
-                options.cloudsyncs_filter,
-                truenas_client,
-                filter_events_by_type(ITEM_TYPE_CLOUDSYNC),
-                truenas_calendar,
-                "cloudsync.query",
-                "enabled",
-                ITEM_TYPE_CLOUDSYNC,
-                "description"))
-
-    if not options.include_cronjobs:
-        logger.info("Ignoring cronjobs...")
-    else:
-        logger.info("Syncing cronjobs...")
-        event_uids_saved = event_uids_saved.union(
-            create_events(
-                options.cronjobs_filter,
-                truenas_client,
-                filter_events_by_type(ITEM_TYPE_CRONJOB),
-                truenas_calendar,
-                "cronjob.query",
-                "enabled",
-                ITEM_TYPE_CRONJOB,
-                "description"))
-
-    # Remove stale events
-    logger.info("Sync complete, removing stale events...")
-    for event in (event for event in all_events if event.component.uid not in event_uids_saved):
-        logger.info(f"Removing stale event with UID {event.component.uid}.")
-        event.delete()
-
+    options = target.options
+    collector = ChangeCollector(asyncio.get_running_loop())
+    # The TrueNAS connection outlives this call, so the subscriptions are removed again before returning. Each one is a round trip, which mustn't hold up the other targets.
+    subscription_ids: list[str] = []
+
+    try:
+        for item_type in options.included_item_types():
+            subscription_ids.append(await asyncio.to_thread(truenas_client.subscribe, item_type.query, collector.callback_for(item_type.query)))
+
+        logger.info(f"Watching for changes until the next full sync in {options.sync_interval}.")
+        deadline = time.monotonic() + options.sync_interval.seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            changes = await collector.wait(remaining, options.change_debounce_time.seconds)
+            if changes is None:
+                break
+
+            needs_full_sync, changed_ids = changes
+            async with sync_slots:
+                await sync_target(target, dav_client, truenas_client, None if needs_full_sync else changed_ids)
+    finally:
+        for subscription_id in subscription_ids:
+            try:
+                await asyncio.to_thread(truenas_client.unsubscribe, subscription_id)
+            except Exception as e:
+                # The connection is often what failed, and that error is the one worth reporting.
+                logger.warning(f"Failed to unsubscribe from TrueNAS changes: {e}")
+
+
+async def run_target(target: SyncTarget, dav_adapter: Optional["HTTPAdapter"], sync_slots: asyncio.Semaphore):
+    """
+    Syncs a target forever, backing off after failures.
+
+    :param target: The target to sync.
+    :type target: SyncTarget
+    :param dav_adapter: The connection pool for the CalDAV server of the target, or None with the ICS output.
+    :type dav_adapter: Optional["HTTPAdapter"]
+    :param sync_slots: Limits how many syncs run at once across all targets.
+    :type sync_slots: asyncio.Semaphore
+    """
+    options = target.options
+    connections = ConnectionManager(options, dav_adapter)
+    backoff = Backoff(options.failure_backoff_initial_time.seconds, options.failure_backoff_time.seconds)
 
-def main():
-    options = Options.from_env()
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',)
+    if options.output == OUTPUT_ICS and options.ics_port is not None:
+        start_feed_server(options.ics_port, target.feed)
 
     while True:
         try:
             while True:
-                with get_davclient(url=f"http://{options.caldav_host}", username=options.caldav_username, password=options.caldav_password) as client:
-                    logger.info("Successfully connected to caldav server.")
+                async with sync_slots:
+                    client = None if options.output == OUTPUT_ICS else await asyncio.to_thread(connections.dav_client)
+                    c = await asyncio.to_thread(connections.truenas_client)
 
-                    with Client(uri=f"wss://{options.truenas_host}/api/current", verify_ssl=options.truenas_host_verify_ssl) as c:
-                        login_result = c.call("auth.login_with_api_key", options.truenas_api_key)
+                    await sync_target(target, client, c)
 
-                        if not login_result:
-                            raise Exception("Failed to authenticate with TrueNAS.")
+                backoff.reset()
 
-                        logger.info("Successfully logged into TrueNAS.")
-
-                        perform_sync(options, client, c)
-
-                logger.info(f"Sync finished successfully. Sleeping for {options.sync_interval}.")
-                time.sleep(options.sync_interval.seconds)
+                if options.subscribe_to_changes:
+                    await watch_for_changes(target, client, c, sync_slots)
+                    logger.info("Starting the periodic full sync.")
+                else:
+                    logger.info(f"Sync finished successfully. Sleeping for {options.sync_interval}.")
+                    await asyncio.sleep(options.sync_interval.seconds)
         except Exception as e:
             logger.error(f"Error encountered at root loop: {e}")
-            logger.error(f"Sleeping for {options.failure_backoff_time} before trying again.")
-            time.sleep(options.failure_backoff_time.seconds)
+            target.reset_snapshot()
+            connections.reset()
+            delay = backoff.next_delay()
+            logger.error(f"Sleeping for {delay:.0f} seconds before trying again.")
+            await asyncio.sleep(delay)
+
+
+async def run_target_once(target: SyncTarget, dav_adapter: Optional["HTTPAdapter"], sync_slots: asyncio.Semaphore) -> bool:
+    """
+    Syncs a target a single time, without retrying after a failure, and closes its connections again.
+
+    :param target: The target to sync.
+    :type target: SyncTarget
+    :param dav_adapter: The connection pool for the CalDAV server of the target, or None with the ICS output.
+    :type dav_adapter: Optional[HTTPAdapter]
+    :param sync_slots: Limits how many syncs run at once across all targets.
+    :type sync_slots: asyncio.Semaphore
+    :return: Whether the sync succeeded.
+    :rtype: bool
+    """
+    options = target.options
+    connections = ConnectionManager(options, dav_adapter)
+    try:
+        async with sync_slots:
+            client = None if options.output == OUTPUT_ICS else await asyncio.to_thread(connections.dav_client)
+            c = await asyncio.to_thread(connections.truenas_client)
+
+            await sync_target(target, client, c)
+    except Exception as e:
+        logger.error(f"Sync failed: {e}")
+        return False
+    finally:
+        connections.reset()
+
+    logger.info("Sync finished successfully.")
+    return True
+
+
+def create_dav_adapters(targets: list[SyncTarget]) -> dict[str, "HTTPAdapter"]:
+    """
+    Creates a connection pool per CalDAV server, shared by the targets on that server.
+
+    :param targets: The targets to sync.
+    :type targets: list[SyncTarget]
+    :return: The connection pools keyed by CalDAV host.
+    :rtype: dict[str, HTTPAdapter]
+    """
+    caldav_targets = [x for x in targets if x.options.output == OUTPUT_CALDAV]
+    if len(caldav_targets) == 0:
+        return {}
+
+    from calendar_writes import create_dav_adapter
+
+    dav_adapters: dict[str, "HTTPAdapter"] = {}
+    for caldav_host in set(x.options.caldav_host for x in caldav_targets):
+        max_concurrency = sum(x.options.caldav_max_concurrency for x in caldav_targets if x.options.caldav_host == caldav_host)
+        dav_adapters[caldav_host] = create_dav_adapter(max_concurrency)
+
+    return dav_adapters
+
+
+async def run_targets(config: SyncConfig, once: bool = False) -> bool:
+    """
+    Syncs all targets concurrently, forever or a single time.
+
+    :param config: The targets to sync and how many syncs may run at once.
+    :type config: SyncConfig
+    :param once: Sync every target a single time and return, rather than forever. The metrics and ICS feed servers aren't started then, since they wouldn't outlive the syncs.
+    :type once: bool
+    :return: Whether every sync succeeded, when syncing once.
+    :rtype: bool
+    """
+    sync_slots = asyncio.Semaphore(config.max_concurrent_syncs)
+
+    for target in config.targets:
+        register_target(target.name)
+
+    if config.metrics_port is not None and not once:
+        start_metrics_server(config.metrics_port)
+
+    dav_adapters = create_dav_adapters(config.targets)
+
+    tasks: list[asyncio.Task] = []
+    async with asyncio.TaskGroup() as task_group:
+        for target in config.targets:
+            # Each task takes a copy of the context, so its metrics and log lines are recorded for its own target.
+            current_target.set(target.name)
+
+            dav_adapter = dav_adapters.get(target.options.caldav_host)
+            tasks.append(task_group.create_task(run_target_once(target, dav_adapter, sync_slots) if once else run_target(target, dav_adapter, sync_slots)))
+
+    return all(x.result() for x in tasks)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Syncs the recurring jobs of TrueNAS instances to CalDAV calendars or ICS feeds.")
+    parser.add_argument("--once", action="store_true", help=f"Sync every target a single time and exit, i.e. when run by cron or a Kubernetes CronJob. Exits with status {EXIT_SYNC_FAILED} if any sync failed, and {EXIT_CONFIG_ERROR} if the configuration is invalid.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(target_prefix)s%(message)s',)
+    log_filter = TargetLogFilter()
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(log_filter)
+
+    load_dotenv()
+
+    try:
+        config = load_config_from_env()
+    except Exception as e:
+        logger.error(f"Invalid configuration: {e}")
+        sys.exit(EXIT_CONFIG_ERROR)
+
+    log_filter.show_targets = len(config.targets) > 1
+
+    if args.once:
+        sys.exit(EXIT_SUCCESS if asyncio.run(run_targets(config, once=True)) else EXIT_SYNC_FAILED)
+
+    asyncio.run(run_targets(config))
 
 
 if __name__ == "__main__":
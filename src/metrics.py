@@ -0,0 +1,284 @@
+import bisect
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+from common import current_target
+
+logger = logging.getLogger(__name__)
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_PREFIX = "truenas_jobs_caldav_"
+
+# Seconds, from single requests up to whole syncs of big calendars.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+SYNC_FULL = "full"
+SYNC_TARGETED = "targeted"
+SYNC_EXPORT = "export"
+
+
+def target_label() -> str:
+    """
+    Gets the name of the target whose sync is running. With a single target, that target is called "default".
+
+    :rtype: str
+    """
+    return current_target.get() or "default"
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if len(names) == 0:
+        return ""
+
+    return "{" + ",".join(f"{name}=\"{escape_label_value(value)}\"" for name, value in zip(names, values)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+
+class Metric(ABC):
+    """
+    A metric in the Prometheus text format. Every metric is labelled with the target it was recorded for, on top of its own labels.
+    """
+    metric_type = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = ("target",) + label_names
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.label_names[1:]):
+            raise Exception(f"Metric {self.name} needs the labels {', '.join(self.label_names[1:])}, not {', '.join(labels)}.")
+
+        return (target_label(),) + tuple(str(labels[x]) for x in self.label_names[1:])
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        ...
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"] + self.samples())
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}" for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+        # The observations per bucket (not cumulative, the last one being +Inf), their sum and their count, keyed by label values.
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            bucket_counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (bucket_counts, total + value, count + 1)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            values = self._values.get(self._key(labels))
+            return 0 if values is None else values[2]
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observes how long the block takes, whether or not it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        lines: list[str] = []
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(self.label_names + ('le',), key + (format_value(bound),))} {cumulative}")
+
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {format_value(total)}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {count}")
+
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list[Metric] = []
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(METRICS_PREFIX + name, help, label_names))
+
+    def gauge(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(METRICS_PREFIX + name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Histogram:
+        return self._register(Histogram(METRICS_PREFIX + name, help, label_names))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(x.render() for x in self._metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+phase_seconds = registry.histogram("phase_duration_seconds", "How long each phase of a sync took.", ("phase",))
+query_seconds = registry.histogram("query_duration_seconds", "How long each TrueNAS query took.", ("query",))
+write_seconds = registry.histogram("write_duration_seconds", "How long each calendar write took.", ("action",))
+sync_seconds = registry.histogram("sync_duration_seconds", "How long each sync cycle took, successful or not.", ("kind",))
+syncs_total = registry.counter("syncs_total", "Sync cycles by whether they succeeded.", ("kind", "result"))
+last_success = registry.gauge("last_success_timestamp_seconds", "When the last sync cycle succeeded, as a Unix timestamp.")
+items_total = registry.counter("items_total", "TrueNAS items fetched, by whether they got an event.", ("type", "outcome"))
+events_total = registry.counter("events_total", "Calendar events by what their sync did to them.", ("outcome",))
+
+# Whether the last sync cycle of every target succeeded, for the health check.
+_target_health: dict[str, bool] = {}
+_target_health_lock = threading.Lock()
+
+
+def register_target(name: str):
+    """
+    Makes a target count towards the health check, which fails until its first sync succeeds.
+
+    :param name: The name of the target.
+    :type name: str
+    """
+    with _target_health_lock:
+        _target_health.setdefault(name, False)
+
+
+def record_sync(kind: str, seconds: float, succeeded: bool):
+    """
+    Records a finished sync cycle of the current target.
+
+    :param kind: SYNC_FULL, SYNC_TARGETED or SYNC_EXPORT.
+    :type kind: str
+    :param seconds: How long the cycle took.
+    :type seconds: float
+    :param succeeded: Whether the cycle succeeded.
+    :type succeeded: bool
+    """
+    sync_seconds.observe(seconds, kind=kind)
+    syncs_total.inc(kind=kind, result="success" if succeeded else "failure")
+    if succeeded:
+        last_success.set(time.time())
+
+    with _target_health_lock:
+        _target_health[target_label()] = succeeded
+
+
+def health() -> tuple[bool, str]:
+    """
+    Checks if the last sync cycle of every target succeeded.
+
+    :return: Whether all is well, and which targets are failing if not.
+    :rtype: tuple[bool, str]
+    """
+    with _target_health_lock:
+        failing = sorted(name for name, healthy in _target_health.items() if not healthy)
+
+    if len(failing) > 0:
+        return False, f"Failing: {', '.join(failing)}\n"
+
+    return True, "OK\n"
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int):
+        super().__init__(("", port), MetricsRequestHandler)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics at /metrics and the health check at /health.
+    """
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+
+        if path == "/metrics":
+            self.send_body(200, METRICS_CONTENT_TYPE, registry.render().encode())
+        elif path == "/health":
+            healthy, message = health()
+            self.send_body(200 if healthy else 503, "text/plain; charset=utf-8", message.encode())
+        else:
+            self.send_body(404, "text/plain; charset=utf-8", b"Not found\n")
+
+    def send_body(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+def start_metrics_server(port: int) -> MetricsServer:
+    """
+    Serves the metrics in the Prometheus text format and a health check over HTTP from a background thread.
+
+    :param port: The port to listen on, or 0 for any free port.
+    :type port: int
+    :return: The running server.
+    :rtype: MetricsServer
+    """
+    server = MetricsServer(port)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on port {server.server_address[1]}.")
+    return server
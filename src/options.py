@@ -1,34 +1,53 @@
 from dataclasses import dataclass
 import os
 import re
-from typing import Optional
+from typing import Mapping, Optional
 from durations_nlp import Duration
+from item_types import ITEM_TYPES, ItemType
+
+OUTPUT_ENV = "OUTPUT"
+ICS_FILE_ENV = "ICS_FILE"
+ICS_PORT_ENV = "ICS_PORT"
 
 CALENDAR_ID_ENV = "CALENDAR_ID"
 CALDAV_HOST_ENV = "CALDAV_HOST"
 CALDAV_USERNAME_ENV = "CALDAV_USERNAME"
 CALDAV_PASSWORD_ENV = "CALDAV_PASSWORD"
+CALDAV_AUTH_TYPE_ENV = "CALDAV_AUTH_TYPE"
+CALDAV_MAX_CONCURRENCY_ENV = "CALDAV_MAX_CONCURRENCY"
 
 TRUENAS_HOST_ENV = "TRUENAS_HOST"
 TRUENAS_HOST_VERIFY_SSL_ENV = "TRUENAS_HOST_VERIFY_SSL"
 TRUENAS_API_KEY_ENV = "TRUENAS_API_KEY"
 
-INCLUDE_SNAPSHOTS_ENV = "INCLUDE_SNAPSHOTS"
-INCLUDE_SCRUBS_ENV = "INCLUDE_SCRUBS"
-INCLUDE_CLOUDSYNCS_ENV = "INCLUDE_CLOUDSYNCS"
-INCLUDE_CRONJOBS_ENV = "INCLUDE_CRONJOBS"
+GROUP_BY_SCHEDULE_ENV = "GROUP_BY_SCHEDULE"
 
-SNAPSHOTS_REGEX_ENV = "SNAPSHOTS_FILTER"
-SCRUBS_REGEX_ENV = "SCRUBS_FILTER"
-CLOUDSYNCS_REGEX_ENV = "CLOUDSYNCS_FILTER"
-CRONJOBS_REGEX_ENV = "CRONJOBS_FILTER"
+INCLUDE_JOB_RUNS_ENV = "INCLUDE_JOB_RUNS"
+JOB_RUN_RETENTION_ENV = "JOB_RUN_RETENTION"
 
 FAILURE_BACKOFF_TIME_ENV = "FAILURE_BACKOFF_TIME"
+FAILURE_BACKOFF_INITIAL_TIME_ENV = "FAILURE_BACKOFF_INITIAL_TIME"
 SYNC_INTERVAL_ENV = "SYNC_INTERVAL"
+FETCH_TIMEOUT_ENV = "FETCH_TIMEOUT"
+WRITE_TIMEOUT_ENV = "WRITE_TIMEOUT"
+SUBSCRIBE_TO_CHANGES_ENV = "SUBSCRIBE_TO_CHANGES"
+CHANGE_DEBOUNCE_TIME_ENV = "CHANGE_DEBOUNCE_TIME"
+
+STATE_FILE_ENV = "STATE_FILE"
+
+CONFIG_FILE_ENV = "CONFIG_FILE"
+MAX_CONCURRENT_SYNCS_ENV = "MAX_CONCURRENT_SYNCS"
+METRICS_PORT_ENV = "METRICS_PORT"
+
+
+OUTPUT_CALDAV = "caldav"
+OUTPUT_ICS = "ics"
+
+CALDAV_AUTH_TYPES = ("basic", "digest", "bearer")
 
 
-def parse_string(env: str, required: bool, default_value=""):
-    result = os.environ.get(env, "")
+def parse_string(env: str, required: bool, default_value="", source: Mapping[str, str] = os.environ):
+    result = source.get(env, "")
     if result == "":
         if required:
             raise Exception(f"Environment variable {env} is required.")
@@ -38,8 +57,8 @@ def parse_string(env: str, required: bool, default_value=""):
     return result
 
 
-def parse_bool(env: str, required: bool, default_value=False):
-    result = parse_string(env, required)
+def parse_bool(env: str, required: bool, default_value=False, source: Mapping[str, str] = os.environ):
+    result = parse_string(env, required, source=source)
     if result.lower() in ("true", "yes"):
         return True
 
@@ -52,8 +71,24 @@ def parse_bool(env: str, required: bool, default_value=False):
     raise Exception(f"Unrecognized bool value {result}")
 
 
-def compile_regex(env: str) -> Optional[re.Pattern]:
-    pattern = os.environ.get(env, "")
+def parse_int(env: str, required: bool, default_value=0, min_value: Optional[int] = None, source: Mapping[str, str] = os.environ):
+    result = parse_string(env, required, source=source)
+    if result == "":
+        return default_value
+
+    try:
+        value = int(result)
+    except ValueError:
+        raise Exception(f"Unrecognized int value {result}")
+
+    if min_value is not None and value < min_value:
+        raise Exception(f"Environment variable {env} must be at least {min_value}.")
+
+    return value
+
+
+def compile_regex(env: str, source: Mapping[str, str] = os.environ) -> Optional[re.Pattern]:
+    pattern = source.get(env, "")
     if pattern == "":
         return None
 
@@ -62,70 +97,133 @@ def compile_regex(env: str) -> Optional[re.Pattern]:
 
 @dataclass
 class Options:
+    output: str
+    ics_file: Optional[str]
+    ics_port: Optional[int]
+
     calendar_id: str
     caldav_host: str
     caldav_username: str
     caldav_password: str
+    # None works out the authentication scheme from the server's first response.
+    caldav_auth_type: Optional[str]
+    caldav_max_concurrency: int
 
     truenas_host: str
     truenas_host_verify_ssl: bool
     truenas_api_key: str
 
-    include_snapshots: bool
-    include_scrubs: bool
-    include_cloudsyncs: bool
-    include_cronjobs: bool
+    # Whether each item type is synced, and the pattern its items are filtered with, keyed by item type name.
+    include: dict[str, bool]
+    filters: dict[str, Optional[re.Pattern]]
 
-    snapshots_filter: Optional[re.Pattern]
-    scrubs_filter: Optional[re.Pattern]
-    cloudsyncs_filter: Optional[re.Pattern]
-    cronjobs_filter: Optional[re.Pattern]
+    group_by_schedule: bool
+
+    include_job_runs: bool
+    job_run_retention: Duration
 
     failure_backoff_time: Duration
+    failure_backoff_initial_time: Duration
     sync_interval: Duration
+    fetch_timeout: Duration
+    write_timeout: Duration
+    subscribe_to_changes: bool
+    change_debounce_time: Duration
 
-    @staticmethod
-    def from_env():
-        calendar_id = parse_string(CALENDAR_ID_ENV, True)
-        caldav_host = parse_string(CALDAV_HOST_ENV, True)
-        caldav_username = parse_string(CALDAV_USERNAME_ENV, True)
-        caldav_password = parse_string(CALDAV_PASSWORD_ENV, True)
+    state_file: Optional[str]
 
-        truenas_host = parse_string(TRUENAS_HOST_ENV, True)
-        truenas_host_verify_ssl = parse_bool(TRUENAS_HOST_VERIFY_SSL_ENV, False, True)
-        truenas_api_key = parse_string(TRUENAS_API_KEY_ENV, True)
+    def included_item_types(self) -> list[ItemType]:
+        """
+        Lists the item types to sync, in the order they are synced.
 
-        include_snapshots = parse_bool(INCLUDE_SNAPSHOTS_ENV, False, True)
-        include_scrubs = parse_bool(INCLUDE_SCRUBS_ENV, False, True)
-        include_cloudsyncs = parse_bool(INCLUDE_CLOUDSYNCS_ENV, False, True)
-        include_cronjobs = parse_bool(INCLUDE_CRONJOBS_ENV, False, True)
+        :rtype: list[ItemType]
+        """
+        return [x for x in ITEM_TYPES if self.include[x.name]]
 
-        snapshots_filter = compile_regex(SNAPSHOTS_REGEX_ENV)
-        scrubs_filter = compile_regex(SCRUBS_REGEX_ENV)
-        cloudsyncs_filter = compile_regex(CLOUDSYNCS_REGEX_ENV)
-        cronjobs_filter = compile_regex(CRONJOBS_REGEX_ENV)
-
-        failure_backoff_time = Duration(parse_string(FAILURE_BACKOFF_TIME_ENV, False, "15 minutes"))
-        sync_interval = Duration(parse_string(SYNC_INTERVAL_ENV, False, "1 hour"))
+    @staticmethod
+    def from_env():
+        return Options.from_mapping(os.environ)
 
-        return Options(calendar_id,
+    @staticmethod
+    def from_mapping(source: Mapping[str, str]):
+        """
+        Parses the options from settings keyed by environment variable name, i.e. the environment or a target of the config file.
+
+        :param source: The settings.
+        :type source: Mapping[str, str]
+        :rtype: Options
+        """
+        output = parse_string(OUTPUT_ENV, False, OUTPUT_CALDAV, source=source).lower()
+        if output not in (OUTPUT_CALDAV, OUTPUT_ICS):
+            raise Exception(f"Unrecognized output {output}")
+
+        ics_file = parse_string(ICS_FILE_ENV, False, None, source=source)
+        ics_port = parse_int(ICS_PORT_ENV, False, None, 1, source=source)
+        if output == OUTPUT_ICS and ics_file is None and ics_port is None:
+            raise Exception(f"Environment variable {ICS_FILE_ENV} or {ICS_PORT_ENV} is required with the {OUTPUT_ICS} output.")
+
+        # The ICS output doesn't talk to a CalDAV server.
+        uses_caldav = output == OUTPUT_CALDAV
+        calendar_id = parse_string(CALENDAR_ID_ENV, uses_caldav, source=source)
+        caldav_host = parse_string(CALDAV_HOST_ENV, uses_caldav, source=source)
+        caldav_username = parse_string(CALDAV_USERNAME_ENV, uses_caldav, source=source)
+        caldav_password = parse_string(CALDAV_PASSWORD_ENV, uses_caldav, source=source)
+        caldav_auth_type = parse_string(CALDAV_AUTH_TYPE_ENV, False, None, source=source)
+        if caldav_auth_type is not None and caldav_auth_type.lower() not in CALDAV_AUTH_TYPES:
+            raise Exception(f"Unrecognized CalDAV auth type {caldav_auth_type}")
+        caldav_max_concurrency = parse_int(CALDAV_MAX_CONCURRENCY_ENV, False, 4, 1, source=source)
+
+        truenas_host = parse_string(TRUENAS_HOST_ENV, True, source=source)
+        truenas_host_verify_ssl = parse_bool(TRUENAS_HOST_VERIFY_SSL_ENV, False, True, source=source)
+        truenas_api_key = parse_string(TRUENAS_API_KEY_ENV, True, source=source)
+
+        include = {x.name: parse_bool(x.include_env, False, x.include_default, source=source) for x in ITEM_TYPES}
+        filters = {x.name: compile_regex(x.filter_env, source) for x in ITEM_TYPES}
+
+        group_by_schedule = parse_bool(GROUP_BY_SCHEDULE_ENV, False, False, source=source)
+
+        include_job_runs = parse_bool(INCLUDE_JOB_RUNS_ENV, False, False, source=source)
+        job_run_retention = Duration(parse_string(JOB_RUN_RETENTION_ENV, False, "30 days", source=source))
+
+        failure_backoff_time = Duration(parse_string(FAILURE_BACKOFF_TIME_ENV, False, "15 minutes", source=source))
+        failure_backoff_initial_time = Duration(parse_string(FAILURE_BACKOFF_INITIAL_TIME_ENV, False, "30 seconds", source=source))
+        sync_interval = Duration(parse_string(SYNC_INTERVAL_ENV, False, "1 hour", source=source))
+        fetch_timeout = Duration(parse_string(FETCH_TIMEOUT_ENV, False, "5 minutes", source=source))
+        write_timeout = Duration(parse_string(WRITE_TIMEOUT_ENV, False, "15 minutes", source=source))
+        subscribe_to_changes = parse_bool(SUBSCRIBE_TO_CHANGES_ENV, False, False, source=source)
+        change_debounce_time = Duration(parse_string(CHANGE_DEBOUNCE_TIME_ENV, False, "10 seconds", source=source))
+
+        state_file = parse_string(STATE_FILE_ENV, False, None, source=source)
+
+        return Options(output,
+                       ics_file,
+                       ics_port,
+
+                       calendar_id,
                        caldav_host,
                        caldav_username,
                        caldav_password,
+                       caldav_auth_type.lower() if caldav_auth_type is not None else None,
+                       caldav_max_concurrency,
 
                        truenas_host,
                        truenas_host_verify_ssl,
                        truenas_api_key,
 
-                       include_snapshots,
-                       include_scrubs,
-                       include_cloudsyncs,
-                       include_cronjobs,
+                       include,
+                       filters,
+
+                       group_by_schedule,
 
-                       snapshots_filter,
-                       scrubs_filter,
-                       cloudsyncs_filter,
-                       cronjobs_filter,
+                       include_job_runs,
+                       job_run_retention,
 
                        failure_backoff_time,
-                       sync_interval)
+                       failure_backoff_initial_time,
+                       sync_interval,
+                       fetch_timeout,
+                       write_timeout,
+                       subscribe_to_changes,
+                       change_debounce_time,
+
+                       state_file)
@@ -0,0 +1,87 @@
+import re
+from typing import Any, Optional
+
+REGEX_METACHARACTERS = set(".^$*+?{}[]|()")
+
+
+def regex_literal(pattern: str) -> Optional[str]:
+    """
+    Unescapes a regular expression that only matches a literal string.
+
+    :param pattern: The regular expression, without anchors.
+    :type pattern: str
+    :return: The literal string, or None if the expression uses any regex features.
+    :rtype: Optional[str]
+    """
+    literal = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            if char.isalnum():
+                # Things like \d and \b aren't literals.
+                return None
+            literal.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in REGEX_METACHARACTERS:
+            return None
+        else:
+            literal.append(char)
+
+    return None if escaped else "".join(literal)
+
+
+def regex_to_query_filter(key: str, items_filter: re.Pattern) -> Optional[list[Any]]:
+    """
+    Translates an anchored literal regular expression into an equivalent TrueNAS query-filter, i.e. "^tank/data$" into ["dataset", "=", "tank/data"] and "^tank/" into ["dataset", "^", "tank/"].
+
+    :param key: The item key the regular expression is matched against.
+    :type key: str
+    :param items_filter: The regular expression.
+    :type items_filter: re.Pattern
+    :return: The query-filter, or None if the expression can't be expressed as one.
+    :rtype: Optional[list[Any]]
+    """
+    pattern = items_filter.pattern
+    if not isinstance(pattern, str) or items_filter.flags & (re.IGNORECASE | re.MULTILINE | re.VERBOSE):
+        return None
+
+    anchored_start = pattern.startswith("^")
+    anchored_end = pattern.endswith("$") and not pattern.endswith("\\$")
+    literal = regex_literal(pattern[1 if anchored_start else 0:len(pattern) - 1 if anchored_end else len(pattern)])
+
+    if literal is None or literal == "":
+        return None
+    if anchored_start and anchored_end:
+        return [key, "=", literal]
+    if anchored_start:
+        return [key, "^", literal]
+    if anchored_end:
+        return [key, "$", literal]
+
+    return None
+
+
+def build_query_filters(enabled_key: Optional[str], description_key: str, items_filter: Optional[re.Pattern]) -> list[list[Any]]:
+    """
+    Builds the TrueNAS query-filters that let the middleware drop disabled and filtered out items.
+
+    :param enabled_key: The key to check if the item is enabled.
+    :type enabled_key: Optional[str]
+    :param description_key: The key for the item description.
+    :type description_key: str
+    :param items_filter: The regular expression items are filtered with. Only anchored literal expressions become query-filters.
+    :type items_filter: Optional[re.Pattern]
+    :rtype: list[list[Any]]
+    """
+    filters: list[list[Any]] = []
+    if enabled_key is not None:
+        filters.append([enabled_key, "=", True])
+
+    if items_filter is not None:
+        description_filter = regex_to_query_filter(description_key, items_filter)
+        if description_filter is not None:
+            filters.append(description_filter)
+
+    return filters
@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+from files import write_file_atomically
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+
+
+@dataclass
+class StoredEvent:
+    href: str
+    etag: Optional[str]
+    content_hash: str
+    dtstart: str
+
+
+@dataclass
+class SyncState:
+    """
+    What this tool last pushed to the calendar, so that unchanged events can be recognized without downloading them.
+    """
+    calendar_url: Optional[str] = None
+    sync_token: Optional[str] = None
+    ctag: Optional[str] = None
+    events: dict[str, StoredEvent] = field(default_factory=dict)
+    # The highest TrueNAS job ID that was fetched. Runs of the jobs up to it that were still running are fetched by their IDs.
+    job_cursor: int = 0
+    unfinished_job_ids: list[int] = field(default_factory=list)
+
+
+def load_state(path: Optional[str]) -> SyncState:
+    """
+    Loads the sync state from disk.
+
+    :param path: The path of the state file, or None to not persist state.
+    :type path: Optional[str]
+    :return: The stored state, or an empty state if there is none or it can't be read.
+    :rtype: SyncState
+    """
+    if path is None or not os.path.exists(path):
+        return SyncState()
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+
+        if raw.get("version") != STATE_VERSION:
+            logger.warning(f"Ignoring state file {path} with unsupported version {raw.get('version')}.")
+            return SyncState()
+
+        state = SyncState(raw["calendar_url"], raw["sync_token"], raw["ctag"], {uid: StoredEvent(**x) for uid, x in raw["events"].items()}, raw.get("job_cursor", 0), raw.get("unfinished_job_ids", []))
+        logger.info(f"Loaded state for {len(state.events)} events from {path}.")
+        return state
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable state file {path}: {e}")
+        return SyncState()
+
+
+def save_state(path: Optional[str], state: SyncState):
+    """
+    Atomically writes the sync state to disk.
+
+    :param path: The path of the state file, or None to not persist state.
+    :type path: Optional[str]
+    :param state: The state to write.
+    :type state: SyncState
+    """
+    if path is None:
+        return
+
+    write_file_atomically(path, json.dumps({"version": STATE_VERSION, **asdict(state)}, separators=(",", ":")).encode("utf-8"))
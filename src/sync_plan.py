@@ -0,0 +1,81 @@
+import logging
+from typing import Optional
+from event_plan import PlannedEvent, plan_events
+from ical_cache import ICalCache
+from options import Options
+from query_filters import build_query_filters
+from item_types import ITEM_TYPES
+from truenas_queries import QueryResult, QuerySpec
+
+logger = logging.getLogger(__name__)
+
+# Most tasks share a handful of schedules, so conversions are shared across items and sync cycles.
+ical_cache = ICalCache()
+
+
+def build_query_specs(options: Options, changed_ids: Optional[dict[str, set[int]]] = None) -> list[QuerySpec]:
+    """
+    Builds the TrueNAS queries for the included item types.
+
+    Only the fields that are actually used are fetched, since some items (cloudsync tasks especially) are huge.
+    The middleware also drops disabled items and whatever the filters can express as query-filters.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param changed_ids: The IDs of the items that changed keyed by query, to only fetch those. None fetches everything.
+    :type changed_ids: Optional[dict[str, set[int]]]
+    :rtype: list[QuerySpec]
+    """
+    query_specs: list[QuerySpec] = []
+    for item_type in ITEM_TYPES:
+        if not options.include[item_type.name]:
+            logger.info(f"Ignoring {item_type.name} items...")
+            continue
+
+        if changed_ids is not None and item_type.query not in changed_ids:
+            continue
+
+        filters = build_query_filters(item_type.enabled_key, item_type.description_key, options.filters[item_type.name])
+        if changed_ids is not None:
+            filters.append(["id", "in", sorted(changed_ids[item_type.query])])
+
+        select = ["id", "schedule", item_type.description_key] + ([item_type.enabled_key] if item_type.enabled_key is not None else [])
+        query_specs.append(QuerySpec(item_type.query, select, filters))
+
+    return query_specs
+
+
+def plan_all_events(options: Options, query_results: dict[str, QueryResult]) -> dict[str, list[PlannedEvent]]:
+    """
+    Works out the events for all fetched items.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :param query_results: The fetched items keyed by query.
+    :type query_results: dict[str, QueryResult]
+    :return: The events keyed by item type.
+    :rtype: dict[str, list[PlannedEvent]]
+    """
+    planned_events: dict[str, list[PlannedEvent]] = {}
+    for item_type in options.included_item_types():
+        if item_type.query not in query_results:
+            continue
+
+        logger.info(f"Creating events with summary prefix \"{item_type.name}\" from query \"{item_type.query}\".")
+        planned_events[item_type.name] = plan_events(query_results[item_type.query].items, item_type, options.filters[item_type.name], options.group_by_schedule)
+
+    return planned_events
+
+
+def get_job_methods(options: Options) -> list[str]:
+    """
+    Lists the TrueNAS job methods whose runs go on the calendar.
+
+    :param options: The parsed options for the synchronization.
+    :type options: Options
+    :rtype: list[str]
+    """
+    if not options.include_job_runs:
+        return []
+
+    return [method for item_type in options.included_item_types() for method in item_type.job_methods]
@@ -0,0 +1,191 @@
+import logging
+import os
+import tomllib
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Mapping, Optional
+from common import current_target
+from ics_export import IcsFeed
+from options import CONFIG_FILE_ENV, MAX_CONCURRENT_SYNCS_ENV, METRICS_PORT_ENV, OUTPUT_CALDAV, Options, parse_int, parse_string
+from state_store import SyncState, load_state
+
+if TYPE_CHECKING:
+    from calendar_snapshot import CalendarSnapshot
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SyncTarget:
+    """
+    A TrueNAS host synced to a calendar, along with what is kept between its syncs.
+    """
+    name: str
+    options: Options
+    state: SyncState
+    # Only CalDAV targets have a snapshot of their calendar.
+    snapshot: Optional["CalendarSnapshot"] = None
+    feed: IcsFeed = field(default_factory=IcsFeed)
+    # The queries that the TrueNAS of this target can't run with filters or a field selection.
+    queries_without_options: set[str] = field(default_factory=set)
+
+    def reset_snapshot(self):
+        """
+        Replaces the calendar snapshot with an empty one, so that the next sync downloads the whole index.
+        A fetch that timed out may still be filling the old snapshot in its worker thread, so it isn't reused.
+        """
+        if self.snapshot is not None:
+            from calendar_snapshot import CalendarSnapshot
+            self.snapshot = CalendarSnapshot()
+
+
+@dataclass
+class SyncConfig:
+    max_concurrent_syncs: int
+    targets: list[SyncTarget]
+    metrics_port: Optional[int] = None
+
+
+class TargetLogFilter(logging.Filter):
+    """
+    Prefixes log lines with the name of the target they were logged for, via the target_prefix record attribute.
+    Only does so once show_targets is set, since a single target has nothing to tell apart.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.show_targets = False
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        target = current_target.get()
+        record.target_prefix = "" if target is None or not self.show_targets else f"[{target}] "
+        return True
+
+
+def create_target(name: str, options: Options) -> SyncTarget:
+    """
+    Creates a sync target, loading its sync state.
+    Only CalDAV targets get a calendar snapshot, which is what imports the CalDAV client.
+
+    :param name: The name of the target.
+    :type name: str
+    :param options: The parsed options of the target.
+    :type options: Options
+    :rtype: SyncTarget
+    """
+    snapshot = None
+    if options.output == OUTPUT_CALDAV:
+        from calendar_snapshot import CalendarSnapshot
+        snapshot = CalendarSnapshot()
+
+    return SyncTarget(name, options, load_state(options.state_file), snapshot)
+
+
+def config_table_to_settings(table: Mapping[str, Any], section: str) -> dict[str, str]:
+    """
+    Converts a table of the config file to settings keyed by environment variable name.
+
+    :param table: The TOML table.
+    :type table: Mapping[str, Any]
+    :param section: Where the table is, for error messages.
+    :type section: str
+    :rtype: dict[str, str]
+    """
+    settings: dict[str, str] = {}
+    for key, value in table.items():
+        if isinstance(value, bool):
+            settings[key.upper()] = "true" if value else "false"
+        elif isinstance(value, (str, int, float)):
+            settings[key.upper()] = str(value)
+        else:
+            raise Exception(f"Setting {key} of {section} must be a string, number or boolean.")
+
+    return settings
+
+
+def validate_targets(targets: list[SyncTarget]):
+    """
+    Makes sure that no two targets would fight over the same calendar, file or port.
+    """
+    names: set[str] = set()
+    calendars: set[tuple[str, str, str]] = set()
+    files: set[str] = set()
+    ports: set[int] = set()
+
+    for target in targets:
+        options = target.options
+
+        if target.name in names:
+            raise Exception(f"More than one target is named \"{target.name}\".")
+
+        if options.output == OUTPUT_CALDAV:
+            calendar = (options.caldav_host, options.caldav_username, options.calendar_id)
+            if calendar in calendars:
+                raise Exception(f"Target \"{target.name}\" syncs to calendar {options.calendar_id} of {options.caldav_username}@{options.caldav_host}, which another target already syncs to.")
+
+            calendars.add(calendar)
+
+        for path in (x for x in (options.state_file, options.ics_file) if x is not None):
+            if os.path.abspath(path) in files:
+                raise Exception(f"Target \"{target.name}\" writes to {path}, which another target already writes to.")
+
+            files.add(os.path.abspath(path))
+
+        if options.ics_port is not None:
+            if options.ics_port in ports:
+                raise Exception(f"Target \"{target.name}\" serves its ICS feed on port {options.ics_port}, which another target already uses.")
+
+            ports.add(options.ics_port)
+
+        names.add(target.name)
+
+
+def load_config(path: str) -> SyncConfig:
+    """
+    Loads the sync targets from a TOML config file.
+
+    Every target is a table in the targets array, with the same settings as the environment variables (in any case) plus a name.
+    Settings missing from a target fall back to the defaults table, and then to the environment.
+
+    :param path: The path of the config file.
+    :type path: str
+    :rtype: SyncConfig
+    """
+    try:
+        with open(path, "rb") as f:
+            raw = tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        raise Exception(f"Failed to read config file {path}: {e}")
+
+    defaults = config_table_to_settings(raw.get("defaults", {}), "defaults")
+
+    targets: list[SyncTarget] = []
+    for i, table in enumerate(raw.get("targets", [])):
+        table = dict(table)
+        name = str(table.pop("name", f"target-{i + 1}"))
+        settings = {**os.environ, **defaults, **config_table_to_settings(table, f"target \"{name}\"")}
+        targets.append(create_target(name, Options.from_mapping(settings)))
+
+    if len(targets) == 0:
+        raise Exception(f"Config file {path} does not define any targets.")
+
+    validate_targets(targets)
+
+    settings = {**os.environ, **config_table_to_settings({x: raw[x] for x in ("max_concurrent_syncs", "metrics_port") if x in raw}, "the config file")}
+    max_concurrent_syncs = parse_int(MAX_CONCURRENT_SYNCS_ENV, False, 4, 1, source=settings)
+    metrics_port = parse_int(METRICS_PORT_ENV, False, None, 1, source=settings)
+
+    logger.info(f"Loaded {len(targets)} targets from {path}: {', '.join(x.name for x in targets)}.")
+    return SyncConfig(max_concurrent_syncs, targets, metrics_port)
+
+
+def load_config_from_env() -> SyncConfig:
+    """
+    Loads the sync targets from the config file named by CONFIG_FILE, or a single target from the environment if there is none.
+
+    :rtype: SyncConfig
+    """
+    config_file = parse_string(CONFIG_FILE_ENV, False, None)
+    if config_file is not None:
+        return load_config(config_file)
+
+    return SyncConfig(parse_int(MAX_CONCURRENT_SYNCS_ENV, False, 4, 1), [create_target("default", Options.from_env())], parse_int(METRICS_PORT_ENV, False, None, 1))
@@ -0,0 +1,15 @@
+from backoff import Backoff
+
+
+def test_delay_doubles_up_to_the_maximum():
+    backoff = Backoff(10, 60)
+    for ceiling in (10, 20, 40, 60, 60):
+        assert ceiling / 2 <= backoff.next_delay() <= ceiling
+
+
+def test_reset_starts_over():
+    backoff = Backoff(10, 60)
+    backoff.next_delay()
+    backoff.next_delay()
+    backoff.reset()
+    assert backoff.next_delay() <= 10
@@ -0,0 +1,173 @@
+import asyncio
+import pytest
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from caldav.calendarobjectresource import Event
+from caldav.davclient import DAVClient
+from caldav.lib import error
+from calendar_snapshot import RemoteEvent
+from calendar_writes import WRITE_CREATE
+from caldav_sync import create_events, create_run_events, download_event_bodies, fetch_calendar, remembered_calendar
+from event_diff import SyncCounts
+from event_plan import PlannedEvent
+from options import CALDAV_HOST_ENV, CALDAV_PASSWORD_ENV, CALDAV_USERNAME_ENV, CALENDAR_ID_ENV, FETCH_TIMEOUT_ENV, TRUENAS_API_KEY_ENV, TRUENAS_HOST_ENV, Options
+from state_store import StoredEvent, SyncState
+
+CALENDAR_URL = "http://localhost:5232/u/truenas-jobs/"
+
+
+def make_options(fetch_timeout: str = "5 minutes") -> Options:
+    return Options.from_mapping({CALDAV_HOST_ENV: "http://localhost:5232/u/", CALDAV_USERNAME_ENV: "u", CALDAV_PASSWORD_ENV: "p", CALENDAR_ID_ENV: "truenas-jobs", TRUENAS_HOST_ENV: "nas.lan", TRUENAS_API_KEY_ENV: "key", FETCH_TIMEOUT_ENV: fetch_timeout})
+
+
+class FakeDAVClient(DAVClient):
+    """
+    Lists a single calendar named like the configured one, without sending requests.
+    """
+
+    def __init__(self):
+        super().__init__(url="http://localhost:5232/u/")
+        self.found = self.calendar(url="http://localhost:5232/u/moved/truenas-jobs/", id="truenas-jobs")
+        self.discoveries = 0
+
+    def principal(self, *args, **kwargs):
+        self.discoveries += 1
+        return SimpleNamespace(calendars=lambda: [SimpleNamespace(id="personal"), self.found])
+
+
+class FakeSnapshot:
+    """
+    Fails to fetch the calendar where it was found before, like after the calendar was removed.
+    """
+
+    def __init__(self, calendar_url: str):
+        self.calendar_url = calendar_url
+        self.fetched: list = []
+        self.invalidated = False
+
+    def invalidate(self):
+        self.invalidated = True
+
+    def fetch(self, calendar, known_uids):
+        self.fetched.append(calendar)
+        if str(calendar.url) == self.calendar_url:
+            raise error.NotFoundError("Gone")
+
+        return []
+
+
+def test_calendar_is_only_remembered_on_the_same_server_with_the_same_id():
+    options = make_options()
+    dav_client = DAVClient(url="http://localhost:5232/u/")
+
+    calendar = remembered_calendar(options, dav_client, CALENDAR_URL)
+    assert calendar is not None and str(calendar.url) == CALENDAR_URL
+    assert remembered_calendar(options, dav_client, CALENDAR_URL.rstrip("/")) is not None
+
+    assert remembered_calendar(options, dav_client, None) is None
+    assert remembered_calendar(options, dav_client, "http://other:5232/u/truenas-jobs/") is None
+    # A calendar of another user on the same host, and a prefix of the server URL that isn't a path segment.
+    assert remembered_calendar(options, dav_client, "http://localhost:5232/v/truenas-jobs/") is None
+    assert remembered_calendar(options, dav_client, "http://localhost:5232/u2/truenas-jobs/") is None
+    assert remembered_calendar(options, dav_client, "http://localhost:5232/u/personal/") is None
+
+
+def test_calendar_is_looked_for_again_when_it_cant_be_fetched_where_it_was_found():
+    dav_client = FakeDAVClient()
+    snapshot = FakeSnapshot(CALENDAR_URL)
+
+    calendar, event_index = fetch_calendar(make_options(), dav_client, SyncState(), snapshot)  # type: ignore
+
+    assert calendar is dav_client.found
+    assert dav_client.discoveries == 1
+    assert snapshot.invalidated
+    assert [str(x.url) for x in snapshot.fetched] == [CALENDAR_URL, str(dav_client.found.url)]
+    assert len(event_index) == 0
+
+
+def test_fetch_errors_are_raised_when_the_calendar_was_just_found():
+    dav_client = FakeDAVClient()
+    snapshot = FakeSnapshot(str(dav_client.found.url))
+    snapshot.calendar_url = None  # type: ignore
+
+    def fail(calendar, known_uids):
+        raise error.AuthorizationError("Forbidden")
+
+    snapshot.fetch = fail  # type: ignore
+    with pytest.raises(error.AuthorizationError):
+        fetch_calendar(make_options(), dav_client, SyncState(), snapshot)  # type: ignore
+
+    assert dav_client.discoveries == 1
+    assert not snapshot.invalidated
+
+
+class SlowCalendar:
+    """
+    Takes a while to answer calendar-multiget, like a big calendar on a slow server.
+    """
+
+    def multiget(self, urls):
+        time.sleep(2)
+        return []
+
+
+def test_event_bodies_are_downloaded_off_the_event_loop_within_the_fetch_timeout():
+    events = [RemoteEvent("http://localhost:80/calendar/truenas-snapshot-1.ics", "truenas-snapshot-1", None, Event(url="http://localhost:80/calendar/truenas-snapshot-1.ics"))]
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.1)
+            ticks += 1
+
+    async def download():
+        ticker = asyncio.create_task(tick())
+        try:
+            await download_event_bodies(make_options("1 second"), SlowCalendar(), {x.uid: x for x in events}, [x.uid for x in events], SyncState())  # type: ignore
+        finally:
+            ticker.cancel()
+
+    with pytest.raises(Exception, match="took longer than"):
+        asyncio.run(download())
+
+    # The event loop kept running while the events were downloaded.
+    assert ticks >= 5
+
+
+class EmptiedCalendar:
+    """
+    Lost all its events since its index was fetched.
+    """
+
+    def multiget(self, urls):
+        return []
+
+
+def make_remote_event(uid: str) -> RemoteEvent:
+    url = f"http://localhost:80/calendar/{uid}.ics"
+    return RemoteEvent(url, uid, "\"1\"", Event(url=url))
+
+
+def test_events_removed_before_their_bodies_were_downloaded_are_saved_again():
+    events = {"truenas-snapshot-1": make_remote_event("truenas-snapshot-1")}
+    # The ETag doesn't match, so the event has to be downloaded.
+    state = SyncState(events={"truenas-snapshot-1": StoredEvent(events["truenas-snapshot-1"].href, "\"0\"", "hash", "2025-01-01T00:00:00+00:00")})
+    writes: list = []
+
+    saved = asyncio.run(create_events(make_options(), [PlannedEvent("truenas-snapshot-1", "0 0 * * *", "Snapshot: tank", None)], events, state, EmptiedCalendar(), SyncCounts(), writes))  # type: ignore
+
+    assert saved == {"truenas-snapshot-1"}
+    assert [(x.uid, x.action) for x in writes] == [("truenas-snapshot-1", WRITE_CREATE)]
+    assert events == {} and state.events == {}
+
+
+def test_run_events_removed_before_their_bodies_were_downloaded_are_forgotten():
+    events = {"truenas-run-1-1": make_remote_event("truenas-run-1-1")}
+    state = SyncState()
+    writes: list = []
+
+    asyncio.run(create_run_events(make_options(), [], events, state, EmptiedCalendar(), datetime.now(timezone.utc), writes))  # type: ignore
+
+    assert events == {} and writes == []
@@ -0,0 +1,188 @@
+from types import SimpleNamespace
+from caldav.calendarobjectresource import Event
+from caldav.elements import cdav, dav
+from caldav.lib import error
+from caldav.lib.url import URL
+from lxml import etree
+from common import UID_PREFIX
+from calendar_snapshot import CalendarSnapshot, GetCTag, RemoteEvent, build_index_query, load_event_bodies, parse_uid
+
+
+def make_data(uid: str) -> str:
+    return f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//test//test//EN\r\nBEGIN:VEVENT\r\nUID:{uid}\r\nDTSTART:20250101T000000Z\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+
+
+def test_uid_is_found_without_parsing_the_event():
+    assert parse_uid(make_data("truenas-snapshot-1")) == "truenas-snapshot-1"
+    # Folded lines, lowercase names and a timezone before the event.
+    assert parse_uid("BEGIN:VCALENDAR\nBEGIN:VTIMEZONE\nTZID:UTC\nEND:VTIMEZONE\nBEGIN:VEVENT\nuid:truenas-scrub-group-\n 0123456789abcdef\nEND:VEVENT\nEND:VCALENDAR\n") == "truenas-scrub-group-0123456789abcdef"
+    assert parse_uid("BEGIN:VCALENDAR\r\nBEGIN:VTODO\r\nUID:todo-1\r\nEND:VTODO\r\nEND:VCALENDAR\r\n") is None
+    assert parse_uid("") is None
+
+
+def test_index_query_filters_by_uid_only_when_asked_to():
+    filtered = str(build_index_query("truenas-"))
+    assert "prop-filter" in filtered and "truenas-" in filtered and "getetag" in filtered
+    assert "prop-filter" not in str(build_index_query(None))
+
+
+class FakeCalendar:
+    def __init__(self):
+        self.batches: list[list[str]] = []
+
+    def multiget(self, urls):
+        self.batches.append([str(x) for x in urls])
+        # The second event was removed in the meantime.
+        return [Event(url=x, data=make_data(str(x).split("/")[-1][:-len(".ics")])) for x in urls if not str(x).endswith("-2.ics")]
+
+
+def test_event_bodies_are_downloaded_in_batches():
+    calendar = FakeCalendar()
+    # Like the hrefs in the snapshot, the URLs are canonical.
+    urls = [f"http://localhost:80/calendar/truenas-snapshot-{x}.ics" for x in range(5)]
+    events = [RemoteEvent(x, x.split("/")[-1][:-len(".ics")], None, Event(url=x)) for x in urls]
+    events[4].event.data = make_data("truenas-snapshot-4")
+
+    load_event_bodies(calendar, events, 2)  # type: ignore
+
+    assert calendar.batches == [urls[:2], urls[2:4]]
+    assert [x.event.data is not None for x in events] == [True, True, False, True, True]
+    assert str(events[3].component.get("uid")) == "truenas-snapshot-3"
+
+
+class SyncUpdates(list):
+    def __init__(self, objects, sync_token: str):
+        super().__init__(objects)
+        self.sync_token = sync_token
+
+
+class FakeCalendarServer:
+    """
+    A calendar and the client to reach it. Answers the REPORTs that CalendarSnapshot sends from a dict of events, and keeps a log of changes for sync tokens.
+    """
+
+    def __init__(self, supports_sync_tokens: bool = True, supports_uid_filter: bool = True):
+        self.url = URL.objectify("http://localhost/calendar/")
+        self.client = self
+        self.supports_sync_tokens = supports_sync_tokens
+        self.supports_uid_filter = supports_uid_filter
+        # The UID and ETag of every event keyed by its path.
+        self.events: dict[str, tuple[str, str]] = {}
+        self.changes: list[str] = []
+        self.ctag = "ctag-0"
+        self.reports: list[str] = []
+        self.multiget_paths: list[str] = []
+
+    def put(self, name: str, uid: str, etag: str):
+        self.events[f"/calendar/{name}.ics"] = (uid, etag)
+        self.changes.append(f"/calendar/{name}.ics")
+        self.ctag = f"ctag-{len(self.changes)}"
+
+    def delete(self, name: str):
+        del self.events[f"/calendar/{name}.ics"]
+        self.changes.append(f"/calendar/{name}.ics")
+        self.ctag = f"ctag-{len(self.changes)}"
+
+    def objects_by_sync_token(self, sync_token=None, load_objects=False):
+        if not self.supports_sync_tokens or (sync_token is not None and not sync_token.startswith("token-")):
+            raise error.ReportError("Sync tokens are not supported")
+
+        since = 0 if sync_token is None else int(sync_token[len("token-"):])
+        changed = [] if sync_token is None else list(dict.fromkeys(self.changes[since:]))
+        return SyncUpdates([SimpleNamespace(url=self.url.join(x), props={dav.GetEtag.tag: self.events[x][1] if x in self.events else None}) for x in changed], f"token-{len(self.changes)}")
+
+    def get_property(self, prop):
+        assert isinstance(prop, GetCTag)
+        return self.ctag
+
+    def report(self, url, body, depth):
+        root = etree.fromstring(body)
+        self.reports.append(etree.QName(root).localname)
+
+        if root.find(f".//{cdav.PropFilter.tag}") is not None:
+            if not self.supports_uid_filter:
+                return SimpleNamespace(status=400, reason="Bad Request", raw="")
+            paths = [x for x, (uid, _) in self.events.items() if UID_PREFIX in uid]
+        elif etree.QName(root).localname == "calendar-multiget":
+            self.multiget_paths.extend(x.text for x in root.iter(dav.Href.tag))
+            paths = [x for x in self.multiget_paths if x in self.events]
+        else:
+            paths = list(self.events)
+
+        results = {x: {dav.GetEtag.tag: self.events[x][1], cdav.CalendarData.tag: make_data(self.events[x][0])} for x in paths}
+        return SimpleNamespace(status=207, expand_simple_props=lambda props: results)
+
+
+def indexed(events: list[RemoteEvent]) -> dict[str, tuple[str, str | None]]:
+    return {x.href.split("/")[-1]: (x.uid, x.etag) for x in events}
+
+
+def test_changes_are_fetched_with_the_sync_token_and_only_new_uids_are_looked_up():
+    server = FakeCalendarServer()
+    server.put("a", "truenas-snapshot-1", "a1")
+    server.put("b", "birthday", "b1")
+    server.put("c", "truenas-scrub-2", "c1")
+    snapshot = CalendarSnapshot()
+
+    assert indexed(snapshot.fetch(server)) == {"a.ics": ("truenas-snapshot-1", "a1"), "c.ics": ("truenas-scrub-2", "c1")}  # type: ignore
+    assert server.reports == ["calendar-query"]
+
+    server.put("a", "truenas-snapshot-1", "a2")
+    server.put("b", "birthday", "b2")
+    # Saved by the last sync, but its change wasn't seen yet.
+    server.put("d", "truenas-cloudsync-3", "d1")
+    server.put("e", "truenas-rsync-4", "e1")
+    # Deletions are reported without an ETag, also for events that were never indexed.
+    server.delete("c")
+    server.put("f", "dentist", "f1")
+    server.delete("f")
+    server.reports = []
+
+    events = snapshot.fetch(server, {"http://localhost:80/calendar/d.ics": "truenas-cloudsync-3"})  # type: ignore
+
+    assert indexed(events) == {"a.ics": ("truenas-snapshot-1", "a2"), "d.ics": ("truenas-cloudsync-3", "d1"), "e.ics": ("truenas-rsync-4", "e1")}
+    # Only the events whose UIDs are unknown are looked up.
+    assert server.reports == ["calendar-multiget"]
+    assert server.multiget_paths == ["/calendar/b.ics", "/calendar/e.ics"]
+    assert snapshot.sync_token == f"token-{len(server.changes)}"
+    assert all(x.event.client is server and x.event.data is None for x in events)
+
+
+def test_rejected_sync_token_falls_back_to_a_full_fetch():
+    server = FakeCalendarServer()
+    server.put("a", "truenas-snapshot-1", "a1")
+    snapshot = CalendarSnapshot()
+    snapshot.restore("http://localhost:80/calendar/", "expired", None, [("http://localhost:80/calendar/gone.ics", "truenas-scrub-2", "g1")])
+
+    assert indexed(snapshot.fetch(server)) == {"a.ics": ("truenas-snapshot-1", "a1")}  # type: ignore
+    assert server.reports == ["calendar-query"]
+    assert snapshot.sync_token == "token-1"
+
+
+def test_without_sync_tokens_the_index_is_reused_while_the_ctag_is_unchanged():
+    server = FakeCalendarServer(supports_sync_tokens=False)
+    server.put("a", "truenas-snapshot-1", "a1")
+    snapshot = CalendarSnapshot()
+
+    assert indexed(snapshot.fetch(server)) == {"a.ics": ("truenas-snapshot-1", "a1")}  # type: ignore
+    assert (snapshot.sync_token, snapshot.ctag) == (None, "ctag-1")
+
+    assert indexed(snapshot.fetch(server)) == {"a.ics": ("truenas-snapshot-1", "a1")}  # type: ignore
+    assert server.reports == ["calendar-query"]
+
+    server.put("a", "truenas-snapshot-1", "a2")
+    assert indexed(snapshot.fetch(server)) == {"a.ics": ("truenas-snapshot-1", "a2")}  # type: ignore
+    assert server.reports == ["calendar-query", "calendar-query"]
+    assert snapshot.ctag == "ctag-2"
+
+
+def test_servers_without_uid_filters_get_every_uid_and_only_truenas_events_are_kept():
+    server = FakeCalendarServer(supports_uid_filter=False)
+    server.put("a", "truenas-snapshot-1", "a1")
+    server.put("b", "birthday", "b1")
+    # Would match the UID filter, which matches anywhere in the UID.
+    server.put("c", "backup-truenas-1", "c1")
+    snapshot = CalendarSnapshot()
+
+    assert indexed(snapshot.fetch(server)) == {"a.ics": ("truenas-snapshot-1", "a1")}  # type: ignore
+    assert server.reports == ["calendar-query", "calendar-query"]
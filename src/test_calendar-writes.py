@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import time
+from requests.auth import HTTPBasicAuth
+from calendar_writes import WRITE_CREATE, WRITE_DELETE, CalendarWrite, count_writes, create_dav_auth, run_writes
+from event_diff import SyncCounts
+
+
+def test_failed_writes_are_reported_without_stopping_the_others():
+    performed = []
+
+    def succeed(uid):
+        return lambda: performed.append(uid)
+
+    def fail():
+        raise Exception("Service Unavailable")
+
+    writes = [
+        CalendarWrite("truenas-scrub-1", WRITE_CREATE, succeed("truenas-scrub-1")),
+        CalendarWrite("truenas-scrub-2", WRITE_CREATE, fail),
+        CalendarWrite("truenas-scrub-3", WRITE_DELETE, succeed("truenas-scrub-3")),
+    ]
+    failures = asyncio.run(run_writes(writes, 2))
+
+    assert sorted(performed) == ["truenas-scrub-1", "truenas-scrub-3"]
+    assert [x.write.uid for x in failures] == ["truenas-scrub-2"]
+    assert str(failures[0].error) == "Service Unavailable"
+
+    counts = SyncCounts()
+    count_writes(writes, failures, counts)
+    assert counts == SyncCounts(created=1, deleted=1)
+
+
+def test_writes_in_flight_are_bounded():
+    lock = threading.Lock()
+    in_flight = [0]
+    most_in_flight = [0]
+
+    def perform():
+        with lock:
+            in_flight[0] += 1
+            most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+
+    writes = [CalendarWrite(f"truenas-scrub-{x}", WRITE_CREATE, perform) for x in range(8)]
+    assert asyncio.run(run_writes(writes, 3)) == []
+    assert most_in_flight[0] == 3
+
+
+def test_auth_is_only_created_up_front_with_an_auth_type():
+    assert create_dav_auth(None, "truenas", "secret") is None
+    auth = create_dav_auth("basic", "truenas", "secret")
+    assert isinstance(auth, HTTPBasicAuth) and (auth.username, auth.password) == ("truenas", "secret")
@@ -0,0 +1,30 @@
+import asyncio
+from change_subscriptions import ChangeCollector
+
+
+def test_no_changes_times_out():
+    async def run():
+        return await ChangeCollector(asyncio.get_running_loop()).wait(0.01, 0)
+
+    assert asyncio.run(run()) is None
+
+
+def test_changes_are_grouped_by_query():
+    async def run():
+        collector = ChangeCollector(asyncio.get_running_loop())
+        callback = collector.callback_for("pool.scrub.query")
+        callback("CHANGED", id=1, fields={})
+        callback("ADDED", {"id": 2, "fields": {}})
+        await asyncio.to_thread(collector.add, "cronjob.query", 3)
+        return await collector.wait(1, 0), await collector.wait(0.01, 0)
+
+    assert asyncio.run(run()) == ((False, {"pool.scrub.query": {1, 2}, "cronjob.query": {3}}), None)
+
+
+def test_change_without_id_needs_full_sync():
+    async def run():
+        collector = ChangeCollector(asyncio.get_running_loop())
+        collector.callback_for("cloudsync.query")("CHANGED")
+        return await collector.wait(1, 0)
+
+    assert asyncio.run(run()) == (True, {})
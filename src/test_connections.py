@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+from typing import Any
+import caldav.davclient
+import requests
+from requests.adapters import HTTPAdapter
+import connections
+from connections import ConnectionManager
+from options import CALDAV_HOST_ENV, CALDAV_PASSWORD_ENV, CALDAV_USERNAME_ENV, CALENDAR_ID_ENV, TRUENAS_API_KEY_ENV, TRUENAS_HOST_ENV, Options
+
+
+def make_options() -> Options:
+    return Options.from_mapping({CALDAV_HOST_ENV: "localhost:5232", CALDAV_USERNAME_ENV: "u", CALDAV_PASSWORD_ENV: "p", CALENDAR_ID_ENV: "truenas-jobs", TRUENAS_HOST_ENV: "nas.lan", TRUENAS_API_KEY_ENV: "key"})
+
+
+class FakeTrueNASClient:
+    """
+    Logs in with any API key and answers pings until it is disconnected.
+    """
+
+    def __init__(self, uri: str, verify_ssl: bool = True):
+        self.uri = uri
+        self.connected = True
+        self.closed = False
+        self.calls: list[str] = []
+
+    def call(self, method: str, *params: Any) -> Any:
+        self.calls.append(method)
+        if not self.connected:
+            raise ConnectionError("Connection lost")
+
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDAVClient:
+    def __init__(self, url: str):
+        self.url = url
+        self.session = requests.Session()
+        self.status = 200
+        self.closed = False
+
+    def options(self, url: str):
+        return SimpleNamespace(status=self.status)
+
+    def close(self):
+        self.closed = True
+
+
+def test_truenas_connection_is_reused_while_it_responds_to_pings(monkeypatch):
+    monkeypatch.setattr(connections, "Client", FakeTrueNASClient)
+    manager = ConnectionManager(make_options(), None)
+
+    client = manager.truenas_client()
+    assert client.calls == ["auth.login_with_api_key"]  # type: ignore
+    assert manager.truenas_client() is client
+    assert client.calls == ["auth.login_with_api_key", "core.ping"]  # type: ignore
+
+
+def test_failed_truenas_ping_reconnects_and_logs_in_again(monkeypatch):
+    monkeypatch.setattr(connections, "Client", FakeTrueNASClient)
+    manager = ConnectionManager(make_options(), None)
+
+    client = manager.truenas_client()
+    client.connected = False  # type: ignore
+
+    new_client = manager.truenas_client()
+    assert new_client is not client
+    assert client.closed  # type: ignore
+    assert new_client.calls == ["auth.login_with_api_key"]  # type: ignore
+
+
+def test_failed_caldav_ping_reconnects_through_the_shared_connection_pool(monkeypatch):
+    monkeypatch.setattr(caldav.davclient, "get_davclient", lambda url, **kwargs: FakeDAVClient(url))
+    adapter = HTTPAdapter()
+    manager = ConnectionManager(make_options(), adapter)
+
+    client = manager.dav_client()
+    assert client.url == "http://localhost:5232"
+    assert manager.dav_client() is client
+
+    client.status = 503  # type: ignore
+    new_client = manager.dav_client()
+    assert new_client is not client
+    assert client.closed  # type: ignore
+    assert new_client.session.get_adapter("http://localhost:5232") is adapter
+    # The pool stays open for the other targets on the same server.
+    assert client.session.adapters == {}
+
+
+def test_reset_drops_both_clients(monkeypatch):
+    monkeypatch.setattr(connections, "Client", FakeTrueNASClient)
+    monkeypatch.setattr(caldav.davclient, "get_davclient", lambda url, **kwargs: FakeDAVClient(url))
+    manager = ConnectionManager(make_options(), HTTPAdapter())
+    truenas_client = manager.truenas_client()
+    dav_client = manager.dav_client()
+
+    manager.reset()
+
+    assert truenas_client.closed and dav_client.closed  # type: ignore
+    assert manager.truenas_client() is not truenas_client
+    assert manager.dav_client() is not dav_client
+    # A reset without clients does nothing.
+    ConnectionManager(make_options(), None).reset()
@@ -1,4 +1,13 @@
-from cron_to_ical import cron_to_ical, FREQ_MINUTELY, FREQ_HOURLY, FREQ_WEEKLY, FREQ_DAILY, FREQ_MONTHLY, FREQ_YEARLY
+import random
+import time
+from datetime import datetime, timedelta
+import pytest
+import recurring_ical_events
+from cron_converter import Cron
+from icalendar import Calendar, Event
+import local_timezone
+from local_timezone import LocalTimezoneResolver
+from cron_to_ical import ICalResult, cron_to_ical, FREQ_MINUTELY, FREQ_HOURLY, FREQ_WEEKLY, FREQ_DAILY, FREQ_MONTHLY, FREQ_YEARLY
 
 
 def test_every_minute():
@@ -68,8 +77,102 @@ def test_every_other_day_of_month_at_midnight():
     assert len(res.rrule) == 4
 
 
-def test_every_10_minutes():
+def test_every_10_minutes_keeps_its_freq():
     res = cron_to_ical("*/10 * * * *")
     assert res.rrule["FREQ"] == FREQ_HOURLY
     assert res.rrule["BYMINUTE"] == [0, 10, 20, 30, 40, 50]
     assert len(res.rrule) == 2
+
+
+def test_every_2_hours_on_mondays_keeps_its_freq():
+    res = cron_to_ical("15 */2 * * mon")
+    assert res.rrule["FREQ"] == FREQ_WEEKLY
+    assert res.rrule["BYHOUR"] == list(range(0, 24, 2))
+    assert "INTERVAL" not in res.rrule
+
+
+def test_every_15_minutes_in_hour_2_keeps_its_freq():
+    res = cron_to_ical("*/15 2 * * *")
+    assert res.rrule["FREQ"] == FREQ_DAILY
+    assert res.rrule["BYHOUR"] == [2]
+    assert res.rrule["BYMINUTE"] == [0, 15, 30, 45]
+    assert "INTERVAL" not in res.rrule
+
+    assert cron_to_ical("0 */2 * * *").rrule["FREQ"] == FREQ_DAILY
+
+
+def test_first_of_every_quarter():
+    res = cron_to_ical("0 0 1 */3 *")
+    assert res.rrule["FREQ"] == FREQ_MONTHLY
+    assert res.rrule["INTERVAL"] == 3
+    assert res.rrule["BYMONTHDAY"] == [1]
+    assert len(res.rrule) == 5
+
+
+def test_every_7_minutes_stays_literal():
+    res = cron_to_ical("*/7 * * * *")
+    assert res.rrule["FREQ"] == FREQ_HOURLY
+    assert res.rrule["BYMINUTE"] == [0, 7, 14, 21, 28, 35, 42, 49, 56]
+    assert len(res.rrule) == 2
+
+
+def random_cron_field(rng: random.Random, low: int, high: int) -> str:
+    kind = rng.randrange(5)
+    if kind == 0:
+        return "*"
+
+    if kind == 1:
+        return f"*/{rng.randint(2, (high - low + 1) // 2)}"
+
+    if kind == 2:
+        step = rng.randint(2, (high - low + 1) // 2)
+        return f"{rng.randint(low, low + step - 1)}-{high}/{step}"
+
+    if kind == 3:
+        return str(rng.randint(low, high))
+
+    return ",".join(str(x) for x in sorted(rng.sample(range(low, high + 1), rng.randint(2, 4))))
+
+
+def random_cron(rng: random.Random) -> str:
+    fields = [random_cron_field(rng, 0, 59), random_cron_field(rng, 0, 23), random_cron_field(rng, 1, 31), random_cron_field(rng, 1, 12), random_cron_field(rng, 0, 6)]
+    # Leave out schedules that might never fire (i.e. the 31st of February).
+    if fields[2] != "*" and fields[3] != "*":
+        fields[2] = random_cron_field(rng, 1, 28)
+    return " ".join(fields)
+
+
+def rule_occurrences(res: ICalResult, end: datetime) -> list[datetime]:
+    event = Event()
+    event.add("uid", "truenas-test-1")
+    event.add("dtstart", res.start)
+    event.add("dtend", res.end)
+    event.add("rrule", res.rrule)
+    calendar = Calendar()
+    calendar.add_component(event)
+    return [x["DTSTART"].dt for x in recurring_ical_events.of(calendar).between(res.start, end + timedelta(seconds=1))]
+
+
+def cron_occurrences(cron: str, start: datetime, count: int) -> list[datetime]:
+    schedule = Cron(cron).schedule(start_date=start)
+    return sorted(schedule.next() for _ in range(count))
+
+
+@pytest.fixture
+def utc(monkeypatch):
+    # Keep DST transitions out of it, since cron and iCal disagree on those regardless of the rule.
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    monkeypatch.setattr(local_timezone, "_resolver", LocalTimezoneResolver())
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_rrule_has_the_same_occurrences_as_cron(seed, utc):
+    cron = random_cron(random.Random(seed))
+    res = cron_to_ical(cron)
+    expected = cron_occurrences(cron, res.start, 30)
+    assert rule_occurrences(res, expected[-1]) == expected, f"{cron} -> {res.rrule}"
+
@@ -0,0 +1,86 @@
+from datetime import timedelta
+import pytest
+from icalendar import Event
+from cron_to_ical import ICalResult, cron_to_ical
+from event_diff import apply_ical_to_component, event_content_hash, is_event_up_to_date, is_stored_event_up_to_date
+from state_store import StoredEvent
+
+
+def make_component(cron: str, summary: str) -> Event:
+    ical = cron_to_ical(cron)
+    component = Event()
+    component.add("uid", "truenas-snapshot-1")
+    apply_ical_to_component(component, ical, summary)
+    return Event.from_ical(component.to_ical())
+
+
+def test_saved_event_is_up_to_date():
+    component = make_component("0 0 * * *", "Snapshot: tank")
+    assert is_event_up_to_date(component, cron_to_ical("0 0 * * *"), "Snapshot: tank")
+
+
+def test_older_occurrence_as_dtstart_is_up_to_date():
+    ical = cron_to_ical("0 * * * *")
+    component = make_component("0 * * * *", "Snapshot: tank")
+    apply_ical_to_component(component, ical, "Snapshot: tank")
+    component.pop("dtstart")
+    component.add("dtstart", ical.start - timedelta(hours=3))
+    component.pop("dtend")
+    component.add("dtend", ical.start - timedelta(hours=3))
+    assert is_event_up_to_date(component, ical, "Snapshot: tank")
+
+    component.pop("dtstart")
+    component.add("dtstart", ical.start - timedelta(minutes=30))
+    component.pop("dtend")
+    component.add("dtend", ical.start - timedelta(minutes=30))
+    assert not is_event_up_to_date(component, ical, "Snapshot: tank")
+
+
+def test_changed_schedule_or_summary_is_not_up_to_date():
+    component = make_component("0 0 * * *", "Snapshot: tank")
+    assert not is_event_up_to_date(component, cron_to_ical("0 1 * * *"), "Snapshot: tank")
+    assert not is_event_up_to_date(component, cron_to_ical("0 0 * * *"), "Snapshot: tank/data")
+
+    apply_ical_to_component(component, cron_to_ical("0 1 * * *"), "Snapshot: tank/data")
+    assert is_event_up_to_date(component, cron_to_ical("0 1 * * *"), "Snapshot: tank/data")
+
+
+def test_stored_event_is_only_trusted_with_a_matching_etag():
+    ical = cron_to_ical("0 * * * *")
+    stored = StoredEvent("http://localhost/calendar/truenas-snapshot-1.ics", "\"1\"", event_content_hash(ical, "Snapshot: tank"), (ical.start - timedelta(hours=2)).isoformat())
+    assert is_stored_event_up_to_date(stored, "\"1\"", ical, "Snapshot: tank")
+    assert not is_stored_event_up_to_date(stored, "\"2\"", ical, "Snapshot: tank")
+    assert not is_stored_event_up_to_date(stored, "\"1\"", ical, "Snapshot: tank/data")
+
+
+def test_changed_description_is_not_up_to_date():
+    ical = cron_to_ical("0 * * * *")
+    component = make_component("0 * * * *", "Snapshot: tank and 1 more")
+    apply_ical_to_component(component, ical, "Snapshot: tank and 1 more", "tank\ntank/media")
+    assert is_event_up_to_date(component, ical, "Snapshot: tank and 1 more", "tank\ntank/media")
+    assert not is_event_up_to_date(component, ical, "Snapshot: tank and 1 more", "tank\ntank/photos")
+    assert event_content_hash(ical, "Snapshot: tank and 1 more", "tank\ntank/media") != event_content_hash(ical, "Snapshot: tank and 1 more", "tank\ntank/photos")
+
+
+@pytest.mark.parametrize("cron,shifted", [("0 */2 * * *", "0 1-23/2 * * *"), ("*/15 * * * *", "5-59/15 * * * *"), ("0 0 1 */3 *", "0 0 1 2-12/3 *")])
+def test_schedule_shifted_within_its_interval_is_not_up_to_date(cron, shifted):
+    ical = cron_to_ical(cron)
+    component = make_component(cron, "Snapshot: tank")
+    stored = StoredEvent("http://localhost/calendar/truenas-snapshot-1.ics", "\"1\"", event_content_hash(ical, "Snapshot: tank"), ical.start.isoformat())
+    assert is_event_up_to_date(component, ical, "Snapshot: tank")
+    assert is_stored_event_up_to_date(stored, "\"1\"", ical, "Snapshot: tank")
+
+    shifted_ical = cron_to_ical(shifted)
+    assert not is_event_up_to_date(component, shifted_ical, "Snapshot: tank")
+    assert not is_stored_event_up_to_date(stored, "\"1\"", shifted_ical, "Snapshot: tank")
+
+
+def test_older_dtstart_in_the_same_interval_phase_is_up_to_date():
+    ical = cron_to_ical("0 */2 * * *")
+    older = ICalResult(ical.start - timedelta(hours=4), ical.end - timedelta(hours=4), ical.rrule)
+    component = make_component("0 */2 * * *", "Snapshot: tank")
+    apply_ical_to_component(component, older, "Snapshot: tank")
+    assert is_event_up_to_date(component, ical, "Snapshot: tank")
+
+    stored = StoredEvent("http://localhost/calendar/truenas-snapshot-1.ics", "\"1\"", event_content_hash(older, "Snapshot: tank"), older.start.isoformat())
+    assert is_stored_event_up_to_date(stored, "\"1\"", ical, "Snapshot: tank")
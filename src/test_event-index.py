@@ -0,0 +1,23 @@
+from caldav.calendarobjectresource import Event
+from calendar_snapshot import RemoteEvent, remote_event_from_event
+from common import ITEM_TYPE_SCRUB, ITEM_TYPE_SNAPSHOT
+from event_index import EventIndex
+
+
+def make_event(uid: str) -> RemoteEvent:
+    return remote_event_from_event(Event(url=f"http://localhost/calendar/{uid}.ics", data=f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//test//test//EN\r\nBEGIN:VEVENT\r\nUID:{uid}\r\nDTSTART:20250101T000000Z\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"), None)
+
+
+def test_events_are_grouped_by_type_and_uid():
+    index = EventIndex([make_event("truenas-snapshot-1"), make_event("truenas-snapshot-2"), make_event("truenas-scrub-1"), make_event("something-else")])
+    assert len(index) == 4
+    assert set(index.for_type(ITEM_TYPE_SNAPSHOT)) == {"truenas-snapshot-1", "truenas-snapshot-2"}
+    assert set(index.for_type(ITEM_TYPE_SCRUB)) == {"truenas-scrub-1"}
+    assert {x.uid for x in index} == {"truenas-snapshot-1", "truenas-snapshot-2", "truenas-scrub-1", "something-else"}
+
+
+def test_duplicate_uids_are_indexed_once():
+    first = make_event("truenas-scrub-1")
+    index = EventIndex([first, make_event("truenas-scrub-1")])
+    assert len(index) == 1
+    assert index.for_type(ITEM_TYPE_SCRUB)["truenas-scrub-1"] is first
@@ -0,0 +1,40 @@
+from common import ITEM_TYPE_REPLICATION, ITEM_TYPE_SMART
+from event_plan import PlannedEvent, plan_events
+from item_types import ITEM_TYPES
+
+ITEMS = [
+    {"id": 1, "dataset": "tank/media", "enabled": True, "schedule": {"minute": "0", "hour": "*", "dom": "*", "month": "*", "dow": "*"}},
+    {"id": 2, "dataset": "tank/photos", "enabled": True, "schedule": {"minute": "0", "hour": "*", "dom": "*", "month": "*", "dow": "*"}},
+    {"id": 3, "dataset": "tank/backups", "enabled": False, "schedule": {"minute": "0", "hour": "*", "dom": "*", "month": "*", "dow": "*"}},
+    {"id": 4, "dataset": "ssd", "enabled": True, "schedule": {"minute": "0", "hour": "0", "dom": "*", "month": "*", "dow": "sun"}},
+]
+
+SNAPSHOT = ITEM_TYPES[0]
+
+
+def test_one_event_per_enabled_item():
+    planned = plan_events(ITEMS, SNAPSHOT, None)
+    assert [x.uid for x in planned] == ["truenas-snapshot-1", "truenas-snapshot-2", "truenas-snapshot-4"]
+    assert planned[0] == PlannedEvent("truenas-snapshot-1", "0 * * * *", "Snapshot: tank/media", None)
+
+
+def test_grouped_events_list_their_members():
+    planned = plan_events(ITEMS, SNAPSHOT, None, True)
+    assert len(planned) == 2
+    assert planned[0].summary == "Snapshot: tank/media and 1 more"
+    assert planned[0].description == "tank/media\ntank/photos"
+    assert planned[0].uid == plan_events(list(reversed(ITEMS)), SNAPSHOT, None, True)[1].uid
+    assert planned[1].summary == "Snapshot: ssd"
+
+
+def test_items_without_enabled_key_description_or_schedule():
+    smart, replication = (next(x for x in ITEM_TYPES if x.name == name) for name in (ITEM_TYPE_SMART, ITEM_TYPE_REPLICATION))
+
+    planned = plan_events([{"id": 5, "desc": "", "schedule": {"hour": "3", "dom": "*", "month": "*", "dow": "sat"}}], smart, None)
+    assert planned == [PlannedEvent("truenas-smart-5", "0 3 * * sat", "SMART: #5", None)]
+
+    replications = [
+        {"id": 1, "name": "offsite", "enabled": True, "schedule": {"minute": "30", "hour": "2", "dom": "*", "month": "*", "dow": "*"}},
+        {"id": 2, "name": "after-snapshots", "enabled": True, "schedule": None},
+    ]
+    assert [x.uid for x in plan_events(replications, replication, None)] == ["truenas-replication-1"]
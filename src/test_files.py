@@ -0,0 +1,17 @@
+import os
+import stat
+from files import PUBLIC_FILE_MODE, write_file_atomically
+
+
+def test_files_are_private_unless_asked_otherwise(tmp_path):
+    state_path = tmp_path / "state.json"
+    feed_path = tmp_path / "feed" / "truenas-jobs.ics"
+
+    write_file_atomically(str(state_path), b"{}")
+    write_file_atomically(str(feed_path), b"BEGIN:VCALENDAR", PUBLIC_FILE_MODE)
+    write_file_atomically(str(feed_path), b"BEGIN:VCALENDAR\r\n", PUBLIC_FILE_MODE)
+
+    assert stat.S_IMODE(os.stat(state_path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(feed_path).st_mode) == 0o644
+    assert feed_path.read_bytes() == b"BEGIN:VCALENDAR\r\n"
+    assert sorted(os.listdir(feed_path.parent)) == ["truenas-jobs.ics"]
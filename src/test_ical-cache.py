@@ -0,0 +1,49 @@
+from zoneinfo import ZoneInfo
+import ical_cache
+from ical_cache import ICalCache
+
+
+def test_equivalent_crons_share_an_entry():
+    cache = ICalCache()
+    first = cache.get("0 0 * * sun")
+    second = cache.get("0 0 * * 0")
+    assert first is second
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ICalCache(max_size=2)
+    cache.get("0 1 * * *")
+    cache.get("0 2 * * *")
+    cache.get("0 1 * * *")
+    cache.get("0 3 * * *")
+    assert len(cache) == 2
+
+    cache.get("0 1 * * *")
+    assert cache.hits == 2
+
+    cache.get("0 2 * * *")
+    assert cache.misses == 4
+
+
+def test_entry_expires_after_one_period():
+    cache = ICalCache()
+    result = cache.get("0 12 * * *")
+    entry = cache._entries["0 12 * * *"]
+    assert (entry.expires - result.start).total_seconds() == 24 * 60 * 60
+
+    entry.expires = result.start
+    assert cache.get("0 12 * * *") is not result
+    assert cache.misses == 2
+
+
+def test_entry_expires_when_the_local_timezone_changes(monkeypatch):
+    cache = ICalCache()
+    monkeypatch.setattr(ical_cache, "resolve_local_timezone", lambda now: ZoneInfo("America/Denver"))
+    result = cache.get("0 12 * * *")
+    assert cache.get("0 12 * * *") is result
+
+    monkeypatch.setattr(ical_cache, "resolve_local_timezone", lambda now: ZoneInfo("America/Boise"))
+    assert cache.get("0 12 * * *") is not result
+    assert cache.misses == 2
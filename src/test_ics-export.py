@@ -0,0 +1,55 @@
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from cron_to_ical import ICalResult
+from event_plan import PlannedEvent
+from ics_export import IcsFeed, feed_etag, render_calendar, start_feed_server
+
+
+def make_events(start: datetime) -> list[tuple[PlannedEvent, ICalResult]]:
+    ical = ICalResult(start, start, {"FREQ": "DAILY", "BYHOUR": [0], "BYMINUTE": [0]})
+    return [(PlannedEvent("truenas-scrub-1", "0 0 * * *", "Scrub: tank", None), ical)]
+
+
+def test_etag_ignores_moving_dtstart():
+    start = datetime(2025, 1, 1, tzinfo=ZoneInfo("America/Denver"))
+    assert feed_etag(make_events(start)) == feed_etag(make_events(start + timedelta(days=1)))
+
+    changed = make_events(start)
+    changed[0][0].summary = "Scrub: ssd"
+    assert feed_etag(changed) != feed_etag(make_events(start))
+
+
+def test_rendered_calendar_includes_timezones():
+    body = render_calendar(make_events(datetime(2025, 1, 1, tzinfo=ZoneInfo("America/Denver"))), datetime(2025, 1, 1, tzinfo=timezone.utc)).decode()
+    assert "BEGIN:VTIMEZONE" in body
+    assert "UID:truenas-scrub-1" in body
+    assert "DTSTART;TZID=America/Denver:20250101T000000" in body
+
+
+def test_server_answers_matching_etag_with_not_modified():
+    feed = IcsFeed()
+    server = start_feed_server(0, feed)
+    url = f"http://127.0.0.1:{server.server_address[1]}/jobs.ics"
+
+    try:
+        try:
+            urllib.request.urlopen(url)
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 503
+
+        feed.publish("\"abc\"", b"BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n")
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["ETag"] == "\"abc\""
+            assert response.read() == b"BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n"
+
+        try:
+            urllib.request.urlopen(urllib.request.Request(url, headers={"If-None-Match": "W/\"abc\""}))
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 304
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+from caldav.calendarobjectresource import Event
+from calendar_snapshot import RemoteEvent, remote_event_from_event
+from common import ITEM_TYPE_CLOUDSYNC, ITEM_TYPE_SCRUB
+from job_runs import create_run_event, expired_run_events, is_run_uid, parse_job
+from state_store import StoredEvent, SyncState
+
+START = datetime(2025, 1, 1, 2, 0, tzinfo=timezone.utc)
+
+
+def make_job(**kwargs) -> dict:
+    return {
+        "id": 7,
+        "method": "cloudsync.sync",
+        "arguments": [3],
+        "state": "SUCCESS",
+        "time_started": {"$date": int(START.timestamp() * 1000)},
+        "time_finished": START + timedelta(minutes=2, seconds=5),
+        "error": None,
+        **kwargs,
+    }
+
+
+def make_event(uid: str, dtstart: str) -> RemoteEvent:
+    return remote_event_from_event(Event(url=f"http://localhost/calendar/{uid}.ics", data=f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//test//test//EN\r\nBEGIN:VEVENT\r\nUID:{uid}\r\nDTSTART:{dtstart}\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"), None)
+
+
+def test_finished_jobs_become_runs():
+    run = parse_job(make_job())
+    assert run is not None
+    assert (run.job_id, run.item_type, run.item_id, run.item_name) == (7, ITEM_TYPE_CLOUDSYNC, 3, None)
+    assert (run.start, run.end) == (START, START + timedelta(minutes=2, seconds=5))
+
+    scrub = parse_job(make_job(method="pool.scrub.run", arguments=["tank", 35], state="FAILED", error="[EFAULT] busy"))
+    assert scrub is not None
+    assert (scrub.item_type, scrub.item_id, scrub.item_name) == (ITEM_TYPE_SCRUB, None, "tank")
+
+    event = create_run_event(scrub, "tank")
+    assert is_run_uid(event.uid)
+    assert event.summary == "Scrub run failed: tank"
+    assert event.description == "Job 7 failed after 2m 5s.\n\n[EFAULT] busy"
+
+
+def test_unfinished_and_unrelated_jobs_are_ignored():
+    assert parse_job(make_job(state="RUNNING", time_finished=None)) is None
+    assert parse_job(make_job(method="disk.smart_test")) is None
+    assert parse_job(make_job(state="WAITING", time_started=None, time_finished=None)) is None
+
+
+def test_expired_run_events_are_removed_oldest_first_in_batches():
+    events = {
+        "truenas-run-1-1": make_event("truenas-run-1-1", "20241201T000000Z"),
+        "truenas-run-2-2": make_event("truenas-run-2-2", "20241101T000000Z"),
+        "truenas-run-3-3": make_event("truenas-run-3-3", "20250101T000000Z"),
+    }
+    # The state knows when the runs it saved started, which saves downloading them.
+    state = SyncState(events={"truenas-run-1-1": StoredEvent("http://localhost/calendar/truenas-run-1-1.ics", None, "hash", "2024-10-01T00:00:00+00:00")})
+    cutoff = datetime(2024, 12, 15, tzinfo=timezone.utc)
+
+    assert [x.uid for x in expired_run_events(events, state, cutoff)] == ["truenas-run-1-1", "truenas-run-2-2"]
+    assert [x.uid for x in expired_run_events(events, state, cutoff, 1)] == ["truenas-run-1-1"]
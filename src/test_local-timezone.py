@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+from dateutil import tz
+from zoneinfo import ZoneInfo
+import local_timezone
+from local_timezone import LocalTimezoneResolver, zone_from_path
+
+
+def test_zone_from_path():
+    assert zone_from_path("/usr/share/zoneinfo/America/Denver") == ZoneInfo("America/Denver")
+    assert zone_from_path("/usr/share/zoneinfo/posix/Europe/Berlin") == ZoneInfo("Europe/Berlin")
+    assert zone_from_path("/etc/localtime") is None
+
+
+def test_tz_env_is_preferred(monkeypatch):
+    monkeypatch.setenv("TZ", ":America/Denver")
+    resolver = LocalTimezoneResolver()
+    assert resolver.resolve(datetime.now(ZoneInfo("UTC"))) == ZoneInfo("America/Denver")
+
+
+def test_tz_env_without_an_iana_key_is_matched_by_offset(monkeypatch):
+    monkeypatch.setenv("TZ", "XYZ3")
+    # The process doesn't use /etc/localtime with TZ set.
+    monkeypatch.setattr(local_timezone, "zone_from_localtime_link", lambda: ZoneInfo("Europe/Berlin"))
+
+    now = datetime(2025, 1, 15, 12, tzinfo=tz.tzstr("XYZ3"))
+    zone = LocalTimezoneResolver().resolve(now)
+    assert zone is not None and zone != ZoneInfo("Europe/Berlin")
+    assert zone.utcoffset(now.replace(tzinfo=None)) == timedelta(hours=-3)
+
+
+def test_offset_match_is_cached_until_the_offset_changes(monkeypatch):
+    monkeypatch.delenv("TZ", raising=False)
+    monkeypatch.setattr(local_timezone, "zone_from_localtime_link", lambda: None)
+
+    lookups = []
+    original_zone_from_offset = local_timezone.zone_from_offset
+
+    def counting_zone_from_offset(now):
+        lookups.append(now)
+        return original_zone_from_offset(now)
+
+    monkeypatch.setattr(local_timezone, "zone_from_offset", counting_zone_from_offset)
+
+    resolver = LocalTimezoneResolver()
+    winter = datetime(2025, 1, 15, 12, tzinfo=ZoneInfo("America/Denver"))
+    summer = datetime(2025, 7, 15, 12, tzinfo=ZoneInfo("America/Denver"))
+
+    winter_zone = resolver.resolve(winter)
+    assert winter_zone is not None
+    assert winter_zone.utcoffset(winter.replace(tzinfo=None)) == winter.utcoffset()
+    assert resolver.resolve(winter) == winter_zone
+    assert len(lookups) == 1
+
+    resolver.resolve(summer)
+    assert len(lookups) == 2
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import pytest
+import sys
+import main
+from common import current_target
+from metrics import SYNC_EXPORT, health, record_sync
+from options import CONFIG_FILE_ENV, ICS_FILE_ENV, OUTPUT_ENV, OUTPUT_ICS, TRUENAS_API_KEY_ENV, TRUENAS_HOST_ENV, Options
+from state_store import SyncState
+from targets import SyncConfig, SyncTarget, TargetLogFilter
+
+
+def ics_target(name: str, tmp_path) -> SyncTarget:
+    options = Options.from_mapping({OUTPUT_ENV: OUTPUT_ICS, ICS_FILE_ENV: str(tmp_path / f"{name}.ics"), TRUENAS_HOST_ENV: "nas.lan", TRUENAS_API_KEY_ENV: "key"})
+    return SyncTarget(name, options, SyncState())
+
+
+def test_a_single_configured_target_is_recorded_under_its_own_name(tmp_path, monkeypatch):
+    async def sync_once(target, dav_adapter, sync_slots):
+        record_sync(SYNC_EXPORT, 0.1, True)
+        return True
+
+    monkeypatch.setattr(main, "run_target_once", sync_once)
+
+    assert asyncio.run(main.run_targets(SyncConfig(1, [ics_target("single-nas", tmp_path)]), once=True))
+    assert "single-nas" not in health()[1]
+
+
+def test_log_lines_are_only_prefixed_with_more_than_one_target():
+    log_filter = TargetLogFilter()
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "Synced.", None, None)
+
+    token = current_target.set("nas")
+    try:
+        log_filter.filter(record)
+        assert record.target_prefix == ""  # type: ignore
+
+        log_filter.show_targets = True
+        log_filter.filter(record)
+        assert record.target_prefix == "[nas] "  # type: ignore
+    finally:
+        current_target.reset(token)
+
+
+class FakeConnectionManager:
+    def __init__(self, options, dav_adapter):
+        pass
+
+    def dav_client(self):
+        return None
+
+    def truenas_client(self):
+        return None
+
+    def reset(self):
+        pass
+
+
+def run_main_once(monkeypatch, tmp_path, sync_fails: bool) -> int:
+    async def sync(target, dav_client, truenas_client, changed_ids=None):
+        if sync_fails:
+            raise Exception("TrueNAS is unreachable")
+
+    monkeypatch.setattr(main, "ConnectionManager", FakeConnectionManager)
+    monkeypatch.setattr(main, "sync_target", sync)
+    monkeypatch.setattr(sys, "argv", ["main.py", "--once"])
+    for name, value in ((OUTPUT_ENV, OUTPUT_ICS), (ICS_FILE_ENV, str(tmp_path / "jobs.ics")), (TRUENAS_HOST_ENV, "nas.lan"), (TRUENAS_API_KEY_ENV, "key")):
+        monkeypatch.setenv(name, value)
+
+    with pytest.raises(SystemExit) as exit_info:
+        main.main()
+
+    return exit_info.value.code  # type: ignore
+
+
+def test_syncing_once_exits_with_whether_the_sync_succeeded(tmp_path, monkeypatch):
+    monkeypatch.delenv(CONFIG_FILE_ENV, raising=False)
+    assert run_main_once(monkeypatch, tmp_path, False) == main.EXIT_SUCCESS
+    assert run_main_once(monkeypatch, tmp_path, True) == main.EXIT_SYNC_FAILED
+
+
+def test_syncing_once_with_an_invalid_configuration_exits_before_syncing(tmp_path, monkeypatch):
+    monkeypatch.setenv(CONFIG_FILE_ENV, str(tmp_path / "missing.toml"))
+    assert run_main_once(monkeypatch, tmp_path, False) == main.EXIT_CONFIG_ERROR
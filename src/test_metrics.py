@@ -0,0 +1,64 @@
+import urllib.error
+import urllib.request
+from common import current_target
+from metrics import Counter, Histogram, health, record_sync, register_target, start_metrics_server
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("test_seconds", "Test.", ("phase",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, phase="fetch")
+    histogram.observe(0.5, phase="fetch")
+    histogram.observe(5, phase="fetch")
+
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        "test_seconds_bucket{target=\"default\",phase=\"fetch\",le=\"0.1\"} 1",
+        "test_seconds_bucket{target=\"default\",phase=\"fetch\",le=\"1.0\"} 2",
+        "test_seconds_bucket{target=\"default\",phase=\"fetch\",le=\"+Inf\"} 3",
+        "test_seconds_sum{target=\"default\",phase=\"fetch\"} 5.55",
+        "test_seconds_count{target=\"default\",phase=\"fetch\"} 3",
+    ]
+
+
+def test_metrics_are_labelled_with_the_current_target():
+    counter = Counter("test_total", "Test.", ("outcome",))
+    counter.inc(outcome="created")
+
+    token = current_target.set("nas \"1\"")
+    try:
+        counter.inc(2, outcome="created")
+        assert counter.get(outcome="created") == 2
+    finally:
+        current_target.reset(token)
+
+    assert counter.get(outcome="created") == 1
+    assert "test_total{target=\"nas \\\"1\\\"\",outcome=\"created\"} 2.0" in counter.render()
+
+
+def test_health_fails_until_every_target_synced_successfully():
+    register_target("health-test")
+    server = start_metrics_server(0)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        try:
+            urllib.request.urlopen(f"{url}/health")
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 503
+            assert "health-test" in e.read().decode()
+
+        token = current_target.set("health-test")
+        try:
+            record_sync("full", 1.5, True)
+        finally:
+            current_target.reset(token)
+
+        assert "health-test" not in health()[1]
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            body = response.read().decode()
+            assert "truenas_jobs_caldav_syncs_total{target=\"health-test\",kind=\"full\",result=\"success\"} 1.0" in body
+    finally:
+        server.shutdown()
+        server.server_close()
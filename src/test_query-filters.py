@@ -0,0 +1,23 @@
+import re
+from query_filters import build_query_filters, regex_to_query_filter
+
+
+def test_anchored_literals_become_query_filters():
+    assert regex_to_query_filter("dataset", re.compile("^tank/data$")) == ["dataset", "=", "tank/data"]
+    assert regex_to_query_filter("dataset", re.compile("^tank/")) == ["dataset", "^", "tank/"]
+    assert regex_to_query_filter("dataset", re.compile("/media$")) == ["dataset", "$", "/media"]
+    assert regex_to_query_filter("description", re.compile(r"^Backup \(daily\)$")) == ["description", "=", "Backup (daily)"]
+
+
+def test_other_regexes_are_left_for_local_filtering():
+    assert regex_to_query_filter("dataset", re.compile("tank")) is None
+    assert regex_to_query_filter("dataset", re.compile("^tank.*$")) is None
+    assert regex_to_query_filter("dataset", re.compile(r"^tank\d")) is None
+    assert regex_to_query_filter("dataset", re.compile("^tank$", re.IGNORECASE)) is None
+    assert regex_to_query_filter("dataset", re.compile("^$")) is None
+
+
+def test_enabled_items_are_always_filtered():
+    assert build_query_filters("enabled", "dataset", None) == [["enabled", "=", True]]
+    assert build_query_filters(None, "dataset", re.compile("^tank/")) == [["dataset", "^", "tank/"]]
+    assert build_query_filters("enabled", "dataset", re.compile("tank")) == [["enabled", "=", True]]
@@ -0,0 +1,17 @@
+from state_store import StoredEvent, SyncState, load_state, save_state
+
+
+def test_state_round_trips_through_disk(tmp_path):
+    path = str(tmp_path / "state" / "state.json")
+    state = SyncState("http://localhost/calendar/", "token", None, {"truenas-scrub-1": StoredEvent("http://localhost/calendar/truenas-scrub-1.ics", "\"etag\"", "hash", "2025-01-01T00:00:00+00:00")}, 42, [40])
+    save_state(path, state)
+    assert load_state(path) == state
+
+
+def test_missing_or_corrupt_state_is_empty(tmp_path):
+    assert load_state(None) == SyncState()
+    assert load_state(str(tmp_path / "missing.json")) == SyncState()
+
+    path = tmp_path / "corrupt.json"
+    path.write_text("{not json")
+    assert load_state(str(path)) == SyncState()
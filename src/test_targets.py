@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import pytest
+from common import ITEM_TYPE_CRONJOB, ITEM_TYPE_SCRUB
+from targets import load_config
+
+CONFIG = """
+max_concurrent_syncs = 2
+metrics_port = 9100
+
+[defaults]
+caldav_host = "192.168.1.22:5232"
+caldav_username = "truenas"
+truenas_api_key = "key"
+
+[[targets]]
+name = "nas1"
+truenas_host = "nas1.lan"
+calendar_id = "nas1-jobs"
+include_cronjobs = false
+
+[[targets]]
+name = "nas2"
+truenas_host = "nas2.lan"
+calendar_id = "nas2-jobs"
+caldav_max_concurrency = 8
+scrubs_filter = "^ssd$"
+"""
+
+
+def test_targets_fall_back_to_defaults_then_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("CALDAV_PASSWORD", "secret")
+    monkeypatch.setenv("SYNC_INTERVAL", "1 day")
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+
+    config = load_config(str(path))
+    assert config.max_concurrent_syncs == 2
+    assert config.metrics_port == 9100
+
+    nas1, nas2 = config.targets
+    assert (nas1.name, nas1.options.truenas_host, nas1.options.calendar_id) == ("nas1", "nas1.lan", "nas1-jobs")
+    assert nas1.options.caldav_password == "secret"
+    assert nas1.options.sync_interval.seconds == 24 * 60 * 60
+    assert not nas1.options.include[ITEM_TYPE_CRONJOB]
+    assert nas2.options.include[ITEM_TYPE_CRONJOB]
+    assert nas2.options.caldav_max_concurrency == 8
+    assert nas2.options.filters[ITEM_TYPE_SCRUB] is not None and nas2.options.filters[ITEM_TYPE_SCRUB].pattern == "^ssd$"
+    assert nas1.snapshot is not nas2.snapshot
+
+    snapshot = nas1.snapshot
+    nas1.reset_snapshot()
+    assert nas1.snapshot is not None and nas1.snapshot is not snapshot
+
+
+def test_targets_may_not_share_a_calendar(tmp_path, monkeypatch):
+    monkeypatch.setenv("CALDAV_PASSWORD", "secret")
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG.replace("nas2-jobs", "nas1-jobs"))
+
+    with pytest.raises(Exception, match="another target already syncs to"):
+        load_config(str(path))
+
+
+def test_ics_targets_do_not_import_the_caldav_client(tmp_path):
+    # A fresh interpreter, since other tests import the CalDAV client.
+    script = "import sys, targets, event_plan, job_runs; target = targets.load_config_from_env().targets[0]; print(target.snapshot is None, 'caldav' in sys.modules)"
+    env = {**os.environ, "OUTPUT": "ics", "ICS_FILE": str(tmp_path / "jobs.ics"), "TRUENAS_HOST": "nas.lan", "TRUENAS_API_KEY": "key", "CONFIG_FILE": ""}
+    result = subprocess.run([sys.executable, "-c", script], env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ["True", "False"]
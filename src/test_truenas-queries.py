@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+from typing import Any
+from truenas_api_client import ClientException
+from truenas_queries import QuerySpec, fetch_job_runs, run_queries, run_query_spec
+
+
+class FakeTrueNASClient:
+    """
+    Answers every query with a single item naming the query, after a delay.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: list[tuple[str, tuple[Any, ...]]] = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._lock = threading.Lock()
+
+    def call(self, method: str, *params: Any) -> Any:
+        with self._lock:
+            self.calls.append((method, params))
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+
+        time.sleep(self.latency)
+
+        with self._lock:
+            self.in_flight -= 1
+
+        return [{"id": 1, "query": method}]
+
+
+class FakeJobsClient:
+    """
+    Answers core.get_jobs from a list of jobs, applying the filters and options that fetch_job_runs uses.
+    """
+
+    def __init__(self, jobs: list[dict[str, Any]]):
+        self.jobs = jobs
+
+    def call(self, method: str, filters: list[list[Any]], options: dict[str, Any]) -> Any:
+        assert method == "core.get_jobs"
+        operators = {">": lambda a, b: a > b, "in": lambda a, b: a in b}
+        jobs = [x for x in self.jobs if all(operators[op](x[name], value) for name, op, value in filters)]
+        jobs.sort(key=lambda x: x["id"], reverse=options["order_by"] == ["-id"])
+        return jobs[:options.get("limit")]
+
+
+def make_job(job_id: int, state: str = "SUCCESS") -> dict[str, Any]:
+    return {"id": job_id, "method": "pool.snapshottask.run", "arguments": [job_id * 10], "state": state, "time_started": 1735689600000, "time_finished": 1735689660000 if state != "RUNNING" else None}
+
+
+class OldTrueNASClient(FakeTrueNASClient):
+    """
+    Rejects queries with filters or a field selection, like middleware that doesn't support them.
+    """
+
+    def call(self, method: str, *params: Any) -> Any:
+        result = super().call(method, *params)
+        if len(params) > 0:
+            raise ClientException("Invalid params")
+
+        return result
+
+
+def test_queries_are_issued_concurrently_and_keyed_by_query():
+    client = FakeTrueNASClient(0.2)
+    queries = ["pool.snapshottask.query", "pool.scrub.query", "cloudsync.query", "cronjob.query"]
+
+    start = time.perf_counter()
+    results = asyncio.run(run_queries(client, [QuerySpec(x) for x in queries], set()))  # type: ignore
+    seconds = time.perf_counter() - start
+
+    assert client.most_in_flight == len(queries)
+    # One after the other, they would take 0.8s.
+    assert seconds < 0.6
+    assert set(results) == set(queries)
+    assert all(result.query == query and result.items == [{"id": 1, "query": query}] for query, result in results.items())
+
+
+def test_no_queries_make_no_calls():
+    client = FakeTrueNASClient()
+    assert asyncio.run(run_queries(client, [], set())) == {}  # type: ignore
+    assert client.calls == []
+
+
+def test_queries_fall_back_to_plain_queries_and_remember_it():
+    client = OldTrueNASClient()
+    queries_without_options: set[str] = set()
+    spec = QuerySpec("pool.scrub.query", ["id", "pool_name"], [["id", "in", [1]]])
+
+    assert run_query_spec(client, spec, queries_without_options).items == [{"id": 1, "query": "pool.scrub.query"}]  # type: ignore
+    assert client.calls == [("pool.scrub.query", ([["id", "in", [1]]], {"select": ["id", "pool_name"]})), ("pool.scrub.query", ())]
+    assert queries_without_options == {"pool.scrub.query"}
+
+    # Later syncs go straight to the plain query, while other TrueNAS instances keep using the options.
+    run_query_spec(client, spec, queries_without_options)  # type: ignore
+    assert client.calls[2:] == [("pool.scrub.query", ())]
+
+    client = FakeTrueNASClient()
+    run_query_spec(client, spec, set())  # type: ignore
+    assert client.calls == [("pool.scrub.query", ([["id", "in", [1]]], {"select": ["id", "pool_name"]}))]
+
+
+def test_job_runs_after_an_unfinished_job_are_not_held_back_by_it():
+    client = FakeJobsClient([make_job(1), make_job(2, "RUNNING"), make_job(3)])
+
+    runs, cursor, unfinished = fetch_job_runs(client, 0, [], ["pool.snapshottask.run"])  # type: ignore
+    assert [x.job_id for x in runs] == [1, 3]
+    assert (cursor, unfinished) == (3, [2])
+
+    # The unfinished job is fetched again by its ID, until it finishes.
+    client.jobs.append(make_job(4, "RUNNING"))
+    runs, cursor, unfinished = fetch_job_runs(client, cursor, unfinished, ["pool.snapshottask.run"])  # type: ignore
+    assert (runs, cursor, unfinished) == ([], 4, [2, 4])
+
+    client.jobs[1] = make_job(2)
+    runs, cursor, unfinished = fetch_job_runs(client, cursor, unfinished, ["pool.snapshottask.run"])  # type: ignore
+    assert [x.job_id for x in runs] == [2]
+    assert (cursor, unfinished) == (4, [4])
+
+    # A job that disappeared without finishing is forgotten.
+    client.jobs[3] = make_job(5)
+    runs, cursor, unfinished = fetch_job_runs(client, cursor, unfinished, ["pool.snapshottask.run"])  # type: ignore
+    assert [x.job_id for x in runs] == [5]
+    assert (cursor, unfinished) == (5, [])
+
+
+def test_job_cursor_starts_over_when_the_middleware_restarted():
+    client = FakeJobsClient([make_job(1), make_job(2, "RUNNING")])
+
+    runs, cursor, unfinished = fetch_job_runs(client, 40, [38], ["pool.snapshottask.run"])  # type: ignore
+    assert [x.job_id for x in runs] == [1]
+    assert (cursor, unfinished) == (2, [2])
+
+
+def test_job_cursor_is_reset_without_job_history():
+    client = FakeJobsClient([])
+    assert fetch_job_runs(client, 0, [], ["pool.snapshottask.run"]) == ([], 0, [])  # type: ignore
+    assert fetch_job_runs(client, 40, [38], ["pool.snapshottask.run"]) == ([], 0, [])  # type: ignore
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+from truenas_api_client import ClientException, JSONRPCClient, LegacyClient
+from job_runs import FINISHED_JOB_STATES, JobRun, parse_job
+from metrics import query_seconds
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QuerySpec:
+    query: str
+    select: Optional[list[str]] = None
+    filters: list[list[Any]] = field(default_factory=list)
+
+
+@dataclass
+class QueryResult:
+    query: str
+    items: list[Dict]
+    seconds: float
+
+
+def run_query(truenas_client: JSONRPCClient | LegacyClient, query: str, *params: Any) -> QueryResult:
+    """
+    Runs a single TrueNAS query and times it.
+
+    :param truenas_client: The TrueNAS API client to use.
+    :type truenas_client: JSONRPCClient | LegacyClient
+    :param query: The query method (i.e. pool.scrub.query).
+    :type query: str
+    :return: The queried items.
+    :rtype: QueryResult
+    """
+    start = time.perf_counter()
+    items: list[Dict] = truenas_client.call(query, *params)  # type: ignore
+    seconds = time.perf_counter() - start
+    query_seconds.observe(seconds, query=query)
+    return QueryResult(query, items, seconds)
+
+
+def run_query_spec(truenas_client: JSONRPCClient | LegacyClient, spec: QuerySpec, queries_without_options: set[str]) -> QueryResult:
+    """
+    Runs a TrueNAS query with its filters and field selection, falling back to a plain query on middleware that can't do those.
+    Callers should still filter the items themselves since the fallback returns every item.
+
+    :param truenas_client: The TrueNAS API client to use.
+    :type truenas_client: JSONRPCClient | LegacyClient
+    :param spec: The query to run.
+    :type spec: QuerySpec
+    :param queries_without_options: The queries that failed with filters or a field selection on this TrueNAS before, i.e. because its middleware doesn't support them. A query that fails is added.
+    :type queries_without_options: set[str]
+    :return: The queried items.
+    :rtype: QueryResult
+    """
+    if (spec.select is None and len(spec.filters) == 0) or spec.query in queries_without_options:
+        return run_query(truenas_client, spec.query)
+
+    options: dict[str, Any] = {}
+    if spec.select is not None:
+        options["select"] = spec.select
+
+    try:
+        return run_query(truenas_client, spec.query, spec.filters, options)
+    except ClientException as e:
+        logger.warning(f"Query \"{spec.query}\" failed with filters or a field selection, falling back to fetching every whole item from now on: {e}")
+        queries_without_options.add(spec.query)
+        return run_query(truenas_client, spec.query)
+
+
+async def run_queries(truenas_client: JSONRPCClient | LegacyClient, queries: list[QuerySpec], queries_without_options: set[str]) -> dict[str, QueryResult]:
+    """
+    Runs several TrueNAS queries at the same time.
+
+    The client multiplexes calls over its one websocket connection, so each query is issued from its own worker thread and the requests are pipelined rather than waiting on each other's round trips.
+
+    :param truenas_client: The TrueNAS API client to use.
+    :type truenas_client: JSONRPCClient | LegacyClient
+    :param queries: The queries to run.
+    :type queries: list[QuerySpec]
+    :param queries_without_options: The queries to run without filters or a field selection on this TrueNAS, see run_query_spec.
+    :type queries_without_options: set[str]
+    :return: The results keyed by query method.
+    :rtype: dict[str, QueryResult]
+    """
+    if len(queries) == 0:
+        return {}
+
+    start = time.perf_counter()
+    results = {x.query: x for x in await asyncio.gather(*(asyncio.to_thread(run_query_spec, truenas_client, spec, queries_without_options) for spec in queries))}
+
+    timings = ", ".join(f"{x.query}: {x.seconds:.3f}s" for x in results.values())
+    logger.info(f"Fetched {len(results)} queries in {time.perf_counter() - start:.3f}s ({timings}).")
+    return results
+
+
+def fetch_job_runs(truenas_client: JSONRPCClient | LegacyClient, cursor: int, unfinished_ids: list[int], methods: list[str]) -> tuple[list[JobRun], int, list[int]]:
+    """
+    Fetches the runs that finished since the cursor, and the runs of jobs that were still running last time.
+
+    The cursor moves past every job that was fetched, and jobs that are still running are remembered by their IDs instead, so that a job that never finishes doesn't hold back the runs after it. Job IDs start over when the middleware restarts, which is noticed when the newest job is older than the cursor.
+
+    :param truenas_client: The TrueNAS API client to use.
+    :type truenas_client: JSONRPCClient | LegacyClient
+    :param cursor: The highest job ID that was already fetched.
+    :type cursor: int
+    :param unfinished_ids: The IDs of the jobs up to the cursor that were still running.
+    :type unfinished_ids: list[int]
+    :param methods: The job methods to fetch the runs of.
+    :type methods: list[str]
+    :return: The finished runs, the new cursor and the IDs of the jobs that are still running.
+    :rtype: tuple[list[JobRun], int, list[int]]
+    """
+    jobs: list[Dict] = truenas_client.call("core.get_jobs", [["id", ">", cursor], ["method", "in", methods]], {"order_by": ["id"]})  # type: ignore
+
+    if len(jobs) == 0 and cursor > 0:
+        latest: list[Dict] = truenas_client.call("core.get_jobs", [], {"order_by": ["-id"], "limit": 1, "select": ["id"]})  # type: ignore
+        if len(latest) == 0 or latest[0]["id"] < cursor:
+            logger.info(f"The newest TrueNAS job is older than the job cursor {cursor}, so the middleware must have restarted. Starting over.")
+            return fetch_job_runs(truenas_client, 0, [], methods) if len(latest) > 0 else ([], 0, [])
+
+    # Jobs that disappeared in the meantime aren't returned, and so they are forgotten.
+    if len(unfinished_ids) > 0:
+        jobs = truenas_client.call("core.get_jobs", [["id", "in", unfinished_ids], ["method", "in", methods]], {"order_by": ["id"]}) + jobs  # type: ignore
+
+    runs: list[JobRun] = []
+    new_cursor = max([cursor] + [job["id"] for job in jobs])
+    still_unfinished: list[int] = []
+
+    for job in jobs:
+        if job.get("state") not in FINISHED_JOB_STATES:
+            still_unfinished.append(job["id"])
+            continue
+
+        run = parse_job(job)
+        if run is not None:
+            runs.append(run)
+
+    logger.info(f"Found {len(runs)} finished job runs after job {cursor}, {len(still_unfinished)} jobs are still running.")
+    return runs, new_cursor, still_unfinished